@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from botcontrol import get_password_hash, verify_password, pwd_context
+
+# --- Password Hashing Pool ---
+# bcrypt is deliberately slow (tens to hundreds of ms per call), so admin
+# logins never hash on the event loop. A small dedicated pool bounds how many
+# run at once, so a burst of logins can't take every core or the default
+# executor's threads away from the rest of the bot.
+
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "2"))
+# 'thread', 'process' or 'auto'. Threads only help when the bcrypt backend
+# releases the GIL, which pyca/bcrypt does but passlib's fallbacks (os_crypt,
+# builtin) don't; processes always run in parallel, at the cost of one
+# interpreter per worker. 'auto' picks threads only for pyca/bcrypt.
+BCRYPT_POOL = os.getenv("BCRYPT_POOL", "auto")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _use_processes() -> bool:
+    if BCRYPT_POOL != 'auto':
+        return BCRYPT_POOL == 'process'
+    from passlib.hash import bcrypt
+    return bcrypt.get_backend() != 'bcrypt'
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                if _use_processes():
+                    # spawn: forking a process that already runs DB and event loop threads is unsafe
+                    _executor = ProcessPoolExecutor(max_workers=BCRYPT_WORKERS,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    _executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix='bcrypt')
+    return _executor
+
+
+async def hash_password(password: str) -> str:
+    """get_password_hash() in the bcrypt pool."""
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), get_password_hash, password)
+
+
+async def check_password(password: str, password_hash: str) -> bool:
+    """verify_password() in the bcrypt pool."""
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), verify_password, password, password_hash)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """True if the hash uses a deprecated scheme or weaker settings than pwd_context now asks for."""
+    return pwd_context.needs_update(password_hash)
+
+
+# --- Admin Sessions ---
+
+ADMIN_SESSION_TTL = 15 * 60  # seconds an admin stays logged in without re-entering the password
+# Key the tokens are signed with. Sessions themselves live in the issuing
+# process's memory (see AdminSessionCache.verify()), so whatever the secret,
+# they end on restart and are valid in that process only; the random key
+# generated per process is enough.
+ADMIN_SESSION_SECRET = os.getenv("ADMIN_SESSION_SECRET", "").encode() or secrets.token_bytes(32)
+
+
+class AdminSessionCache:
+    """
+    Short-lived, signed admin session tokens, valid in the process that issued them.
+    A token is "<admin id>.<expiry>.<nonce>.<HMAC>", so a forged or altered
+    token fails the signature check without any lookup. Valid tokens must
+    also still be in the cache, which is what lets logout() and
+    revoke_admin() end a session before it expires.
+    """
+
+    def __init__(self, ttl: int = ADMIN_SESSION_TTL, secret: bytes = ADMIN_SESSION_SECRET):
+        self.ttl = ttl
+        self.secret = secret
+        self._sessions = {}  # token -> (admin id, expires at)
+        self._lock = threading.Lock()
+
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, admin_id: int) -> str:
+        """Starts a session for `admin_id` and returns its token."""
+        expires_at = int(time.time()) + self.ttl
+        payload = f"{admin_id}.{expires_at}.{secrets.token_hex(8)}"
+        token = f"{payload}.{self._sign(payload)}"
+        with self._lock:
+            self._purge_expired()
+            self._sessions[token] = (admin_id, expires_at)
+        return token
+
+    def verify(self, token: str) -> int | None:
+        """Returns the admin id of a live session, or None."""
+        payload, _, signature = token.rpartition('.')
+        if not payload or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            admin_id, expires_at = session
+            if expires_at <= time.time():
+                del self._sessions[token]
+                return None
+        return admin_id
+
+    def logout(self, token: str) -> None:
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def revoke_admin(self, admin_id: int) -> None:
+        """Ends every session of an admin, e.g. after a password change."""
+        with self._lock:
+            for token in [token for token, (owner, _) in self._sessions.items() if owner == admin_id]:
+                del self._sessions[token]
+
+    def _purge_expired(self) -> None:
+        now = time.time()
+        for token in [token for token, (_, expires_at) in self._sessions.items() if expires_at <= now]:
+            del self._sessions[token]
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+admin_sessions = AdminSessionCache()
+
+
+# --- Background Rehashing ---
+
+_background_tasks = set()  # keeps the rehash tasks referenced until they finish
+
+
+def schedule_rehash(rehash) -> None:
+    """Runs `rehash()` (a coroutine function) in the background, logging instead of raising."""
+    async def run() -> None:
+        try:
+            await rehash()
+        except Exception as e:
+            logging.warning(f"Admin password rehash failed: {e}")
+
+    task = asyncio.get_running_loop().create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -0,0 +1,543 @@
+# Async counterpart of botcontrol.py, used by the bot's handlers.
+# Every function mirrors the sync one with the same name, but takes an
+# AsyncSession so a MySQL round trip never blocks the event loop.
+# botcontrol.py stays the sync API for scripts like create_tables.py.
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator
+
+from sqlalchemy import select, func, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_models import (User, Deposit, Referral, Admin, Product, BroadcastProgress, Balance, BotState,
+                       PaymentNotification)
+from profile_cache import profile_cache
+from product_catalog import product_catalog
+import admin_auth
+from botcontrol import (ReferralStats, referral_stats_query,
+                        UPSERT_RETURNING_DIALECTS, upsert_users_statement, user_row,
+                        mark_deposits_paid_statement, PAGE_SIZE, deposits_by_state_page,
+                        to_decimal, coin_deltas, balance_upsert_statement, extend_subscription,
+                        subscription_days_left, shorten_subscription, bot_state_upsert_statement,
+                        unsettled_deposits_query, settlement_insert_statement,
+                        settlement_referral_update_statement, settlement_balance_statement,
+                        settled_deposits_statement, due_deposits_page, paid_deposits_claim_query,
+                        mark_deposit_ids_paid_statement, postpone_deposit_checks_statement,
+                        queue_payment_notifications_statement, payment_notifications_page)
+
+
+# --- Streaming Helpers ---
+# Async generators mirroring botcontrol's iter_* functions (keyset pagination).
+
+async def _iter_by_id(db: AsyncSession, stmt, id_column, page_size: int) -> AsyncIterator:
+    """Yields the entities selected by `stmt` in `id_column` order, page by page."""
+    last_id = None
+    while True:
+        page_stmt = stmt.order_by(id_column).limit(page_size)
+        if last_id is not None:
+            page_stmt = page_stmt.where(id_column > last_id)
+        page = (await db.scalars(page_stmt)).all()
+        for entity in page:
+            yield entity
+        if len(page) < page_size:
+            return
+        last_id = page[-1].id
+
+async def stream(db: AsyncSession, stmt, batch_size: int = PAGE_SIZE) -> AsyncIterator:
+    """One-shot export of any select() through a server-side cursor with yield_per."""
+    result = await db.stream(stmt.execution_options(yield_per=batch_size))
+    async for partition in result.partitions():
+        for row in partition:
+            yield row
+
+# --- User Functions ---
+
+async def update_user_language(db: AsyncSession, telegram_id: int, new_lang_code: str) -> User | None:
+    """Updates the language for a given user."""
+    user = await get_user_by_telegram_id(db, telegram_id)
+    if user:
+        user.language_code = new_lang_code
+        await db.commit()
+        await profile_cache.invalidate_async(telegram_id)
+        return user
+    return None
+
+async def get_user_by_telegram_id(db: AsyncSession, telegram_id: int) -> User | None:
+    """Returns the full User object if found, otherwise None."""
+    result = await db.execute(select(User).where(User.telegram_id == telegram_id).limit(1))
+    return result.scalars().first()
+
+async def create_user(db: AsyncSession, telegram_id: int, first_name: str, last_name: str, username: str) -> User:
+    """Creates and returns a new User object."""
+    new_user = User(
+        telegram_id=telegram_id,
+        first_name=first_name,
+        last_name=last_name,
+        username=username
+    )
+    db.add(new_user)
+    await db.commit()
+    await db.refresh(new_user)
+    return new_user
+
+async def get_or_create_user(db: AsyncSession, telegram_id: int, first_name: str, last_name: str,
+                             username: str, language_code: str = 'en') -> User:
+    """
+    Returns the user, registering them with `language_code` on first contact.
+    See botcontrol.get_or_create_user() for the per-dialect round trips.
+    """
+    dialect_name = db.get_bind().dialect.name
+    row = user_row(telegram_id, first_name, last_name, username, language_code)
+    stmt = upsert_users_statement(dialect_name, [row])
+
+    if dialect_name in UPSERT_RETURNING_DIALECTS:
+        user = (await db.scalars(stmt.returning(User), execution_options={'populate_existing': True})).one()
+        await db.commit()
+        return user
+
+    user = await get_user_by_telegram_id(db, telegram_id)
+    if user:
+        return user
+    await db.execute(stmt)
+    # Locking read: sees a row a concurrent tap committed after our first SELECT
+    user = (await db.scalars(select(User).where(User.telegram_id == telegram_id).with_for_update())).one()
+    await db.commit()
+    return user
+
+async def get_or_create_users(db: AsyncSession, rows: list[dict]) -> dict[int, User]:
+    """
+    Multi-row get_or_create_user(): one upsert for every row (see user_row()),
+    returning the users keyed by telegram_id.
+    """
+    dialect_name = db.get_bind().dialect.name
+    stmt = upsert_users_statement(dialect_name, rows)
+    if dialect_name in UPSERT_RETURNING_DIALECTS:
+        users = (await db.scalars(stmt.returning(User), execution_options={'populate_existing': True})).all()
+    else:
+        await db.execute(stmt)
+        telegram_ids = [row['telegram_id'] for row in rows]
+        users = (await db.scalars(select(User).where(User.telegram_id.in_(telegram_ids)))).all()
+    await db.commit()
+    return {user.telegram_id: user for user in users}
+
+class RegistrationBatcher:
+    """
+    Coalesces concurrent get_or_create_user() calls into one multi-row upsert.
+    Meant for referral-campaign spikes: calls arriving within `max_delay`
+    seconds of each other share a single statement and transaction.
+    """
+
+    def __init__(self, session_factory, max_delay: float = 0.02, max_batch: int = 500):
+        self.session_factory = session_factory
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._pending = {}  # telegram_id -> (row, future)
+        self._flush_handle = None
+
+    async def get_or_create_user(self, telegram_id: int, first_name: str, last_name: str,
+                                 username: str, language_code: str = 'en') -> User:
+        pending = self._pending.get(telegram_id)
+        if pending is not None:
+            # A second tap from the same user joins the first one's request
+            return await asyncio.shield(pending[1])
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[telegram_id] = (user_row(telegram_id, first_name, last_name, username, language_code), future)
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.max_delay, self._start_flush)
+        return await asyncio.shield(future)
+
+    def _start_flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            asyncio.ensure_future(self._flush(batch))
+
+    async def _flush(self, batch: dict) -> None:
+        try:
+            async with self.session_factory() as db:
+                users = await get_or_create_users(db, [row for row, _ in batch.values()])
+        except Exception as e:
+            logging.error(f"Batched registration of {len(batch)} users failed: {e}")
+            for _, future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for telegram_id, (_, future) in batch.items():
+            if not future.done():
+                future.set_result(users.get(telegram_id))
+
+async def get_all_users(db: AsyncSession) -> list[User]:
+    """Returns every user."""
+    result = await db.execute(select(User))
+    return list(result.scalars().all())
+
+async def iter_users(db: AsyncSession, page_size: int = PAGE_SIZE) -> AsyncIterator[User]:
+    """Streams every user in id order, one keyset page at a time."""
+    async for user in _iter_by_id(db, select(User), User.id, page_size):
+        yield user
+
+async def delete_user(db: AsyncSession, user_id: int) -> bool:
+    """Deletes a user by their primary key `id`."""
+    user_to_delete = await db.get(User, user_id)
+    if user_to_delete:
+        telegram_id = user_to_delete.telegram_id
+        await db.delete(user_to_delete)
+        await db.commit()
+        await profile_cache.invalidate_async(telegram_id)
+        return True
+    return False
+
+# --- Referral Functions ---
+
+async def create_referral(db: AsyncSession, referrer_id: int, new_user_id: int) -> Referral:
+    """Note: Uses telegram_ids."""
+    new_ref = Referral(
+        user_id=referrer_id,
+        referred_user_id=new_user_id,
+        bonus=0
+    )
+    db.add(new_ref)
+    await db.commit()
+    await db.refresh(new_ref)
+    return new_ref
+
+async def get_users_referred_by(db: AsyncSession, referrer_id: int) -> list[Referral]:
+    """Returns the referrals made by `referrer_id`."""
+    result = await db.execute(select(Referral).where(Referral.user_id == referrer_id))
+    return list(result.scalars().all())
+
+async def count_referrals(db: AsyncSession, referrer_id: int, only_paid: bool = False) -> int:
+    """If only_paid is True, it only counts referrals with a bonus > 0."""
+    query = select(func.count(Referral.id)).where(Referral.user_id == referrer_id)
+    if only_paid:
+        query = query.where(Referral.bonus > 0)
+    return (await db.execute(query)).scalar_one()
+
+async def get_referral_balance(db: AsyncSession, referrer_id: int) -> float:
+    """Returns the sum of the bonuses earned by `referrer_id`."""
+    total = (await db.execute(
+        select(func.sum(Referral.bonus)).where(Referral.user_id == referrer_id)
+    )).scalar()
+    return total or 0.0
+
+async def get_referral_stats(db: AsyncSession, referrer_id: int) -> ReferralStats:
+    """Returns the referral balance, total count and paid count in one round trip."""
+    balance, total, paid = (await db.execute(referral_stats_query(referrer_id))).one()
+    return ReferralStats(balance or 0.0, total, paid)  # same zero as get_referral_balance()
+
+async def credit_referral_bonus(db: AsyncSession, referrer_id: int, new_user_id: int, bonus: float) -> Referral | None:
+    """Sets one referral's bonus and moves the referrer's referral balance by the difference."""
+    referral = (await db.scalars(select(Referral).where(
+        Referral.user_id == referrer_id, Referral.referred_user_id == new_user_id
+    ).with_for_update().limit(1))).first()
+    if referral is None:
+        return None
+    delta = to_decimal(bonus) - (referral.bonus or 0)
+    referral.bonus = bonus
+    await db.execute(balance_upsert_statement(db.get_bind().dialect.name, referrer_id, {'referral_balance': delta}))
+    await db.commit()
+    await db.refresh(referral)
+    return referral
+
+# --- Deposit Functions ---
+
+async def create_deposit(db: AsyncSession, user_id: int, amount: float, doll_amount: float,
+                         coin: str, order_id: str) -> Deposit:
+    """Creates a pending deposit."""
+    new_deposit = Deposit(
+        user_id=user_id,
+        amount=amount,
+        doll_amount=doll_amount,
+        coin=coin,
+        order_id=order_id,
+        state='pending'
+    )
+    db.add(new_deposit)
+    await db.commit()
+    await db.refresh(new_deposit)
+    return new_deposit
+
+async def get_deposits_by_user(db: AsyncSession, user_id: int, state: str) -> list[Deposit]:
+    """Pass 'pending', 'paid', or 'approved' to the state parameter."""
+    result = await db.execute(select(Deposit).where(Deposit.user_id == user_id, Deposit.state == state))
+    return list(result.scalars().all())
+
+async def get_all_deposits_by_state(db: AsyncSession, state: str) -> list:
+    """Returns (Deposit, User) rows for every deposit in `state`."""
+    result = await db.execute(
+        select(Deposit, User).join(User, Deposit.user_id == User.telegram_id).where(Deposit.state == state)
+    )
+    return list(result.all())
+
+async def iter_deposits_by_state(db: AsyncSession, state: str, page_size: int = PAGE_SIZE) -> AsyncIterator:
+    """Streaming get_all_deposits_by_state(): yields (Deposit, User) rows in time order."""
+    after = None
+    while True:
+        page = (await db.execute(deposits_by_state_page(state, after, page_size))).all()
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        after = (page[-1].Deposit.time, page[-1].Deposit.id)
+
+async def mark_deposit_paid(db: AsyncSession, order_id: str) -> Deposit | None:
+    """Marks the deposit with this order_id paid if it is still pending, see botcontrol.mark_deposit_paid()."""
+    result = await db.execute(select(Deposit).where(Deposit.order_id == order_id).limit(1).with_for_update())
+    deposit_to_update = result.scalars().first()
+    if deposit_to_update:
+        if deposit_to_update.state == 'pending':
+            deposit_to_update.state = 'paid'
+        await db.commit()
+        await db.refresh(deposit_to_update)
+        return deposit_to_update
+    return None
+
+async def mark_deposits_paid(db: AsyncSession, order_ids: list[str]) -> int:
+    """
+    Marks every pending deposit in `order_ids` paid with one UPDATE in one transaction.
+    Returns the number of deposits marked paid.
+    """
+    if not order_ids:
+        return 0
+    result = await db.execute(mark_deposits_paid_statement(list(order_ids)))
+    await db.commit()
+    return result.rowcount
+
+async def get_due_deposits(db: AsyncSession, now: datetime, after_id: int, page_size: int) -> list:
+    """One page of pending deposits due for a payment check, see botcontrol.due_deposits_page()."""
+    return list((await db.execute(due_deposits_page(now, after_id, page_size))).all())
+
+async def claim_paid_deposits(db: AsyncSession, order_ids: list[str]) -> int:
+    """Marks the pending deposits in `order_ids` paid and queues their notifications, see botcontrol.claim_paid_deposits()."""
+    if not order_ids:
+        return 0
+    deposit_ids = list(await db.scalars(paid_deposits_claim_query(list(order_ids))))
+    if deposit_ids:
+        await db.execute(mark_deposit_ids_paid_statement(deposit_ids))
+        await db.execute(queue_payment_notifications_statement(deposit_ids))
+    await db.commit()
+    return len(deposit_ids)
+
+async def get_payment_notifications(db: AsyncSession, after_id: int, page_size: int = PAGE_SIZE) -> list:
+    """One page of the payment watcher's outbox, see botcontrol.payment_notifications_page()."""
+    return list((await db.execute(payment_notifications_page(after_id, page_size))).all())
+
+async def delete_payment_notifications(db: AsyncSession, deposit_ids: list[int]) -> None:
+    """Removes sent notifications from the outbox."""
+    if deposit_ids:
+        await db.execute(delete(PaymentNotification).where(PaymentNotification.deposit_id.in_(deposit_ids)))
+        await db.commit()
+
+async def postpone_deposit_checks(db: AsyncSession, schedule: list[tuple[list[int], int, datetime]]) -> None:
+    """Backs off deposits still unpaid, see botcontrol.postpone_deposit_checks()."""
+    for deposit_ids, attempts, next_check_at in schedule:
+        await db.execute(postpone_deposit_checks_statement(deposit_ids, attempts, next_check_at))
+    await db.commit()
+
+async def approve_deposit(db: AsyncSession, deposit_id: int, amount: float, doll_amount: float,
+                          subscription_days: int = 0) -> Deposit | None:
+    """
+    Approves a deposit with its final amounts and, in the same transaction,
+    credits the balance and, on first approval, extends the subscription
+    (see botcontrol.approve_deposit()).
+    """
+    deposit_to_approve = await db.get(Deposit, deposit_id, with_for_update=True)
+    if deposit_to_approve:
+        newly_approved = deposit_to_approve.state != 'approved'
+        already_credited = 0 if newly_approved else deposit_to_approve.amount
+        deposit_to_approve.state = 'approved'
+        deposit_to_approve.amount = amount
+        deposit_to_approve.doll_amount = doll_amount
+        deltas = coin_deltas(deposit_to_approve.coin, to_decimal(amount) - already_credited)
+        await db.execute(balance_upsert_statement(db.get_bind().dialect.name, deposit_to_approve.user_id, deltas))
+        if newly_approved and subscription_days:
+            deposit_to_approve.subscription_days = subscription_days
+            balance = await db.get(Balance, deposit_to_approve.user_id, with_for_update=True, populate_existing=True)
+            balance.subscription_expires = extend_subscription(balance.subscription_expires, subscription_days)
+        await db.commit()
+        await db.refresh(deposit_to_approve)
+        return deposit_to_approve
+    return None
+
+async def delete_deposit(db: AsyncSession, deposit_id: int) -> bool:
+    """Deletes a deposit by its primary key `id`, taking back what its approval credited."""
+    deposit_to_delete = await db.get(Deposit, deposit_id, with_for_update=True)
+    if deposit_to_delete:
+        if deposit_to_delete.state == 'approved':
+            deltas = coin_deltas(deposit_to_delete.coin, -deposit_to_delete.amount)
+            await db.execute(balance_upsert_statement(db.get_bind().dialect.name, deposit_to_delete.user_id, deltas))
+            if deposit_to_delete.subscription_days:
+                balance = await db.get(Balance, deposit_to_delete.user_id, with_for_update=True, populate_existing=True)
+                balance.subscription_expires = shorten_subscription(balance.subscription_expires,
+                                                                    deposit_to_delete.subscription_days)
+        await db.delete(deposit_to_delete)
+        await db.commit()
+        return True
+    return False
+
+# --- Balance Ledger ---
+
+async def get_balance(db: AsyncSession, telegram_id: int) -> Balance | None:
+    """The user's ledger row, read by primary key. None if nothing was ever credited."""
+    return await db.get(Balance, telegram_id)
+
+# --- Referral Settlement ---
+
+async def settle_referral_batch(db: AsyncSession, batch_id: str, rate, limit: int) -> tuple[int, int]:
+    """Settles up to `limit` new approved deposits in one transaction, see botcontrol.settle_referral_batch()."""
+    dialect_name = db.get_bind().dialect.name
+    deposit_ids = list(await db.scalars(unsettled_deposits_query(limit)))
+    settled = 0
+    if deposit_ids:
+        settled = (await db.execute(settlement_insert_statement(batch_id, rate, deposit_ids))).rowcount
+        if settled:
+            await db.execute(settlement_referral_update_statement(batch_id))
+            await db.execute(settlement_balance_statement(dialect_name, batch_id))
+        await db.execute(settled_deposits_statement(deposit_ids))
+    await db.commit()
+    return len(deposit_ids), settled
+
+# --- Admin Functions ---
+# bcrypt is CPU-heavy, so hashing and verifying run in admin_auth's bounded pool.
+
+async def create_admin(db: AsyncSession, username: str, plain_password: str) -> Admin:
+    """Creates an admin with a bcrypt-hashed password."""
+    hashed_password = await admin_auth.hash_password(plain_password)
+    new_admin = Admin(username=username, password_hash=hashed_password)
+    db.add(new_admin)
+    await db.commit()
+    await db.refresh(new_admin)
+    return new_admin
+
+async def authenticate_admin(db: AsyncSession, username: str, plain_password: str) -> Admin | None:
+    """
+    Returns the admin if the username and password match, otherwise None.
+    A hash in a deprecated scheme is upgraded in the background after the login.
+    """
+    result = await db.execute(select(Admin).where(Admin.username == username).limit(1))
+    admin = result.scalars().first()
+    if admin and await admin_auth.check_password(plain_password, admin.password_hash):
+        if admin_auth.needs_rehash(admin.password_hash):
+            admin_auth.schedule_rehash(
+                lambda: _rehash_admin(db.bind, admin.id, admin.password_hash, plain_password)
+            )
+        return admin
+    return None
+
+async def _rehash_admin(bind, admin_id: int, old_hash: str, plain_password: str) -> None:
+    new_hash = await admin_auth.hash_password(plain_password)
+    # Own session: the login's session may be closed by now. Only replaces the
+    # hash that was verified, so a password changed meanwhile is kept.
+    async with AsyncSession(bind) as db:
+        await db.execute(
+            update(Admin).where(Admin.id == admin_id, Admin.password_hash == old_hash).values(password_hash=new_hash)
+        )
+        await db.commit()
+    logging.info(f"Upgraded the password hash of admin {admin_id}.")
+
+async def login_admin(db: AsyncSession, username: str, plain_password: str) -> str | None:
+    """
+    Checks the password once and returns a session token for later admin actions
+    (verify it with admin_auth.admin_sessions.verify()), or None if the login failed.
+    """
+    admin = await authenticate_admin(db, username, plain_password)
+    return admin_auth.admin_sessions.issue(admin.id) if admin else None
+
+async def get_all_admins(db: AsyncSession) -> list[Admin]:
+    """Returns every admin."""
+    result = await db.execute(select(Admin))
+    return list(result.scalars().all())
+
+async def iter_admins(db: AsyncSession, page_size: int = PAGE_SIZE) -> AsyncIterator[Admin]:
+    """Streams every admin in id order, one keyset page at a time."""
+    async for admin in _iter_by_id(db, select(Admin), Admin.id, page_size):
+        yield admin
+
+# --- Product Functions ---
+
+async def get_all_products(db: AsyncSession) -> list[Product]:
+    """Returns every product."""
+    result = await db.execute(select(Product))
+    return list(result.scalars().all())
+
+async def iter_products(db: AsyncSession, page_size: int = PAGE_SIZE) -> AsyncIterator[Product]:
+    """Streams every product in id order, one keyset page at a time."""
+    async for product in _iter_by_id(db, select(Product), Product.id, page_size):
+        yield product
+
+async def create_product(db: AsyncSession, name: str, text: str, image: str, url: str) -> Product:
+    """Creates and returns a new Product."""
+    new_product = Product(name=name, text=text, image=image, url=url)
+    db.add(new_product)
+    await db.commit()
+    await db.refresh(new_product)
+    product_catalog.invalidate()
+    return new_product
+
+async def set_product_file_id(db: AsyncSession, product_id: int, file_id: str) -> None:
+    """Stores the Telegram file_id of a product's uploaded image."""
+    await db.execute(update(Product).where(Product.id == product_id).values(file_id=file_id))
+    await db.commit()
+
+# --- Broadcast Functions ---
+
+async def get_broadcast_languages(db: AsyncSession) -> list[str]:
+    """Returns every language code that at least one user has."""
+    result = await db.execute(select(User.language_code).distinct().order_by(User.language_code))
+    return list(result.scalars().all())
+
+async def get_broadcast_recipients(db: AsyncSession, language_code: str, after_id: int,
+                                   page_size: int) -> list[tuple[int, int]]:
+    """One keyset page of (users.id, telegram_id) for a language, in id order."""
+    result = await db.execute(
+        select(User.id, User.telegram_id)
+        .where(User.language_code == language_code, User.id > after_id)
+        .order_by(User.id)
+        .limit(page_size)
+    )
+    return [tuple(row) for row in result.all()]
+
+async def get_broadcast_progress(db: AsyncSession, broadcast_id: str) -> dict[str, BroadcastProgress]:
+    """Returns the checkpoints of a broadcast keyed by language code."""
+    result = await db.execute(select(BroadcastProgress).where(BroadcastProgress.broadcast_id == broadcast_id))
+    return {progress.language_code: progress for progress in result.scalars().all()}
+
+async def save_broadcast_progress(db: AsyncSession, broadcast_id: str, language_code: str, last_user_id: int,
+                                  sent: int, failed: int, done: bool = False) -> BroadcastProgress:
+    """Creates or moves forward the checkpoint of one language of a broadcast."""
+    progress = await db.get(BroadcastProgress, (broadcast_id, language_code))
+    if progress is None:
+        progress = BroadcastProgress(broadcast_id=broadcast_id, language_code=language_code)
+        db.add(progress)
+    progress.last_user_id = last_user_id
+    progress.sent = sent
+    progress.failed = failed
+    progress.done = done
+    await db.commit()
+    return progress
+
+
+# --- Bot State Functions ---
+
+async def get_bot_state(db: AsyncSession, kind: str, key: int) -> str | None:
+    """Returns the stored JSON data of one user or chat, or None."""
+    result = await db.execute(select(BotState.data).where(BotState.kind == kind, BotState.key == key))
+    return result.scalar_one_or_none()
+
+async def save_bot_states(db: AsyncSession, kind: str, rows: dict[int, str]) -> None:
+    """Writes {key: JSON data} for many users or chats in one statement."""
+    if rows:
+        await db.execute(bot_state_upsert_statement(db.get_bind().dialect.name, kind, rows))
+        await db.commit()
+
+async def delete_bot_states(db: AsyncSession, kind: str, keys: list[int]) -> None:
+    if keys:
+        await db.execute(delete(BotState).where(BotState.kind == kind, BotState.key.in_(keys)))
+        await db.commit()
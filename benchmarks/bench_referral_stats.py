@@ -0,0 +1,128 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+import botcontrol
+from db_models import Referral
+
+# --- Referral Stats Benchmark ---
+# Compares the old three-query path (get_referral_balance + two
+# count_referrals calls) against get_referral_stats(), with and without the
+# (user_id, bonus) index, on a referral table with --rows rows.
+#
+#   python benchmarks/bench_referral_stats.py
+#   python benchmarks/bench_referral_stats.py --rows 1000000 --url mysql+mysqlconnector://user:pw@host/bench_db
+#
+# The default database is a throwaway SQLite file. Point --url at an empty
+# scratch database: its referral table is dropped and refilled.
+
+
+def bench_table() -> Table:
+    """
+    A copy of the referral table without its foreign keys. On MySQL the
+    (user_id, bonus) index backs the user_id foreign key and can't be
+    dropped (error 1553), so the "no index" case needs a table without it.
+    The queries run unchanged: they only name the table and its columns.
+    """
+    source = Referral.__table__
+    return Table(source.name, MetaData(),
+                 *(Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+                   for column in source.columns),
+                 *(Index(index.name, *(column.name for column in index.columns)) for index in source.indexes))
+
+
+def fill(engine, table: Table, rows: int, referrers: int) -> None:
+    """Recreates `table` and fills it with `rows` random referrals."""
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    rng = random.Random(42)
+    chunk = 50_000
+    with engine.begin() as conn:
+        for start in range(0, rows, chunk):
+            conn.execute(insert(table), [
+                {
+                    'user_id': rng.randrange(referrers),
+                    'referred_user_id': start + i,
+                    # About a third of the referrals have been paid a bonus
+                    'bonus': rng.choice((0, 0, 0.0005)),
+                }
+                for i in range(min(chunk, rows - start))
+            ])
+
+
+def old_path(db, referrer_id):
+    return (
+        botcontrol.get_referral_balance(db, referrer_id=referrer_id),
+        botcontrol.count_referrals(db, referrer_id=referrer_id, only_paid=False),
+        botcontrol.count_referrals(db, referrer_id=referrer_id, only_paid=True),
+    )
+
+
+def new_path(db, referrer_id):
+    return botcontrol.get_referral_stats(db, referrer_id=referrer_id)
+
+
+def measure(session_factory, fn, referrers: int, repeat: int) -> list[float]:
+    rng = random.Random(7)
+    timings = []
+    db = session_factory()
+    try:
+        for _ in range(repeat):
+            referrer_id = rng.randrange(referrers)
+            started = time.perf_counter()
+            fn(db, referrer_id)
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        db.close()
+    return timings
+
+
+def report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<42} mean {statistics.mean(timings):8.3f} ms   "
+          f"p50 {statistics.median(timings):8.3f} ms   p95 {p95:8.3f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the referrals screen queries, with and without "
+                                                 "the (user_id, bonus) index.")
+    parser.add_argument('--rows', type=int, default=1_000_000, help="referral rows to insert")
+    parser.add_argument('--referrers', type=int, default=10_000, help="distinct referrers")
+    parser.add_argument('--repeat', type=int, default=200, help="lookups per measurement")
+    parser.add_argument('--url', default=None, help="database URL (default: temporary SQLite file)")
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_referral.db')}"
+    engine = create_engine(url)
+    session_factory = sessionmaker(bind=engine)
+
+    table = bench_table()
+    print(f"Filling {args.rows:,} referral rows for {args.referrers:,} referrers ...")
+    started = time.perf_counter()
+    fill(engine, table, args.rows, args.referrers)
+    print(f"  done in {time.perf_counter() - started:.1f} s\n")
+
+    index = next(ix for ix in table.indexes if ix.name == 'ix_referral_user_bonus')
+    index.drop(engine)
+    report("3 queries, no index", measure(session_factory, old_path, args.referrers, args.repeat))
+    report("get_referral_stats, no index", measure(session_factory, new_path, args.referrers, args.repeat))
+
+    index.create(engine)
+    report("3 queries, (user_id, bonus) index", measure(session_factory, old_path, args.referrers, args.repeat))
+    report("get_referral_stats, (user_id, bonus) index", measure(session_factory, new_path, args.referrers, args.repeat))
+
+    table.drop(engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import ClientSession, web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# --- Fake Telegram ---
+# Both sides of Telegram for a webhook test on one machine: a fake Bot API
+# that answers the calls the workers make (run them with TELEGRAM_API_BASE_URL
+# pointing here), and a sender that POSTs synthetic updates to the receiver.
+#
+#   TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 WEBHOOK_PORT=8443 python webhook.py
+#   python benchmarks/fake_telegram.py --webhook http://127.0.0.1:8443/telegram --users 200
+
+
+class FakeBotAPI:
+    """Answers Bot API calls locally and records them as (method, params)."""
+
+    def __init__(self):
+        self.calls = []
+        self.call_times = []             # time.monotonic() of each call
+        self.received = asyncio.Event()  # set on every recorded call
+        self.blocked = set()             # chat ids whose sendMessage fails with 403
+        self._delivered = defaultdict(list)  # chat_id -> texts of the successful sendMessage calls
+        self._failures = defaultdict(list)  # method -> error responses for its next calls
+        self._runner = None
+        self.url = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self._handle)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Serves the fake API, returns its base URL (for TELEGRAM_API_BASE_URL)."""
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def fail(self, method: str, error_code: int, description: str, **parameters) -> None:
+        """Fails the next call of `method` as Telegram would, e.g. fail('sendMessage', 429, '...', retry_after=1)."""
+        error = {'ok': False, 'error_code': error_code, 'description': description}
+        if parameters:
+            error['parameters'] = parameters
+        self._failures[method].append(error)
+
+    def sent(self) -> dict[int, list[str]]:
+        """chat_id -> the texts delivered there, in call order."""
+        return dict(self._delivered)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls.append((method, params))
+        self.call_times.append(time.monotonic())
+        self.received.set()
+        if self._failures[method]:
+            error = self._failures[method].pop(0)
+            return web.json_response(error, status=error['error_code'])
+        if method == 'sendMessage' and int(params['chat_id']) in self.blocked:
+            return web.json_response({'ok': False, 'error_code': 403,
+                                      'description': "Forbidden: bot was blocked by the user"}, status=403)
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+    def _result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method == 'sendMessage':
+            self._delivered[int(params['chat_id'])].append(params['text'])
+            return {'message_id': len(self.calls), 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': int(params['chat_id']), 'type': 'private'}}
+        return True  # setWebhook, answerCallbackQuery, editMessageText of an inline message...
+
+
+# --- Synthetic Updates ---
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'language_code': 'en'}
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': text, 'from': user,
+                        'chat': {'id': user_id, 'type': 'private'}}}
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'language_code': 'en'}
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': data,
+                               'message': {'message_id': 1, 'date': int(time.time()), 'from': user,
+                                           'chat': {'id': user_id, 'type': 'private'}, 'text': 'menu'}}}
+
+
+async def post_updates(url: str, updates_by_user: dict[int, list[dict]], secret: str = '') -> Counter:
+    """
+    POSTs every user's updates to the webhook `url`, each user's one after
+    another (as Telegram does), different users at once. Returns the count
+    of each response status.
+    """
+    statuses = Counter()
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+
+    async def send(session: ClientSession, updates: list[dict]) -> None:
+        for update in updates:
+            async with session.post(url, data=json.dumps(update), headers=headers) as response:
+                statuses[response.status] += 1
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(send(session, updates) for updates in updates_by_user.values()))
+    return statuses
+
+
+async def wait_for_calls(api: FakeBotAPI, count: int, timeout: float) -> bool:
+    """Waits until `api` recorded `count` calls. False on timeout."""
+    deadline = time.monotonic() + timeout
+    while len(api.calls) < count:
+        api.received.clear()
+        try:
+            await asyncio.wait_for(api.received.wait(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            return False
+    return True
+
+
+def synthetic_chats(users: int, actions: int) -> dict[int, list[dict]]:
+    """/start and `actions` main menu presses for each of `users` users."""
+    update_ids = iter(range(1, users * (actions + 1) + 1))
+    return {user_id: [message_update(next(update_ids), user_id, '/start')]
+                     + [callback_update(next(update_ids), user_id, 'mainme') for _ in range(actions)]
+            for user_id in range(1000, 1000 + users)}
+
+
+async def run(args) -> None:
+    api = FakeBotAPI()
+    await api.start(port=args.api_port)
+    print(f"Fake Bot API on {api.url}, posting to {args.webhook}...")
+    try:
+        chats = synthetic_chats(args.users, args.actions)
+        started = time.perf_counter()
+        statuses = await post_updates(args.webhook, chats, args.secret)
+        posted = time.perf_counter() - started
+        total = sum(len(updates) for updates in chats.values())
+        # Every update answers with at least one Bot API call
+        answered = await wait_for_calls(api, total, args.timeout)
+        elapsed = time.perf_counter() - started
+        print(f"{total} updates posted in {posted:.2f} s ({total / posted:.1f}/s), responses {dict(statuses)}")
+        print(f"{len(api.calls)} Bot API calls in {elapsed:.2f} s"
+              + ("" if answered else f", fewer than {total} after {args.timeout} s"))
+    finally:
+        await api.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake Telegram for a local webhook test.")
+    parser.add_argument('--webhook', default="http://127.0.0.1:8443/telegram", help="the receiver's URL")
+    parser.add_argument('--secret', default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument('--api-port', type=int, default=8081, help="port of the fake Bot API")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--actions', type=int, default=5, help="button presses per user after /start")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for the workers")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Must be set before db_models is imported: a named in-memory database for the
+# handlers' async engine. SQLite has a single writer anyway, so the pool holds
+# one connection (which also keeps the database alive).
+os.environ['DATABASE_URL'] = "sqlite:///file:loadtest?mode=memory&uri=true"
+os.environ['DB_POOL_SIZE'] = '1'
+os.environ['DB_MAX_OVERFLOW'] = '0'
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+import db_models
+import translation
+import bot
+
+# --- Load Test ---
+# --users concurrent users each send /start, /language and --actions random
+# button presses, one after another like a real chat. The handlers run
+# unchanged on real Update objects against a stub Bot API (--api-latency),
+# a stub translator (--translate-latency) and an in-memory SQLite database,
+# so nothing touches the network. Reports p50/p95/p99 latency per route and
+# per menu (time in menu_registry.get). --warm prebuilds every menu first,
+# as post_init does in production.
+#
+#   python benchmarks/loadtest.py --users 500 --actions 20 --translate-latency 0.2 --warm
+
+
+class StubTranslator:
+    """Stands in for deep_translator.GoogleTranslator: sleeps, then tags the text."""
+
+    latency = 0.0  # seconds per request
+
+    def __init__(self, source: str, target: str):
+        self.target = target
+
+    def translate(self, text: str) -> str:
+        time.sleep(self.latency)  # the real one is blocking too
+        return f"[{self.target}] {text}"
+
+
+class StubBot:
+    """Answers the Bot API calls the handlers make, without a network."""
+
+    username = 'loadtest_bot'
+    latency = 0.0  # seconds per API call
+
+    def __init__(self):
+        self.calls = 0
+
+    async def _call(self, *args, **kwargs) -> bool:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return True
+
+    async def send_message(self, chat_id, text, *args, **kwargs) -> Message:
+        await self._call()
+        return Message(self.calls, datetime.now(), Chat(chat_id, Chat.PRIVATE), text=text)
+
+    edit_message_text = _call
+    answer_callback_query = _call
+
+
+class StubContext:
+    """The parts of CallbackContext the handlers use."""
+
+    def __init__(self, telegram_bot):
+        self.bot = telegram_bot
+        self.user_data = {}
+
+
+class Recorder:
+    """Collects latencies (seconds) by label."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def add(self, label: str, seconds: float) -> None:
+        self.samples[label].append(seconds)
+
+    def report(self, title: str, elapsed: float) -> None:
+        print(f"\n{title}")
+        print(f"{'':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'per s':>10}")
+        for label, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            print(f"{label:<24}{len(samples):>8}{percentile(samples, 50):>10.2f}{percentile(samples, 95):>10.2f}"
+                  f"{percentile(samples, 99):>10.2f}{samples[-1] * 1000:>10.2f}{len(samples) / elapsed:>10.1f}")
+
+
+def percentile(sorted_samples: list[float], p: float) -> float:
+    """Nearest-rank percentile of sorted samples, in milliseconds."""
+    index = max(0, min(len(sorted_samples) - 1, round(p / 100 * len(sorted_samples)) - 1))
+    return sorted_samples[index] * 1000
+
+
+def instrument_menus(recorder: Recorder) -> None:
+    """Times every menu_registry.get() call, by menu name."""
+    original_get = bot.menu_registry.get
+
+    async def timed_get(name: str, lang: str):
+        started = time.perf_counter()
+        try:
+            return await original_get(name, lang)
+        finally:
+            recorder.add(name, time.perf_counter() - started)
+
+    bot.menu_registry.get = timed_get
+
+
+# --- Synthetic Updates ---
+
+def callback_data_choices() -> list[str]:
+    """Every button of the bot, as the callback data Telegram would send."""
+    choices = ['mainme', 'language_menu', 'balan', 'refer', 'referlink', 'withref',
+               'alert_btc', 'alert_eth', 'alert_usdt', 'products']
+    choices += list(bot.STATIC_SCREENS)
+    choices += [f"set_lang_{lang}" for lang in bot.SUPPORTED_LANGUAGES]
+    return choices
+
+
+def route_label(data: str) -> str:
+    return 'set_lang_*' if data.startswith('set_lang_') else data
+
+
+class SimulatedUser:
+    def __init__(self, telegram_id: int, telegram_bot: StubBot, language_code: str):
+        self.bot = telegram_bot
+        self.user = User(telegram_id, first_name='Load', is_bot=False, last_name='Test',
+                         username=f"user{telegram_id}", language_code=language_code)
+        self.chat = Chat(telegram_id, Chat.PRIVATE)
+        self.context = StubContext(telegram_bot)
+        self._next_id = 0
+
+    def _message(self, text: str | None = None) -> Message:
+        self._next_id += 1
+        message = Message(self._next_id, datetime.now(), self.chat, from_user=self.user, text=text)
+        message.set_bot(self.bot)
+        return message
+
+    def command(self, name: str) -> Update:
+        return Update(self._next_id, message=self._message(f"/{name}"))
+
+    def button(self, data: str) -> Update:
+        query = CallbackQuery(str(self._next_id), self.user, chat_instance=str(self.chat.id),
+                              message=self._message(), data=data)
+        query.set_bot(self.bot)
+        return Update(self._next_id, callback_query=query)
+
+
+async def run_user(user: SimulatedUser, actions: int, rng: random.Random, routes: Recorder) -> None:
+    choices = callback_data_choices()
+    steps = [('/start', bot.start, user.command('start')),
+             ('/language', bot.language_command, user.command('language'))]
+    for label, handler, update in steps:
+        started = time.perf_counter()
+        await handler(update, user.context)
+        routes.add(label, time.perf_counter() - started)
+    for _ in range(actions):
+        data = rng.choice(choices)
+        started = time.perf_counter()
+        await bot.button_handler(user.button(data), user.context)
+        routes.add(route_label(data), time.perf_counter() - started)
+
+
+def use_translation_store() -> None:
+    """
+    Gives the translation cache's database tier an in-memory database of its
+    own: two SQLite connections writing to one in-memory database would fail
+    with 'database table is locked' instead of waiting for each other.
+    """
+    store = create_engine("sqlite:///file:loadtest_translations?mode=memory&uri=true", poolclass=QueuePool,
+                          pool_size=1, max_overflow=0, connect_args={'check_same_thread': False})
+    db_models.Translation.__table__.create(store)
+    translation.translation_cache.session_factory = sessionmaker(bind=store)
+
+
+async def run(args) -> None:
+    async with db_models.get_async_engine().begin() as conn:
+        await conn.run_sync(db_models.Base.metadata.create_all)
+    use_translation_store()
+
+    if args.warm:
+        started = time.perf_counter()
+        await bot.menu_registry.prebuild(bot.SUPPORTED_LANGUAGES)
+        print(f"Prebuilt every menu in {time.perf_counter() - started:.2f} s")
+
+    routes, menus = Recorder(), Recorder()
+    instrument_menus(menus)
+    telegram_bot = StubBot()
+    rng = random.Random(args.seed)
+    users = [SimulatedUser(1_000_000 + i, telegram_bot, rng.choice(bot.SUPPORTED_LANGUAGES))
+             for i in range(args.users)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(user, args.actions, random.Random(rng.random()), routes) for user in users))
+    elapsed = time.perf_counter() - started
+
+    updates = sum(len(samples) for samples in routes.samples.values())
+    print(f"\n{args.users} users, {updates} updates in {elapsed:.2f} s: "
+          f"{updates / elapsed:.1f} updates/s, {telegram_bot.calls} Bot API calls")
+    routes.report("Per handler / callback route", elapsed)
+    menus.report("Per menu (menu_registry.get)", elapsed)
+    print(f"\nTranslation cache: {translation.translation_cache.stats()}")
+    for name, stats in db_models.pool_stats().items():
+        print(f"Connection pool ({name}): {stats['checkouts']} checkouts, "
+              f"avg wait {stats['wait_seconds_avg'] * 1000:.2f} ms, max wait {stats['wait_seconds_max'] * 1000:.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline load test of the bot's handlers.")
+    parser.add_argument('--users', type=int, default=200, help="simulated concurrent users")
+    parser.add_argument('--actions', type=int, default=10, help="button presses per user after /start and /language")
+    parser.add_argument('--translate-latency', type=float, default=0.05, help="seconds per stub translator request")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds per stub Bot API call")
+    parser.add_argument('--warm', action='store_true', help="prebuild every menu before the run")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)  # the bot logs every translation miss
+    StubTranslator.latency = args.translate_latency
+    StubBot.latency = args.api_latency
+    translation.GoogleTranslator = StubTranslator
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
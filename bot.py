@@ -1,16 +1,43 @@
 import logging
 # --- Import your database models and session ---
-from db_models import SessionLocal 
-import botcontrol  # Import the entire crud.py file
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
-from deep_translator import GoogleTranslator
+from db_models import AsyncSessionLocal
+import async_botcontrol  # Async CRUD functions, so DB round trips don't block the event loop
+import translation
+from menus import MenuButton, menu_registry, render_cache
+from product_catalog import product_catalog
+from router import CallbackRouter, CallbackDebouncer
+import profile_cache
+import metrics
+from persistence import SQLPersistence
+import settlement
+import payment_watcher
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Message
+from telegram.error import BadRequest
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
 
 
 # Your Telegram Bot Token from BotFather
 BOT_TOKEN = "7523138028:telegram_bot_token"
 
+# Optional Redis server shared by all workers for the user profile cache,
+# e.g. "redis://localhost:6379/0". None keeps an in-process LRU per worker.
+REDIS_URL = None
+
+# Keep context.user_data across restarts in the 'bot_state' table, see
+# persistence.py for the settings. Off while no handler keeps anything there
+# worth a SELECT per cold user (the language is read through the profile cache).
+PERSIST_USER_DATA = False
+
+# Run the scheduled jobs (referral settlement, payment watcher) in this
+# process. The webhook mode turns it off in every worker but the first.
+RUN_JOBS = True
+
+# The payment processor's client, a payment_watcher.PaymentProvider, to tell
+# users when their pending deposit is paid (see payment_watcher.py for the
+# settings). None: deposits are only marked paid by the processor's callbacks.
+PAYMENT_PROVIDER = None
+
 # --- Basic Setup ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -39,54 +66,50 @@ SUPPORTED_LANGUAGES = list(LANGUAGES_CONFIG.keys())
 
 
 def t(text: str, lang: str) -> str:
-    """Translates text to the user's target language."""
-    if lang == 'en' or not text:
-        return text
-    try:
-         # This creates a new, properly configured translator for each call.
-        # It's more reliable.
-        return GoogleTranslator(source='auto', target=lang).translate(text)
-    except Exception as e:
-        logging.error(f"Translation failed for text '{text}' to lang '{lang}': {e}")
-        return text # Return original text on failure
+    """Translates text to the user's target language (cached, see translation.py)."""
+    return translation.translate(text, lang)
     
 # --- Helper Function to Get/Create User ---
-def get_user_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
-    """Gets user's language from context or DB, creates user if non-existent."""
+# Turn on during referral campaigns: first-contact registrations arriving
+# together are then written with one multi-row upsert.
+BATCH_REGISTRATIONS = False
+registration_batcher = async_botcontrol.RegistrationBatcher(AsyncSessionLocal) if BATCH_REGISTRATIONS else None
+
+async def get_user_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Gets user's language from the profile cache or DB, creates user if non-existent."""
     user_info = update.effective_user
     user_id = user_info.id
-    
-    # First, check if language is already cached in the context for this update
-    if 'language_code' in context.user_data:
-        return context.user_data['language_code']
-
-    db = SessionLocal()
-    user = botcontrol.get_user_by_telegram_id(db, telegram_id=user_id)
-    if not user:
-        # --- THIS IS THE NEW LOGIC FOR NEW USERS ---
-        detected_lang_code = user_info.language_code
-        
-        # Check if the user's Telegram language is in our supported list
-        default_user_lang = detected_lang_code if detected_lang_code in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
-        logging.info(f"Creating new user {user_id} with language '{default_user_lang}'.")
-        
-        # Use the CRUD function to create the user
-        user = botcontrol.create_user(
-            db=db,
-            telegram_id=user_id,
-            first_name=user_info.first_name,
-            last_name=user_info.last_name,
-            username=user_info.username
+
+    # The shared profile cache, which survives restarts when backed by Redis.
+    # No copy in context.user_data: update_user_language() and delete_user()
+    # in any worker invalidate this cache, they couldn't reach such a copy.
+    profile = await profile_cache.profile_cache.get_async(user_id)
+    if profile is not None:
+        return profile['language_code']
+
+    # --- THIS IS THE NEW LOGIC FOR NEW USERS ---
+    # Check if the user's Telegram language is in our supported list
+    detected_lang_code = user_info.language_code
+    default_user_lang = detected_lang_code if detected_lang_code in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
+
+    # One upsert registers new users with their detected language and returns
+    # existing users untouched, so their chosen language is kept.
+    if registration_batcher is not None:
+        user = await registration_batcher.get_or_create_user(
+            user_id, user_info.first_name, user_info.last_name, user_info.username, default_user_lang
         )
-        # Now update their language
-        botcontrol.update_user_language(db, telegram_id=user_id, new_lang_code=default_user_lang)
-        lang_code = default_user_lang
     else:
-        lang_code = user.language_code
-    
-    db.close()
-    # Cache the language code in context for this session
-    context.user_data['language_code'] = lang_code
+        async with AsyncSessionLocal() as db:
+            user = await async_botcontrol.get_or_create_user(
+                db=db,
+                telegram_id=user_id,
+                first_name=user_info.first_name,
+                last_name=user_info.last_name,
+                username=user_info.username,
+                language_code=default_user_lang
+            )
+    lang_code = user.language_code
+    await profile_cache.profile_cache.set_async(user_id, {'language_code': lang_code})
     return lang_code
 
 # --- 1. CENTRALIZED ENGLISH TEXT STRINGS (Content) ---
@@ -166,6 +189,10 @@ TEXT_PROCEED_PAYMENT = (
     "Once we receive payment you will be notified."
 )
 BUTTON_PROCEED_PAYMENT = "Proceed to Payment"
+TEXT_PAYMENT_RECEIVED = (
+    "✅ We received your payment of {amount} {coin}.\n"
+    "It will show in your balance once it is approved."
+)
 
 # -- Balance Menu --
 TEXT_BALANCE_MENU = (
@@ -205,211 +232,438 @@ ALERT_NO_USDT = "Not Enough USDT(TRC20) on balance to Withdraw"
 # -- Support --
 BUTTON_SUPPORT = "Support"
 
+# -- Products --
+BUTTON_PRODUCTS = "Products"
+BUTTON_VIEW_PRODUCT = "View Product"
+ALERT_NO_PRODUCTS = "No products available yet."
+
+# --- MENU LAYOUTS ---
+# Every static menu is declared once here with English labels. The registry
+# builds each one once per language and hands out the cached result.
+
+def _language_rows() -> list[list[MenuButton]]:
+    """Language buttons in two columns, names shown as-is."""
+    buttons = [
+        MenuButton(f"{details['emoji']} {details['name']}", callback_data=f"set_lang_{code}", translate=False)
+        for code, details in LANGUAGES_CONFIG.items()
+    ]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    # Add the "Back" button at the very bottom
+    rows.append([MenuButton("⬅️ Back", callback_data='mainme')])
+    return rows
+
+menu_registry.register('main', TEXT_MAIN_MENU, [
+    [MenuButton(BUTTON_ALL_SIGNALS, callback_data='signa')],
+    [MenuButton(BUTTON_SUBSCRIPTION, callback_data='subscr')],
+    [MenuButton(BUTTON_BALANCE, callback_data='balan')], # Assuming 'My Balance' is a brand name
+    [MenuButton(BUTTON_REFERRAL, callback_data='refer')],
+    [MenuButton(BUTTON_PRODUCTS, callback_data='products')],
+    [MenuButton("🌐 Language", callback_data='language_menu')],
+    [MenuButton(BUTTON_SUPPORT, url='https://t.me/DecryptDAO')]
+])
+menu_registry.register('language', "Please select your language:", _language_rows())
+menu_registry.register('language_updated', "Language updated!")
+
+menu_registry.register('signals', TEXT_SIGNALS_MENU, [
+    [MenuButton(BUTTON_ALL_SIGNALS, callback_data='allsig')],
+    [MenuButton(BUTTON_ACCURACY_85, callback_data='accu85')],
+    [MenuButton(BUTTON_ACCURACY_90, callback_data='accu90')],
+    [MenuButton(BUTTON_MAIN_MENU, callback_data='mainme')]
+])
+menu_registry.register('subscription_updated', TEXT_SUBSCRIPTION_UPDATED, [
+    [MenuButton(BUTTON_MAIN_MENU, callback_data='mainme')]
+])
+
+menu_registry.register('subscription', TEXT_SUBSCRIPTION_MENU, [
+    [MenuButton(BUTTON_PLAN_1_MONTH, callback_data='1mont')],
+    [MenuButton(BUTTON_PLAN_3_MONTHS, callback_data='2mont')],
+    [MenuButton(BUTTON_PLAN_12_MONTHS, callback_data='3mont')],
+    [MenuButton(BUTTON_MAIN_MENU, callback_data='mainme')]
+])
+menu_registry.register('choose_currency', TEXT_CHOOSE_CURRENCY, [
+    [MenuButton(BUTTON_PAY_BTC, callback_data='proced')],
+    [MenuButton(BUTTON_PAY_ETH, callback_data='proced')],
+    [MenuButton(BUTTON_PAY_USDT, callback_data='proced')],
+    [MenuButton(BUTTON_BACK, callback_data='subscr')]
+])
+menu_registry.register('proceed_payment', TEXT_PROCEED_PAYMENT, [
+    [MenuButton(BUTTON_PROCEED_PAYMENT, callback_data='payment_final_step')],
+    [MenuButton(BUTTON_MAIN_MENU, callback_data='mainme')]
+])
+menu_registry.register('payment_received', TEXT_PAYMENT_RECEIVED, [
+    [MenuButton(BUTTON_MAIN_MENU, callback_data='mainme')]
+], template=True)
+
+# Screens filled with live values: the template is translated once per
+# language and the values are formatted in after translation.
+menu_registry.register('balance', TEXT_BALANCE_MENU, [
+    [MenuButton(BUTTON_SUBSCRIPTION, callback_data='subscr')],
+    [MenuButton(BUTTON_MAIN_MENU, callback_data='mainme')]
+], template=True)
+menu_registry.register('referrals', TEXT_REFERRALS_MENU, [
+    [MenuButton(BUTTON_REFERRAL_LINK, callback_data='referlink')],
+    [MenuButton(BUTTON_WITHDRAW, callback_data='withref')],
+    [MenuButton(BUTTON_MAIN_MENU, callback_data='mainme')]
+], template=True)
+menu_registry.register('referral_link', TEXT_REFERRAL_LINK_INTRO, [
+    [MenuButton(BUTTON_BACK, callback_data='refer')]
+])
+menu_registry.register('withdraw', TEXT_WITHDRAW_MENU, [
+    [MenuButton(BUTTON_BITCOIN, callback_data='alert_btc')],
+    [MenuButton(BUTTON_ETHEREUM, callback_data='alert_eth')],
+    [MenuButton(BUTTON_USDT_TRC20, callback_data='alert_usdt')],
+    [MenuButton(BUTTON_BACK, callback_data='refer')]
+], template=True)
+
+# Alerts are text-only "menus"
+menu_registry.register('alert_btc', ALERT_NO_BTC)
+menu_registry.register('alert_eth', ALERT_NO_ETH)
+menu_registry.register('alert_usdt', ALERT_NO_USDT)
+menu_registry.register('alert_no_products', ALERT_NO_PRODUCTS)
+# So are the labels of screens built per item, to get them into the catalogs
+menu_registry.register('view_product', BUTTON_VIEW_PRODUCT)
+
+# --- Message Rendering ---
+# Every screen goes through these two, so the bot knows what each message
+# shows and can skip edits that would leave it unchanged.
+
+def _message_key(message_or_query):
+    inline_message_id = getattr(message_or_query, 'inline_message_id', None)
+    if inline_message_id:
+        return inline_message_id
+    message = getattr(message_or_query, 'message', None) or message_or_query
+    return message.chat_id, message.message_id
+
+async def edit_message(query, text: str, reply_markup: InlineKeyboardMarkup | None) -> None:
+    """Edits the callback's message, unless it already shows exactly this text and keyboard."""
+    key = _message_key(query)
+    if render_cache.is_current(key, text, reply_markup):
+        metrics.edits_skipped.inc()
+        return
+    try:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # The cache can miss (restart, another device); Telegram's refusal means the same thing
+        if 'not modified' not in str(e):
+            raise
+        metrics.edits_skipped.inc()
+    render_cache.remember(key, text, reply_markup)
+
+async def send_message(update: Update, text: str, reply_markup: InlineKeyboardMarkup | None) -> None:
+    """Replies with a new message and remembers what it shows."""
+    message = await update.message.reply_text(text, reply_markup=reply_markup)
+    if message:
+        render_cache.remember(_message_key(message), text, reply_markup)
+
 #lang fxn
 async def language_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /language command."""
-    await language_menu(update, context)
+    async with metrics.track('/language'):
+        await language_menu(update, context)
         
 async def language_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Shows the language selection menu, dynamically built in two columns."""
-    lang = get_user_language(update, context)
-    text = t("Please select your language:", lang)
-    
-    keyboard = []
-    row = []
-    # Iterate through the language config to build buttons
-    for code, details in LANGUAGES_CONFIG.items():
-        button = InlineKeyboardButton(
-            f"{details['emoji']} {details['name']}",
-            callback_data=f"set_lang_{code}"
-        )
-        row.append(button)
-        
-        # When two buttons are in a row, add it to the keyboard and start a new row
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    
-    # If there's an odd number of languages, add the last button
-    if row:
-        keyboard.append(row)
-        
-    # Add the "Back" button at the very bottom
-    keyboard.append([InlineKeyboardButton(t("⬅️ Back", lang), callback_data='mainme')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    """Shows the language selection menu, built in two columns."""
+    lang = await get_user_language(update, context)
+    menu = await menu_registry.get('language', lang)
 
     # This logic remains the same
     query = update.callback_query
     if query:
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await edit_message(query, menu.text, menu.reply_markup)
     else:
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await send_message(update, menu.text, menu.reply_markup)
 
 
 # --- 2. BOT LOGIC (Handlers) ---
 
-def get_main_menu(lang: str) -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton(t(BUTTON_ALL_SIGNALS,lang), callback_data='signa')],
-        [InlineKeyboardButton(t(BUTTON_SUBSCRIPTION,lang), callback_data='subscr')],
-        [InlineKeyboardButton(t(BUTTON_BALANCE,lang), callback_data='balan')], # Assuming 'My Balance' is a brand name
-        [InlineKeyboardButton(t(BUTTON_REFERRAL,lang), callback_data='refer')],
-        [InlineKeyboardButton("🌐 " + t("Language", lang), callback_data='language_menu')],
-        [InlineKeyboardButton(t(BUTTON_SUPPORT,lang), url='https://t.me/DecryptDAO')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+async def get_main_menu(lang: str) -> InlineKeyboardMarkup:
+    """Returns the cached main menu keyboard for `lang`."""
+    return (await menu_registry.get('main', lang)).reply_markup
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Shows the main menu, editing the previous message."""
-    lang = get_user_language(update, context)
-    text = t(TEXT_MAIN_MENU, lang)
-    reply_markup = get_main_menu(lang)
+    lang = await get_user_language(update, context)
+    menu = await menu_registry.get('main', lang)
     query = update.callback_query
     if query:
         # If called from a button, edit the message
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await edit_message(query, menu.text, menu.reply_markup)
     else:
         # If called from a command like /start, send a new message
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await send_message(update, menu.text, menu.reply_markup)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /start command by showing the main menu."""
+    async with metrics.track('/start'):
+        await show_main_menu(update, context)
+
+async def show_menu(query, name: str, lang: str) -> None:
+    """Edits the callback's message into a prebuilt static menu."""
+    menu = await menu_registry.get(name, lang)
+    await edit_message(query, menu.text, menu.reply_markup)
+
+# --- Callback Routes ---
+# Every inline button's callback data maps to one route. Only routes declared
+# with needs_db=True get a database session.
+router = CallbackRouter(AsyncSessionLocal)
+
+# Main Menu
+@router.route('mainme')
+async def on_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
     await show_main_menu(update, context)
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles all button presses."""
+#lang menu
+@router.route('language_menu')
+async def on_language_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    await language_menu(update, context)
+
+@router.route('set_lang_', prefix=True, needs_db=True)
+async def on_set_language(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
     query = update.callback_query
-    await query.answer()
-    data = query.data
-    user_id = query.from_user.id
-    lang = get_user_language(update, context)
-    
-    db = SessionLocal() # Open a database session for this interaction
+    new_lang = query.data.split('_')[-1] # 'en' or 'es'
+
+    # Use the new CRUD function to update the language
+    # Also invalidates the user's cached profile, so every worker picks the change up
+    await async_botcontrol.update_user_language(db, telegram_id=query.from_user.id, new_lang_code=new_lang)
+
+    # Confirm the change to the user
+    await query.answer((await menu_registry.get('language_updated', new_lang)).text)
+    # Show the main menu again, now in the new language
+    await show_main_menu(update, context)
+
+# Static screens: callback data -> registered menu name
+STATIC_SCREENS = {
+    # Signals Menu
+    'signa': 'signals',
+    'allsig': 'subscription_updated',
+    'accu85': 'subscription_updated',
+    'accu90': 'subscription_updated',
+    # Subscription & Payment Flow
+    'subscr': 'subscription',
+    '1mont': 'choose_currency',
+    '2mont': 'choose_currency',
+    '3mont': 'choose_currency',
+    'proced': 'proceed_payment',
+}
 
+def _static_screen(menu_name: str):
+    async def on_static_screen(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+        await show_menu(update.callback_query, menu_name, lang)
+    return on_static_screen
+
+for callback_data, menu_name in STATIC_SCREENS.items():
+    router.add(callback_data, _static_screen(menu_name))
+
+def balance_values(balance) -> dict:
+    """Placeholder values of the balance and withdraw screens, from a user's ledger row (or None)."""
+    if balance is None:
+        return {'days': 0, 'btc_balance': "0.000000", 'eth_balance': "0.000000",
+                'usdt_balance': "0.000000", 'refbalance': "0.000000"}
+    return {
+        'days': async_botcontrol.subscription_days_left(balance.subscription_expires),
+        'btc_balance': f"{balance.btc_balance:.6f}",
+        'eth_balance': f"{balance.eth_balance:.6f}",
+        'usdt_balance': f"{balance.usdt_balance:.6f}",
+        'refbalance': f"{balance.referral_balance:.6f}",
+    }
+
+# Balance Menu
+@router.route('balan', needs_db=True)
+async def on_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    query = update.callback_query
+    # One primary-key read of the ledger, however many deposits the user has
+    balance = await async_botcontrol.get_balance(db, query.from_user.id)
+    menu = await menu_registry.get('balance', lang)
+    text = menu.text.format(**balance_values(balance))
+    await edit_message(query, text, menu.reply_markup)
+
+# Referrals Menu
+@router.route('refer', needs_db=True)
+async def on_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    query = update.callback_query
+    # Balance, total and paid counts in one aggregate query
+    stats = await async_botcontrol.get_referral_stats(db, referrer_id=query.from_user.id)
+
+    menu = await menu_registry.get('referrals', lang)
+    text = menu.text.format(ref_balance=stats.balance, all_users=stats.total, active_users=stats.paid)
+    await edit_message(query, text, menu.reply_markup)
+
+@router.route('referlink')
+async def on_referral_link(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    query = update.callback_query
+    referral_link = f"https://t.me/{context.bot.username}?start={query.from_user.id}" # Replace with your bot's username
+    menu = await menu_registry.get('referral_link', lang)
+    text = f"{menu.text}\n{referral_link}"
+    await edit_message(query, text, menu.reply_markup)
+
+@router.route('withref', needs_db=True)
+async def on_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    query = update.callback_query
+    balance = await async_botcontrol.get_balance(db, query.from_user.id)
+    menu = await menu_registry.get('withdraw', lang)
+    text = menu.text.format(**balance_values(balance))
+    await edit_message(query, text, menu.reply_markup)
+
+# Handling the alerts
+@router.route('alert_btc', 'alert_eth', 'alert_usdt')
+async def on_withdraw_alert(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    query = update.callback_query
+    await query.answer((await menu_registry.get(query.data, lang)).text, show_alert=True)
+
+# Products: one product per page, browsed with inline arrows. The pages come
+# from the in-memory catalog snapshot, and images are resent by file_id after
+# their first upload, so Telegram doesn't fetch the image URL again.
+CAPTION_LIMIT = 1024  # Telegram's limit for photo captions
+
+async def _load_products() -> list:
+    async with AsyncSessionLocal() as db:
+        return [product async for product in async_botcontrol.iter_products(db)]
+
+async def _product_page(product, page: int, pages: int, lang: str) -> tuple[str, InlineKeyboardMarkup]:
+    """The caption and keyboard of one product page, translated."""
+    name, text, main_menu_label = await translation.translate_many(
+        [product.name, product.text or '', BUTTON_MAIN_MENU], lang
+    )
+    view_label = (await menu_registry.get('view_product', lang)).text
+    caption = f"{name}\n\n{text}".strip()[:CAPTION_LIMIT]
+    rows = [[
+        InlineKeyboardButton("◀️", callback_data=f"prodpage_{(page - 1) % pages}"),
+        InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"prodpage_{page}"),
+        InlineKeyboardButton("▶️", callback_data=f"prodpage_{(page + 1) % pages}"),
+    ]]
+    if product.url:
+        rows.append([InlineKeyboardButton(view_label, url=product.url)])
+    rows.append([InlineKeyboardButton(main_menu_label, callback_data='prodclose')])
+    return caption, InlineKeyboardMarkup(rows)
+
+async def _put_photo(query, media: str, caption: str, reply_markup: InlineKeyboardMarkup):
+    """Shows a photo in place of the callback's message and returns the message showing it."""
+    if query.message.photo:
+        return await query.edit_message_media(InputMediaPhoto(media, caption=caption), reply_markup=reply_markup)
+    # A text screen can't be edited into a photo: replace it
+    sent = await query.message.reply_photo(media, caption=caption, reply_markup=reply_markup)
+    await _delete_message(query.message)
+    return sent
+
+async def _delete_message(message) -> None:
     try:
-        # Main Menu
-        if data == 'mainme':
-            await show_main_menu(update, context)
-    
-        #lang menu
-        elif data == 'language_menu':
-            await language_menu(update, context)
-    
-        elif data.startswith('set_lang_'):
-            new_lang = data.split('_')[-1] # 'en' or 'es'
+        await message.delete()
+    except BadRequest as e:  # e.g. older than 48 hours; the user just scrolls past it
+        logging.debug(f"Could not delete message {message.message_id}: {e}")
 
-            # Use the new CRUD function to update the language
-            botcontrol.update_user_language(db, telegram_id=user_id, new_lang_code=new_lang)
-            context.user_data['language_code'] = new_lang # Update cache
-    
-            # Confirm the change to the user
-            await query.answer(t("Language updated!", new_lang))
-            # Show the main menu again, now in the new language
-            await show_main_menu(update, context)
-    
-    
-        # Signals Menu
-        elif data == 'signa':
-            keyboard = [
-                [InlineKeyboardButton(t(BUTTON_ALL_SIGNALS,lang), callback_data='allsig')],
-                [InlineKeyboardButton(t(BUTTON_ACCURACY_85,lang), callback_data='accu85')],
-                [InlineKeyboardButton(t(BUTTON_ACCURACY_90,lang), callback_data='accu90')],
-                [InlineKeyboardButton(t(BUTTON_MAIN_MENU,lang), callback_data='mainme')]
-            ]
-            await query.edit_message_text(text=t(TEXT_SIGNALS_MENU,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-        
-        elif data in ['allsig', 'accu85', 'accu90']:
-            keyboard = [[InlineKeyboardButton(t(BUTTON_MAIN_MENU,lang), callback_data='mainme')]]
-            await query.edit_message_text(text=t(TEXT_SUBSCRIPTION_UPDATED,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-    
-        # Subscription & Payment Flow
-        elif data == 'subscr':
-            keyboard = [
-                [InlineKeyboardButton(t(BUTTON_PLAN_1_MONTH,lang), callback_data='1mont')],
-                [InlineKeyboardButton(t(BUTTON_PLAN_3_MONTHS,lang), callback_data='2mont')],
-                [InlineKeyboardButton(t(BUTTON_PLAN_12_MONTHS,lang), callback_data='3mont')],
-                [InlineKeyboardButton(t(BUTTON_MAIN_MENU,lang), callback_data='mainme')]
-            ]
-            await query.edit_message_text(text=t(TEXT_SUBSCRIPTION_MENU,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-            
-        elif data in ['1mont', '2mont', '3mont']:
-            keyboard = [
-                [InlineKeyboardButton(t(BUTTON_PAY_BTC,lang), callback_data='proced')],
-                [InlineKeyboardButton(t(BUTTON_PAY_ETH,lang), callback_data='proced')],
-                [InlineKeyboardButton(t(BUTTON_PAY_USDT,lang), callback_data='proced')],
-                [InlineKeyboardButton(t(BUTTON_BACK,lang), callback_data='subscr')]
-            ]
-            await query.edit_message_text(text=t(TEXT_CHOOSE_CURRENCY,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-        
-        elif data == 'proced':
-            keyboard = [
-                [InlineKeyboardButton(t(BUTTON_PROCEED_PAYMENT,lang), callback_data='payment_final_step')],
-                [InlineKeyboardButton(t(BUTTON_MAIN_MENU,lang), callback_data='mainme')]
-            ]
-            await query.edit_message_text(text=t(TEXT_PROCEED_PAYMENT,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-    
-        # Balance Menu
-        elif data == 'balan':
-            ref_balance = botcontrol.get_referral_balance(db, referrer_id=user_id)
-            
-            # --- DATABASE LOGIC will replace these placeholder values ---
-            balance_text = TEXT_BALANCE_MENU.format(days=0, btc_balance="0.000000", eth_balance="0.000000", usdt_balance="0.000000",refbalance=ref_balance)
-            keyboard = [
-                [InlineKeyboardButton(t(BUTTON_SUBSCRIPTION,lang), callback_data='subscr')],
-                [InlineKeyboardButton(t(BUTTON_MAIN_MENU,lang), callback_data='mainme')]
-            ]
-            await query.edit_message_text(text=t(balance_text,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-    
-        # Referrals Menu
-        elif data == 'refer':
-            ref_balance = botcontrol.get_referral_balance(db, referrer_id=user_id)
-            total_refs = botcontrol.count_referrals(db, referrer_id=user_id, only_paid=False)
-            active_refs = botcontrol.count_referrals(db, referrer_id=user_id, only_paid=True)
-
-            # --- DATABASE LOGIC will replace these placeholder values ---
-            referral_text = TEXT_REFERRALS_MENU.format(refbalance=ref_balance, all_users=total_refs, active_users=active_refs)
-            keyboard = [
-                [InlineKeyboardButton(t(BUTTON_REFERRAL_LINK,lang), callback_data='referlink')],
-                [InlineKeyboardButton(t(BUTTON_WITHDRAW,lang), callback_data='withref')],
-                [InlineKeyboardButton(t(BUTTON_MAIN_MENU,lang), callback_data='mainme')]
-            ]
-            await query.edit_message_text(text=t(referral_text,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-            
-        elif data == 'referlink':
-            chat_id = query.from_user.id
-            referral_link = f"https://t.me/{context.bot.username}?start={user_id}" # Replace with your bot's username
-            text = f"{t(TEXT_REFERRAL_LINK_INTRO,lang)}\n{referral_link}"
-            keyboard = [[InlineKeyboardButton(t(BUTTON_BACK,lang), callback_data='refer')]]
-            await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
-            
-        elif data == 'withref':
-            # --- DATABASE LOGIC will replace these placeholder values ---
-            withdraw_text = TEXT_WITHDRAW_MENU.format(btc_balance="0.000000", eth_balance="0.000000", usdt_balance="0.000000")
-            keyboard = [
-                [InlineKeyboardButton(t(BUTTON_BITCOIN,lang), callback_data='alert_btc')],
-                [InlineKeyboardButton(t(BUTTON_ETHEREUM,lang), callback_data='alert_eth')],
-                [InlineKeyboardButton(t(BUTTON_USDT_TRC20,lang), callback_data='alert_usdt')],
-                [InlineKeyboardButton(t(BUTTON_BACK,lang), callback_data='refer')]
-            ]
-            await query.edit_message_text(text=t(withdraw_text,lang), reply_markup=InlineKeyboardMarkup(keyboard))
-    
-        # Handling the alerts
-        elif data == 'alert_btc':
-            await query.answer(t(ALERT_NO_BTC,lang), show_alert=True)
-        elif data == 'alert_eth':
-            await query.answer(t(ALERT_NO_ETH,lang), show_alert=True)
-        elif data == 'alert_usdt':
-            await query.answer(t(ALERT_NO_USDT,lang), show_alert=True)
-    
+async def _show_product_photo(query, product, caption: str, reply_markup: InlineKeyboardMarkup) -> None:
+    """Shows the product's image by file_id when Telegram already has it, and learns the file_id otherwise."""
+    file_id = product_catalog.file_id(product)
+    try:
+        if file_id:
+            try:
+                await _put_photo(query, file_id, caption, reply_markup)
+                return
+            except BadRequest as e:
+                if 'not modified' in str(e):
+                    raise
+                logging.warning(f"Resending product {product.id} by file_id failed ({e}), uploading it again.")
+        sent = await _put_photo(query, product.image, caption, reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
+        metrics.edits_skipped.inc()
+        return
+    if isinstance(sent, Message) and sent.photo:
+        new_file_id = sent.photo[-1].file_id  # the largest size; sending it by id brings every size
+        product_catalog.remember_file_id(product.id, new_file_id)
+        async with AsyncSessionLocal() as db:
+            await async_botcontrol.set_product_file_id(db, product.id, new_file_id)
+
+@router.route('products')
+@router.route('prodpage_', prefix=True)
+async def on_products(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    query = update.callback_query
+    products = await product_catalog.get(_load_products)
+    if not products:
+        await query.answer((await menu_registry.get('alert_no_products', lang)).text, show_alert=True)
+        return
+    page = query.data[len('prodpage_'):] if query.data.startswith('prodpage_') else ''
+    page = int(page) % len(products) if page.isdigit() else 0
+    product = products[page]
+    caption, reply_markup = await _product_page(product, page, len(products), lang)
+    if product.image:
+        await _show_product_photo(query, product, caption, reply_markup)
+    elif query.message.photo:
+        await query.message.reply_text(caption, reply_markup=reply_markup)
+        await _delete_message(query.message)
+    else:
+        await edit_message(query, caption, reply_markup)
+
+@router.route('prodclose')
+async def on_close_products(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, db) -> None:
+    """Back to the main menu. A photo can't be edited into text, so the main menu is sent anew."""
+    query = update.callback_query
+    if not query.message.photo:
+        await show_main_menu(update, context)
+        return
+    menu = await menu_registry.get('main', lang)
+    message = await query.message.reply_text(menu.text, reply_markup=menu.reply_markup)
+    render_cache.remember(_message_key(message), menu.text, menu.reply_markup)
+    await _delete_message(query.message)
+
+# Presses of the same button on the same message, while the first is still
+# being handled or within a second of it, are answered and dropped.
+debouncer = CallbackDebouncer(window=1.0)
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles all button presses by dispatching them through the router."""
+    query = update.callback_query
+    key = debouncer.key(query)
+    if not debouncer.begin(key):
+        metrics.callbacks_debounced.inc()
+        await query.answer()  # stops the button's spinner, the screen is already (being) shown
+        return
+    try:
+        async with metrics.track(router.label(query.data or '')):
+            await query.answer()
+            lang = await get_user_language(update, context)
+            await router.dispatch(update, context, lang)
     finally:
-        db.close() # Ensure the database session is always closed
+        debouncer.end(key)
     
 
+# --- Payment Notifications ---
+
+async def render_payment_received(deposit) -> tuple[str, InlineKeyboardMarkup | None]:
+    """The message sent by the payment watcher for a deposit it marked paid."""
+    lang = deposit.language_code if deposit.language_code in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
+    menu = await menu_registry.get('payment_received', lang)
+    return menu.text.format(amount=f"{deposit.amount:.8f}", coin=deposit.coin), menu.reply_markup
+
+
 # --- Main Function to Run the Bot ---
-def main() -> None:
-    """Run the bot."""
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+async def post_init(application) -> None:
+    """Builds every static menu for every supported language in the background."""
+    application.create_task(menu_registry.prebuild(SUPPORTED_LANGUAGES))
+    await metrics.start(application)
+
+def build_application(builder: ApplicationBuilder | None = None) -> Application:
+    """
+    Builds the Application with every handler registered.
+    Shared by polling mode (main) and the webhook workers (webhook.py).
+    """
+    if REDIS_URL:
+        profile_cache.configure(profile_cache.RedisBackend.from_url(REDIS_URL))
+    # Compiled translations (python catalog.py), so menus build without calling the translator
+    translation.translation_cache.catalogs.load()
+
+    builder = builder or ApplicationBuilder()
+    state = SQLPersistence() if PERSIST_USER_DATA else None
+    if state is not None:
+        builder = builder.persistence(state)
+    if metrics.ENABLED:
+        # Time every outbound Bot API call (getUpdates keeps its own, untimed request)
+        metrics.install()
+        builder = builder.request(metrics.InstrumentedRequest(connection_pool_size=256))
+    application = builder.token(BOT_TOKEN).post_init(post_init).build()
+    if state is not None:
+        state.attach(application)  # lets it evict idle users
 
     #add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -417,6 +671,16 @@ def main() -> None:
 
     #add the callback handler for all buttons
     application.add_handler(CallbackQueryHandler(button_handler))
+
+    if RUN_JOBS:
+        settlement.schedule(application)
+        if PAYMENT_PROVIDER is not None:
+            payment_watcher.PaymentWatcher(PAYMENT_PROVIDER, render_payment_received).schedule(application)
+    return application
+
+def main() -> None:
+    """Run the bot (long polling, single process). See webhook.py for multi-worker mode."""
+    application = build_application()
     print("Bot is running...")
     application.run_polling()
 
@@ -1,11 +1,22 @@
 # In your new file: crud.py
 
+import logging
+import math
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Iterator, NamedTuple
+
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, case, select, update, delete, and_, or_, literal, Numeric
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from passlib.context import CryptContext  # For secure password hashing
 
 # Import your database models and the SessionLocal you created
-from db_models import User, Deposit, Referral, Admin, Product
+from db_models import (User, Deposit, Referral, Admin, Product, Translation, Balance, BotState, ReferralSettlement,
+                       PaymentNotification)
+from profile_cache import profile_cache
+from product_catalog import product_catalog
 
 # --- Security Setup for Admin Passwords ---
 # This is the modern, secure way to handle passwords, replacing MD5.
@@ -18,6 +29,38 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+# --- Streaming Helpers ---
+# The get_all_* functions load whole tables into memory. Admin tools and
+# exports should use the iter_* generators instead: they walk the table with
+# keyset pagination (WHERE id > :last ORDER BY id LIMIT n), so memory stays
+# constant and every page is an index range scan however deep it is.
+
+PAGE_SIZE = 1000
+
+def _iter_by_id(db: Session, stmt, id_column, page_size: int) -> Iterator:
+    """Yields the entities selected by `stmt` in `id_column` order, page by page."""
+    last_id = None
+    while True:
+        page_stmt = stmt.order_by(id_column).limit(page_size)
+        if last_id is not None:
+            page_stmt = page_stmt.where(id_column > last_id)
+        page = db.scalars(page_stmt).all()
+        yield from page
+        if len(page) < page_size:
+            return
+        last_id = page[-1].id
+
+def stream(db: Session, stmt, batch_size: int = PAGE_SIZE) -> Iterator:
+    """
+    One-shot export of any select(): streams its rows through a server-side
+    cursor with yield_per, holding at most `batch_size` rows in memory.
+    Keeps a cursor (and a connection) open until exhausted; prefer the
+    iter_* functions for long-running jobs.
+    """
+    result = db.execute(stmt.execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        yield from partition
+
 # --- User Functions ---
 
 def update_user_language(db: Session, telegram_id: int, new_lang_code: str) -> User | None:
@@ -27,6 +70,7 @@ def update_user_language(db: Session, telegram_id: int, new_lang_code: str) -> U
         user.language_code = new_lang_code
         db.commit()
         db.refresh(user)
+        profile_cache.invalidate(telegram_id)
         return user
     return None
 
@@ -50,16 +94,81 @@ def create_user(db: Session, telegram_id: int, first_name: str, last_name: str,
     db.refresh(new_user)
     return new_user
 
+# Dialects whose upsert can hand back the row in the same statement (RETURNING).
+# MySQL has no RETURNING, so there the row is read back in the same transaction.
+UPSERT_RETURNING_DIALECTS = ('sqlite', 'postgresql')
+
+def upsert_users_statement(dialect_name: str, rows: list[dict]):
+    """
+    Builds a native multi-row "insert unless telegram_id exists" statement.
+    Existing users are left untouched, so their chosen language is kept.
+    """
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(User).values(rows)
+        # No-op update, only there to turn the duplicate key error into "keep the row"
+        return stmt.on_duplicate_key_update(telegram_id=stmt.inserted.telegram_id)
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    stmt = insert(User).values(rows)
+    # DO UPDATE (not DO NOTHING) so RETURNING also yields rows that already existed
+    return stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={'telegram_id': stmt.excluded.telegram_id}
+    )
+
+def user_row(telegram_id: int, first_name: str, last_name: str, username: str, language_code: str) -> dict:
+    """Column values of a new user, as used by upsert_users_statement()."""
+    return {
+        'telegram_id': telegram_id,
+        'first_name': first_name,
+        'last_name': last_name,
+        'username': username,
+        'language_code': language_code,
+    }
+
+def get_or_create_user(db: Session, telegram_id: int, first_name: str, last_name: str,
+                       username: str, language_code: str = 'en') -> User:
+    """
+    Returns the user, registering them with `language_code` on first contact.
+    Uses a native upsert, so two quick taps can't race on the unique telegram_id.
+    On SQLite/PostgreSQL this is a single INSERT ... ON CONFLICT ... RETURNING.
+    On MySQL it is a SELECT, and only for new users INSERT ... ON DUPLICATE KEY UPDATE
+    plus a read back, all in one transaction. The read back is a locking read:
+    under REPEATABLE READ a plain one would use the snapshot of the first
+    SELECT and miss a row inserted meanwhile by a concurrent tap.
+    """
+    dialect_name = db.get_bind().dialect.name
+    row = user_row(telegram_id, first_name, last_name, username, language_code)
+    stmt = upsert_users_statement(dialect_name, [row])
+
+    if dialect_name in UPSERT_RETURNING_DIALECTS:
+        user = db.scalars(stmt.returning(User), execution_options={'populate_existing': True}).one()
+        db.commit()
+        return user
+
+    user = get_user_by_telegram_id(db, telegram_id)
+    if user:
+        return user
+    db.execute(stmt)
+    user = db.scalars(select(User).where(User.telegram_id == telegram_id).with_for_update()).one()
+    db.commit()
+    return user
+
 def get_all_users(db: Session) -> list[User]:
-    """Replaces allUsers()."""
+    """Replaces allUsers(). Loads every user, prefer iter_users() for big tables."""
     return db.query(User).all()
 
+def iter_users(db: Session, page_size: int = PAGE_SIZE) -> Iterator[User]:
+    """Streams every user in id order, one keyset page at a time."""
+    yield from _iter_by_id(db, select(User), User.id, page_size)
+
 def delete_user(db: Session, user_id: int) -> bool:
     """Replaces deleteUser(). Deletes a user by their primary key `id`."""
     user_to_delete = db.query(User).filter(User.id == user_id).first()
     if user_to_delete:
+        telegram_id = user_to_delete.telegram_id
         db.delete(user_to_delete)
         db.commit()
+        profile_cache.invalidate(telegram_id)
         return True
     return False
 
@@ -96,6 +205,45 @@ def get_referral_balance(db: Session, referrer_id: int) -> float:
     total = db.query(func.sum(Referral.bonus)).filter(Referral.user_id == referrer_id).scalar()
     return total or 0.0
 
+class ReferralStats(NamedTuple):
+    """The numbers shown on the referrals screen for one referrer."""
+    balance: float   # sum of all bonuses, same as get_referral_balance()
+    total: int       # same as count_referrals(only_paid=False)
+    paid: int        # same as count_referrals(only_paid=True)
+
+def referral_stats_query(referrer_id: int):
+    """The single aggregate query behind get_referral_stats()."""
+    return select(
+        func.coalesce(func.sum(Referral.bonus), 0),
+        func.count(),
+        func.coalesce(func.sum(case((Referral.bonus > 0, 1), else_=0)), 0)
+    ).where(Referral.user_id == referrer_id)
+
+def get_referral_stats(db: Session, referrer_id: int) -> ReferralStats:
+    """
+    Returns the referral balance, total count and paid count in one round trip.
+    Served entirely from the (user_id, bonus) index.
+    """
+    balance, total, paid = db.execute(referral_stats_query(referrer_id)).one()
+    return ReferralStats(balance or 0.0, total, paid)  # same zero as get_referral_balance()
+
+def credit_referral_bonus(db: Session, referrer_id: int, new_user_id: int, bonus: float) -> Referral | None:
+    """
+    Sets the bonus earned for one referral and moves the referrer's
+    referral balance by the difference, in one transaction.
+    """
+    referral = db.query(Referral).filter(
+        Referral.user_id == referrer_id, Referral.referred_user_id == new_user_id
+    ).with_for_update().first()
+    if referral is None:
+        return None
+    delta = to_decimal(bonus) - (referral.bonus or 0)
+    referral.bonus = bonus
+    db.execute(balance_upsert_statement(db.get_bind().dialect.name, referrer_id, {'referral_balance': delta}))
+    db.commit()
+    db.refresh(referral)
+    return referral
+
 # --- Deposit Functions ---
 
 def create_deposit(db: Session, user_id: int, amount: float, doll_amount: float, coin: str, order_id: str) -> Deposit:
@@ -105,7 +253,7 @@ def create_deposit(db: Session, user_id: int, amount: float, doll_amount: float,
         amount=amount,
         doll_amount=doll_amount,
         coin=coin,
-        time=order_id, # Assuming 'time' column in PHP was for an order ID
+        order_id=order_id,
         state='pending'
     )
     db.add(new_deposit)
@@ -127,39 +275,396 @@ def get_all_deposits_by_state(db: Session, state: str) -> list:
     """
     return db.query(Deposit, User).join(User, Deposit.user_id == User.telegram_id).filter(Deposit.state == state).all()
 
+def deposits_by_state_page(state: str, after: tuple[datetime, int] | None, page_size: int):
+    """
+    One keyset page of (Deposit, User) rows in `state`, ordered by (time, id).
+    `after` is the (time, id) of the last deposit of the previous page, so the
+    page does not depend on that deposit still being there, or in `state`.
+    Walks the (state, time) index, so deep pages cost the same as the first one.
+    """
+    stmt = (
+        select(Deposit, User)
+        .join(User, Deposit.user_id == User.telegram_id)
+        .where(Deposit.state == state)
+        .order_by(Deposit.time, Deposit.id)
+        .limit(page_size)
+    )
+    if after is not None:
+        last_time, last_id = after
+        stmt = stmt.where(or_(Deposit.time > last_time, and_(Deposit.time == last_time, Deposit.id > last_id)))
+    return stmt
+
+def iter_deposits_by_state(db: Session, state: str, page_size: int = PAGE_SIZE) -> Iterator:
+    """Streaming get_all_deposits_by_state(): yields (Deposit, User) rows in time order."""
+    after = None
+    while True:
+        page = db.execute(deposits_by_state_page(state, after, page_size)).all()
+        yield from page
+        if len(page) < page_size:
+            return
+        after = (page[-1].Deposit.time, page[-1].Deposit.id)
+
 def mark_deposit_paid(db: Session, order_id: str) -> Deposit | None:
     """
-    Replaces markpaid(). Finds a deposit by the order_id and updates its state.
+    Replaces markpaid(). Finds a deposit by the order_id and marks it paid if
+    it is still pending; a repeated callback after approval leaves it approved.
+    Returns the deposit, or None if there is none with this order_id.
     """
-    deposit_to_update = db.query(Deposit).filter(Deposit.time == order_id).first()
+    deposit_to_update = db.query(Deposit).filter(Deposit.order_id == order_id).with_for_update().first()
     if deposit_to_update:
-        deposit_to_update.state = 'paid'
+        if deposit_to_update.state == 'pending':
+            deposit_to_update.state = 'paid'
         db.commit()
         db.refresh(deposit_to_update)
         return deposit_to_update
     return None
 
-def approve_deposit(db: Session, deposit_id: int, amount: float, doll_amount: float) -> Deposit | None:
-    """Replaces approveDeposit()."""
-    deposit_to_approve = db.query(Deposit).filter(Deposit.id == deposit_id).first()
+def mark_deposits_paid_statement(order_ids: list[str]):
+    """The single UPDATE behind mark_deposits_paid()."""
+    return (
+        update(Deposit)
+        .where(Deposit.order_id.in_(order_ids), Deposit.state == 'pending')
+        .values(state='paid')
+        .execution_options(synchronize_session=False)
+    )
+
+def mark_deposits_paid(db: Session, order_ids: list[str]) -> int:
+    """
+    Bulk version of mark_deposit_paid() for a batch of payment-processor callbacks.
+    Settles every pending deposit in `order_ids` with one UPDATE in one transaction.
+    Deposits that are already paid or approved are left alone, so repeated
+    callbacks are harmless. Returns the number of deposits marked paid.
+    """
+    if not order_ids:
+        return 0
+    result = db.execute(mark_deposits_paid_statement(list(order_ids)))
+    db.commit()
+    return result.rowcount
+
+def due_deposits_page(now: datetime, after_id: int, page_size: int):
+    """
+    One keyset page, in id order, of the pending deposits with an order id
+    whose next payment check is due at `now`: (id, order_id, check_attempts) rows.
+    """
+    return (
+        select(Deposit.id, Deposit.order_id, Deposit.check_attempts)
+        .where(Deposit.state == 'pending', Deposit.order_id.isnot(None),
+               or_(Deposit.next_check_at.is_(None), Deposit.next_check_at <= now),
+               Deposit.id > after_id)
+        .order_by(Deposit.id)
+        .limit(page_size)
+    )
+
+def paid_deposits_claim_query(order_ids: list[str]):
+    """Locks the pending deposits in `order_ids`."""
+    return (
+        select(Deposit.id)
+        .where(Deposit.order_id.in_(order_ids), Deposit.state == 'pending')
+        .order_by(Deposit.id)
+        .with_for_update()
+    )
+
+def mark_deposit_ids_paid_statement(deposit_ids: list[int]):
+    return (
+        update(Deposit)
+        .where(Deposit.id.in_(deposit_ids), Deposit.state == 'pending')
+        .values(state='paid')
+        .execution_options(synchronize_session=False)
+    )
+
+def queue_payment_notifications_statement(deposit_ids: list[int]):
+    return PaymentNotification.__table__.insert().from_select(
+        ['deposit_id'], select(Deposit.id).where(Deposit.id.in_(deposit_ids))
+    )
+
+def claim_paid_deposits(db: Session, order_ids: list[str]) -> int:
+    """
+    mark_deposits_paid() for the payment watcher: in one transaction, marks
+    every pending deposit in `order_ids` paid and queues a notification for
+    exactly those in 'payment_notification', so each payment is notified
+    once even if a callback marks some of them paid at the same time.
+    Returns the number of deposits marked paid.
+    """
+    if not order_ids:
+        return 0
+    deposit_ids = list(db.scalars(paid_deposits_claim_query(list(order_ids))))
+    if deposit_ids:
+        db.execute(mark_deposit_ids_paid_statement(deposit_ids))
+        db.execute(queue_payment_notifications_statement(deposit_ids))
+    db.commit()
+    return len(deposit_ids)
+
+def payment_notifications_page(after_id: int, page_size: int):
+    """
+    One keyset page of the notifications to send, as (id, user_id, amount,
+    coin, language_code) rows of their deposits, in deposit id order.
+    """
+    return (
+        select(Deposit.id, Deposit.user_id, Deposit.amount, Deposit.coin, User.language_code)
+        .join(PaymentNotification, PaymentNotification.deposit_id == Deposit.id)
+        .join(User, Deposit.user_id == User.telegram_id)
+        .where(Deposit.id > after_id)
+        .order_by(Deposit.id)
+        .limit(page_size)
+    )
+
+def get_payment_notifications(db: Session, after_id: int, page_size: int = PAGE_SIZE) -> list:
+    """One page of the payment watcher's outbox."""
+    return db.execute(payment_notifications_page(after_id, page_size)).all()
+
+def delete_payment_notifications(db: Session, deposit_ids: list[int]) -> None:
+    """Removes sent notifications from the outbox."""
+    if deposit_ids:
+        db.execute(delete(PaymentNotification).where(PaymentNotification.deposit_id.in_(deposit_ids)))
+        db.commit()
+
+def postpone_deposit_checks_statement(deposit_ids: list[int], attempts: int, next_check_at: datetime):
+    """Records one more unpaid check of `deposit_ids`, which all had `attempts` so far."""
+    return (
+        update(Deposit)
+        .where(Deposit.id.in_(deposit_ids), Deposit.state == 'pending')
+        .values(check_attempts=attempts + 1, next_check_at=next_check_at)
+        .execution_options(synchronize_session=False)
+    )
+
+def postpone_deposit_checks(db: Session, schedule: list[tuple[list[int], int, datetime]]) -> None:
+    """
+    Backs off deposits still unpaid. `schedule` holds (deposit ids, their
+    check_attempts, next check time) groups: one UPDATE per group, one transaction.
+    """
+    for deposit_ids, attempts, next_check_at in schedule:
+        db.execute(postpone_deposit_checks_statement(deposit_ids, attempts, next_check_at))
+    db.commit()
+
+def approve_deposit(db: Session, deposit_id: int, amount: float, doll_amount: float,
+                    subscription_days: int = 0) -> Deposit | None:
+    """
+    Replaces approveDeposit(). In the same transaction, credits the amount to
+    the user's balance (only the difference if it was already approved) and,
+    when the deposit wasn't approved yet, extends their subscription by
+    `subscription_days`. Approving it again never extends it twice.
+    """
+    deposit_to_approve = db.query(Deposit).filter(Deposit.id == deposit_id).with_for_update().first()
     if deposit_to_approve:
+        newly_approved = deposit_to_approve.state != 'approved'
+        already_credited = 0 if newly_approved else deposit_to_approve.amount
         deposit_to_approve.state = 'approved'
         deposit_to_approve.amount = amount
         deposit_to_approve.doll_amount = doll_amount
+        deltas = coin_deltas(deposit_to_approve.coin, to_decimal(amount) - already_credited)
+        db.execute(balance_upsert_statement(db.get_bind().dialect.name, deposit_to_approve.user_id, deltas))
+        if newly_approved and subscription_days:
+            deposit_to_approve.subscription_days = subscription_days
+            balance = db.get(Balance, deposit_to_approve.user_id, with_for_update=True, populate_existing=True)
+            balance.subscription_expires = extend_subscription(balance.subscription_expires, subscription_days)
         db.commit()
         db.refresh(deposit_to_approve)
         return deposit_to_approve
     return None
 
 def delete_deposit(db: Session, deposit_id: int) -> bool:
-    """Replaces deleteDeposit()."""
-    deposit_to_delete = db.query(Deposit).filter(Deposit.id == deposit_id).first()
+    """
+    Replaces deleteDeposit(). Deleting an approved deposit takes its amount
+    back off the balance, and the subscription days it granted off the expiry.
+    """
+    deposit_to_delete = db.query(Deposit).filter(Deposit.id == deposit_id).with_for_update().first()
     if deposit_to_delete:
+        if deposit_to_delete.state == 'approved':
+            deltas = coin_deltas(deposit_to_delete.coin, -deposit_to_delete.amount)
+            db.execute(balance_upsert_statement(db.get_bind().dialect.name, deposit_to_delete.user_id, deltas))
+            if deposit_to_delete.subscription_days:
+                balance = db.get(Balance, deposit_to_delete.user_id, with_for_update=True, populate_existing=True)
+                balance.subscription_expires = shorten_subscription(balance.subscription_expires,
+                                                                    deposit_to_delete.subscription_days)
         db.delete(deposit_to_delete)
         db.commit()
         return True
     return False
 
+# --- Balance Ledger ---
+# One 'balance' row per user, moved by the functions above in the same
+# transaction as the deposit or referral they change.
+
+# Deposit.coin prefix -> Balance column
+BALANCE_COLUMNS = {'btc': 'btc_balance', 'eth': 'eth_balance', 'usdt': 'usdt_balance'}
+
+def to_decimal(amount) -> Decimal:
+    """Converts an amount passed as float/str/Decimal without float rounding noise."""
+    return amount if isinstance(amount, Decimal) else Decimal(str(amount))
+
+def coin_deltas(coin: str, delta) -> dict:
+    """{balance column: delta} for a deposit in `coin` ('BTC', 'usdt', 'USDT(TRC20)', ...)."""
+    coin = coin.strip().lower()
+    for prefix, column in BALANCE_COLUMNS.items():
+        if coin.startswith(prefix):
+            return {column: delta}
+    logging.warning(f"No balance column for coin '{coin}', the ledger is left unchanged.")
+    return {}
+
+def balance_upsert_statement(dialect_name: str, user_id: int, deltas: dict):
+    """
+    Adds each {column: delta} to the user's balance row in one statement,
+    creating the row first if needed. The addition happens in SQL, so
+    concurrent credits can't overwrite each other.
+    """
+    values = {'user_id': user_id, **deltas}
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(Balance).values(values)
+        changes = {column: getattr(Balance, column) + delta for column, delta in deltas.items()}
+        return stmt.on_duplicate_key_update(changes or {'user_id': stmt.inserted.user_id})
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    stmt = insert(Balance).values(values)
+    changes = {column: getattr(Balance, column) + delta for column, delta in deltas.items()}
+    return stmt.on_conflict_do_update(
+        index_elements=[Balance.user_id],
+        set_=changes or {'user_id': stmt.excluded.user_id}
+    )
+
+def _as_utc(moment: datetime | None) -> datetime | None:
+    # SQLite hands DateTime(timezone=True) columns back without a timezone
+    if moment is not None and moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment
+
+def extend_subscription(expires: datetime | None, days: int, now: datetime | None = None) -> datetime:
+    """New expiry after buying `days`: added to the current expiry, or to now if it has lapsed."""
+    now = now or datetime.now(timezone.utc)
+    return max(now, _as_utc(expires) or now) + timedelta(days=days)
+
+def shorten_subscription(expires: datetime | None, days: int) -> datetime | None:
+    """Expiry after taking back `days` granted by extend_subscription()."""
+    return _as_utc(expires) - timedelta(days=days) if expires is not None else None
+
+def subscription_days_left(expires: datetime | None, now: datetime | None = None) -> int:
+    """Whole days of subscription left (a started day counts), 0 once expired."""
+    if expires is None:
+        return 0
+    remaining = (_as_utc(expires) - (now or datetime.now(timezone.utc))).total_seconds()
+    return max(0, math.ceil(remaining / 86400))
+
+def get_balance(db: Session, telegram_id: int) -> Balance | None:
+    """The user's ledger row, read by primary key. None if nothing was ever credited."""
+    return db.get(Balance, telegram_id)
+
+def rebuild_balance(db: Session, telegram_id: int) -> Balance:
+    """
+    Recomputes a user's balances from their approved deposits and referral
+    bonuses (the subscription expiry is kept). Used to backfill the ledger
+    for users created before it existed, or to audit it.
+    """
+    totals = {column: Decimal(0) for column in BALANCE_COLUMNS.values()}
+    approved = db.query(Deposit.coin, func.sum(Deposit.amount)).filter(
+        Deposit.user_id == telegram_id, Deposit.state == 'approved'
+    ).group_by(Deposit.coin)
+    for coin, amount in approved:
+        for column, delta in coin_deltas(coin, amount or 0).items():
+            totals[column] += delta
+    totals['referral_balance'] = db.query(
+        func.coalesce(func.sum(Referral.bonus), 0)
+    ).filter(Referral.user_id == telegram_id).scalar()
+
+    balance = db.get(Balance, telegram_id, with_for_update=True) or Balance(user_id=telegram_id)
+    for column, value in totals.items():
+        setattr(balance, column, value)
+    db.add(balance)
+    db.commit()
+    db.refresh(balance)
+    return balance
+
+# --- Referral Settlement ---
+# Referrers earn a share of every deposit of the users they referred, once
+# the deposit is approved. Each run reads only the approved deposits it has
+# not seen yet (Deposit.referral_settled, over the (state, referral_settled)
+# index), so its cost follows new approvals, not deposit history. A batch
+# is settled with set-based statements in one transaction: mark (and price)
+# it in 'referral_settlement', add it to the referrals' bonuses, then to the
+# referrers' ledger rows, and flag its deposits as settled.
+
+def unsettled_deposits_query(limit: int):
+    """Locks up to `limit` approved deposits the settlement job hasn't seen yet."""
+    return (
+        select(Deposit.id)
+        .where(Deposit.state == 'approved', Deposit.referral_settled.is_(False))
+        .order_by(Deposit.id)
+        .limit(limit)
+        .with_for_update()
+    )
+
+def settlement_insert_statement(batch_id: str, rate, deposit_ids: list[int]):
+    """
+    Records the not yet settled (deposit, referral) pairs of `deposit_ids`
+    under `batch_id`, with bonus = rate * the deposit's dollar amount.
+    """
+    settled = select(ReferralSettlement.deposit_id).where(
+        ReferralSettlement.deposit_id == Deposit.id, ReferralSettlement.referral_id == Referral.id
+    ).exists()
+    bonus = func.coalesce(Deposit.doll_amount, 0) * literal(to_decimal(rate), Numeric(18, 8))
+    batch = (
+        select(Deposit.id, Referral.id, Referral.user_id, bonus, literal(batch_id))
+        .join(Referral, Referral.referred_user_id == Deposit.user_id)
+        .where(Deposit.id.in_(deposit_ids), ~settled)
+    )
+    return ReferralSettlement.__table__.insert().from_select(
+        ['deposit_id', 'referral_id', 'referrer_id', 'bonus', 'batch_id'], batch
+    )
+
+def settlement_referral_update_statement(batch_id: str):
+    """Adds a batch's bonuses to the bonus of each referral in it."""
+    batch_bonus = select(func.sum(ReferralSettlement.bonus)).where(
+        ReferralSettlement.batch_id == batch_id, ReferralSettlement.referral_id == Referral.id
+    ).scalar_subquery()
+    in_batch = select(ReferralSettlement.referral_id).where(ReferralSettlement.batch_id == batch_id)
+    return (
+        update(Referral)
+        .where(Referral.id.in_(in_batch))
+        .values(bonus=Referral.bonus + batch_bonus)
+        .execution_options(synchronize_session=False)
+    )
+
+def settlement_balance_statement(dialect_name: str, batch_id: str):
+    """Adds a batch's bonuses to each referrer's referral_balance, creating ledger rows as needed."""
+    totals = (
+        select(ReferralSettlement.referrer_id, func.sum(ReferralSettlement.bonus))
+        .where(ReferralSettlement.batch_id == batch_id)
+        .group_by(ReferralSettlement.referrer_id)
+    )
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(Balance).from_select(['user_id', 'referral_balance'], totals)
+        return stmt.on_duplicate_key_update(referral_balance=Balance.referral_balance + stmt.inserted.referral_balance)
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    stmt = insert(Balance).from_select(['user_id', 'referral_balance'], totals)
+    return stmt.on_conflict_do_update(
+        index_elements=[Balance.user_id],
+        set_={'referral_balance': Balance.referral_balance + stmt.excluded.referral_balance}
+    )
+
+def settled_deposits_statement(deposit_ids: list[int]):
+    return (
+        update(Deposit)
+        .where(Deposit.id.in_(deposit_ids))
+        .values(referral_settled=True)
+        .execution_options(synchronize_session=False)
+    )
+
+def settle_referral_batch(db: Session, batch_id: str, rate, limit: int) -> tuple[int, int]:
+    """
+    Settles up to `limit` new approved deposits in one transaction. Returns
+    (deposits seen, (deposit, referral) pairs credited). Concurrent runs
+    can't credit a deposit twice: the batch is locked, and a second insert
+    of a marker would fail and roll back.
+    """
+    dialect_name = db.get_bind().dialect.name
+    deposit_ids = list(db.scalars(unsettled_deposits_query(limit)))
+    settled = 0
+    if deposit_ids:
+        settled = db.execute(settlement_insert_statement(batch_id, rate, deposit_ids)).rowcount
+        if settled:
+            db.execute(settlement_referral_update_statement(batch_id))
+            db.execute(settlement_balance_statement(dialect_name, batch_id))
+        db.execute(settled_deposits_statement(deposit_ids))
+    db.commit()
+    return len(deposit_ids), settled
+
 # --- Admin Functions (SECURE VERSION) ---
 
 def create_admin(db: Session, username: str, plain_password: str) -> Admin:
@@ -187,6 +692,10 @@ def get_all_admins(db: Session) -> list[Admin]:
     """Replaces allAdmins()."""
     return db.query(Admin).all()
 
+def iter_admins(db: Session, page_size: int = PAGE_SIZE) -> Iterator[Admin]:
+    """Streams every admin in id order, one keyset page at a time."""
+    yield from _iter_by_id(db, select(Admin), Admin.id, page_size)
+
 # --- Product Functions ---
 # (Assuming you have a Product model as defined previously)
 
@@ -194,12 +703,59 @@ def get_all_products(db: Session) -> list[Product]:
     """Replaces allproducts()."""
     return db.query(Product).all()
 
+def iter_products(db: Session, page_size: int = PAGE_SIZE) -> Iterator[Product]:
+    """Streams every product in id order, one keyset page at a time."""
+    yield from _iter_by_id(db, select(Product), Product.id, page_size)
+
 def create_product(db: Session, name: str, text: str, image: str, url: str) -> Product:
     """Replaces addProd()."""
     new_product = Product(name=name, text=text, image=image, url=url)
     db.add(new_product)
     db.commit()
     db.refresh(new_product)
+    product_catalog.invalidate()
     return new_product
 
-# ... you can add update and delete functions for products if needed ...
\ No newline at end of file
+def set_product_file_id(db: Session, product_id: int, file_id: str) -> None:
+    """Stores the Telegram file_id of a product's uploaded image."""
+    db.execute(update(Product).where(Product.id == product_id).values(file_id=file_id))
+    db.commit()
+
+# ... you can add update and delete functions for products if needed ...
+
+# --- Translation Cache Functions ---
+
+def get_translation(db: Session, source_hash: str, lang: str) -> str | None:
+    """Returns the stored translation for a source text hash, or None."""
+    return db.query(Translation.translated_text).filter(
+        Translation.source_hash == source_hash, Translation.lang == lang
+    ).scalar()
+
+def save_translation(db: Session, source_hash: str, lang: str, source_text: str, translated_text: str) -> None:
+    """
+    Stores a translation. If another process saved the same
+    (source_hash, lang) first, the existing row is kept.
+    """
+    db.add(Translation(
+        source_hash=source_hash,
+        lang=lang,
+        source_text=source_text,
+        translated_text=translated_text
+    ))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+
+# --- Bot State Functions ---
+
+def bot_state_upsert_statement(dialect_name: str, kind: str, rows: dict[int, str]):
+    """Builds one multi-row upsert of {key: JSON data} into bot_state."""
+    values = [{'kind': kind, 'key': key, 'data': data} for key, data in rows.items()]
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(BotState).values(values)
+        return stmt.on_duplicate_key_update(data=stmt.inserted.data, last_updated=func.now())
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    stmt = insert(BotState).values(values)
+    return stmt.on_conflict_do_update(index_elements=['kind', 'key'],
+                                      set_={'data': stmt.excluded.data, 'last_updated': func.now()})
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from db_models import AsyncSessionLocal
+import async_botcontrol
+import translation
+
+# --- Broadcasts ---
+# Users are streamed one language at a time (keyset pages), so the message is
+# translated once per language, and sent within Telegram's limits. Each page
+# is checkpointed in 'broadcast_progress': running the same broadcast id
+# again resumes it. From the shell: python broadcast.py <id> <message_file>
+
+# Telegram allows about 30 messages per second overall, and 1 per second in a single chat
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+PAGE_SIZE = 100       # recipients sent concurrently between two checkpoints
+MAX_ATTEMPTS = 5      # per message, for 429s and network errors
+TRANSLATE_ATTEMPTS = 5  # per language, before its recipients are left for a rerun
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:  # FIFO, so waiters are served in order
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Stops handing out tokens for `seconds` (used for 429 retry_after)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class ChatRateLimiter:
+    """Keeps at least `interval` seconds between two sends to the same chat."""
+
+    def __init__(self, interval: float, maxsize: int = 100_000):
+        self.interval = interval
+        self.maxsize = maxsize
+        self._next_allowed = OrderedDict()  # chat_id -> monotonic time
+
+    async def acquire(self, chat_id: int) -> None:
+        now = time.monotonic()
+        next_allowed = self._next_allowed.get(chat_id, now)
+        self._next_allowed[chat_id] = max(now, next_allowed) + self.interval
+        self._next_allowed.move_to_end(chat_id)
+        if len(self._next_allowed) > self.maxsize:
+            self._next_allowed.popitem(last=False)
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+
+
+def _seconds(retry_after) -> float:
+    """RetryAfter.retry_after is an int in older python-telegram-bot versions, a timedelta in newer ones."""
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class Broadcaster:
+    """Sends one message to every user, translated per language, within Telegram's limits."""
+
+    def __init__(self, bot, session_factory=AsyncSessionLocal, rate: float = GLOBAL_RATE,
+                 per_chat_interval: float = PER_CHAT_INTERVAL, page_size: int = PAGE_SIZE):
+        self.bot = bot
+        self.session_factory = session_factory
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatRateLimiter(per_chat_interval)
+        self.page_size = page_size
+
+    async def send(self, chat_id: int, text: str, **send_options) -> bool:
+        """Sends one message, honouring both limiters and 429s. Returns False if it gave up."""
+        for attempt in range(MAX_ATTEMPTS):
+            await self.chats.acquire(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **send_options)
+                return True
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every sender waits
+                logging.warning(f"Broadcast hit flood control, pausing for {e.retry_after}s.")
+                self.bucket.pause(_seconds(e.retry_after))
+            except (Forbidden, BadRequest) as e:
+                # Blocked the bot, deleted account, bad chat id: retrying won't help
+                logging.info(f"Broadcast to {chat_id} failed: {e}")
+                return False
+            except (TimedOut, NetworkError) as e:
+                logging.warning(f"Broadcast to {chat_id} failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        return False
+
+    async def run(self, broadcast_id: str, text: str, **send_options) -> dict:
+        """
+        Sends `text` (English) to every user, resuming from the checkpoints of
+        `broadcast_id` if it ran before. Returns {'sent': n, 'failed': n}.
+        A language whose translation keeps failing is skipped, not sent in
+        English: run the same `broadcast_id` again later to reach its users.
+        """
+        async with self.session_factory() as db:
+            languages = await async_botcontrol.get_broadcast_languages(db)
+            progress = await async_botcontrol.get_broadcast_progress(db, broadcast_id)
+
+        totals = {'sent': 0, 'failed': 0}
+        skipped = []
+        for lang in languages:
+            checkpoint = progress.get(lang)
+            if checkpoint is not None and checkpoint.done:
+                totals['sent'] += checkpoint.sent
+                totals['failed'] += checkpoint.failed
+                continue
+            localized = await self._localize(text, lang)  # once per language
+            if localized is None:
+                skipped.append(lang)
+                continue
+            sent, failed = await self._run_language(broadcast_id, localized, lang, checkpoint, send_options)
+            totals['sent'] += sent
+            totals['failed'] += failed
+        if skipped:
+            logging.error(f"Broadcast '{broadcast_id}' skipped {', '.join(skipped)}: the translation failed. "
+                          f"Run it again to send to these users.")
+        logging.info(f"Broadcast '{broadcast_id}' finished: {totals['sent']} sent, {totals['failed']} failed.")
+        return totals
+
+    async def _localize(self, text: str, lang: str) -> str | None:
+        """The complete translation of `text`, or None if it can't be had in TRANSLATE_ATTEMPTS tries."""
+        for attempt in range(TRANSLATE_ATTEMPTS):
+            (localized,), complete = await translation.translate_all([text], lang)
+            if complete:
+                return localized
+            # A timed-out translation keeps filling the cache, so the next try often finds it there
+            logging.warning(f"Translating the broadcast to '{lang}' failed (attempt {attempt + 1}).")
+            if attempt + 1 < TRANSLATE_ATTEMPTS:
+                await asyncio.sleep(2 ** attempt)
+        return None
+
+    async def _run_language(self, broadcast_id: str, localized: str, lang: str, checkpoint,
+                            send_options) -> tuple[int, int]:
+        last_user_id = checkpoint.last_user_id if checkpoint else 0
+        sent = checkpoint.sent if checkpoint else 0
+        failed = checkpoint.failed if checkpoint else 0
+        logging.info(f"Broadcast '{broadcast_id}' to '{lang}' users from user id {last_user_id}.")
+
+        while True:
+            # Short sessions around the fetch and the checkpoint: none stays
+            # open, holding a connection and a transaction, while a page is sent
+            async with self.session_factory() as db:
+                page = await async_botcontrol.get_broadcast_recipients(db, lang, last_user_id, self.page_size)
+            if not page:
+                break
+            results = await asyncio.gather(
+                *(self.send(telegram_id, localized, **send_options) for _, telegram_id in page)
+            )
+            sent += sum(results)
+            failed += len(results) - sum(results)
+            last_user_id = page[-1][0]
+            async with self.session_factory() as db:
+                await async_botcontrol.save_broadcast_progress(db, broadcast_id, lang, last_user_id, sent, failed)
+        async with self.session_factory() as db:
+            await async_botcontrol.save_broadcast_progress(db, broadcast_id, lang, last_user_id, sent, failed, done=True)
+        return sent, failed
+
+
+async def _main(broadcast_id: str, path: str) -> None:
+    from telegram import Bot
+    import bot
+
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    async with Bot(bot.BOT_TOKEN) as telegram_bot:
+        await Broadcaster(telegram_bot).run(broadcast_id, text)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python broadcast.py <broadcast_id> <message_file>")
+        sys.exit(1)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(_main(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,173 @@
+import argparse
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+
+# --- Compiled Translation Catalogs ---
+# python catalog.py [--lang es de] translates every UI string into one
+# CATALOG_DIR/<lang>.cat per language. The bot memory-maps them at startup;
+# strings missing from a catalog still go through the live translator.
+# Layout (little-endian): header (MAGIC, version u16, reserved u16, count u32),
+# count x (16-byte blake2b of the English segment, offset u32, length u32)
+# sorted by hash, then the UTF-8 blob the offsets point into.
+
+CATALOG_DIR = os.getenv("CATALOG_DIR", "catalog")
+
+MAGIC = b"TGCT"
+VERSION = 1
+_HEADER = struct.Struct("<4sHHI")
+_ENTRY = struct.Struct("<16sII")
+KEY_SIZE = 16
+
+
+def catalog_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+
+def catalog_path(directory: str, lang: str) -> str:
+    return os.path.join(directory, f"{lang}.cat")
+
+
+class _Keys:
+    """The hashes of a catalog's index as a sequence, for bisect, read straight from the map."""
+
+    def __init__(self, buffer, count: int):
+        self._buffer = buffer
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> bytes:
+        start = _HEADER.size + index * _ENTRY.size
+        return self._buffer[start:start + KEY_SIZE]
+
+
+class Catalog:
+    """One language's memory-mapped catalog."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.count = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a version {VERSION} translation catalog")
+        self._keys = _Keys(self._map, self.count)
+        self._blob = _HEADER.size + self.count * _ENTRY.size
+
+    def get(self, text: str) -> str | None:
+        key = catalog_key(text)
+        index = bisect.bisect_left(self._keys, key)
+        if index == self.count or self._keys[index] != key:
+            return None
+        _, offset, length = _ENTRY.unpack_from(self._map, _HEADER.size + index * _ENTRY.size)
+        start = self._blob + offset
+        return str(self._map[start:start + length], 'utf-8')
+
+    def close(self) -> None:
+        self._map.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class CatalogSet:
+    """The catalogs of every language, looked up by (text, lang). Empty until load() is called."""
+
+    def __init__(self):
+        self._catalogs = {}  # lang -> Catalog
+        self._lock = threading.Lock()
+
+    def load(self, directory: str = CATALOG_DIR) -> None:
+        """Maps every '<lang>.cat' in `directory`, replacing the catalogs mapped before."""
+        catalogs = {}
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith('.cat'):
+                    continue
+                try:
+                    catalogs[name[:-len('.cat')]] = Catalog(os.path.join(directory, name))
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Skipping translation catalog '{name}': {e}")
+        with self._lock:
+            old, self._catalogs = self._catalogs, catalogs
+        for catalog in old.values():
+            catalog.close()
+        if catalogs:
+            logging.info(f"Loaded translation catalogs: "
+                         f"{', '.join(f'{lang} ({len(c)})' for lang, c in catalogs.items())}")
+        else:
+            logging.info(f"No translation catalogs in '{directory}', translating live.")
+
+    def get(self, text: str, lang: str) -> str | None:
+        catalog = self._catalogs.get(lang)
+        return catalog.get(text) if catalog is not None else None
+
+
+# --- Building ---
+
+def write_catalog(path: str, translations: dict[str, str]) -> None:
+    """
+    Writes {English text: translation} as a catalog file.
+    The file is written next to `path` and renamed over it, so processes
+    that still map the old file keep reading it unchanged.
+    """
+    entries = sorted((catalog_key(text), translated.encode('utf-8'))
+                     for text, translated in translations.items())
+    index, blob = [], bytearray()
+    for key, data in entries:
+        index.append(_ENTRY.pack(key, len(blob), len(data)))
+        blob += data
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, len(entries)))
+        f.writelines(index)
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def source_texts() -> list[str]:
+    """Every string the bot sends through the translator, exactly as it sends it."""
+    from bot import menu_registry
+    return menu_registry.source_texts()
+
+
+def build(langs: list[str], directory: str = CATALOG_DIR) -> None:
+    """Translates every source text to each of `langs` and writes their catalogs."""
+    import translation
+
+    texts = source_texts()
+    segments = translation.unique_segments(texts)  # long texts are looked up paragraph by paragraph
+    os.makedirs(directory, exist_ok=True)
+    for lang in langs:
+        if lang == 'en':
+            continue  # English is the source, never translated
+        translated = translation.translate_batch(texts, lang)
+        missing = len(segments) - len(translated)
+        write_catalog(catalog_path(directory, lang), translated)
+        print(f"{lang}: {len(translated)} segments"
+              + (f", {missing} left to the live translator" if missing else ""))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Builds the compiled translation catalogs.")
+    parser.add_argument('--lang', nargs='+', help="languages to build (default: every supported language)")
+    parser.add_argument('--out', default=CATALOG_DIR, help="output directory (default: CATALOG_DIR)")
+    args = parser.parse_args()
+
+    from bot import SUPPORTED_LANGUAGES
+    unknown = set(args.lang or ()) - set(SUPPORTED_LANGUAGES)
+    if unknown:
+        sys.exit(f"Unsupported languages: {', '.join(sorted(unknown))}")
+    build(args.lang or SUPPORTED_LANGUAGES, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import NamedTuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import translation
+
+
+class MenuButton(NamedTuple):
+    """One button of a menu layout. The label is English source text."""
+    label: str
+    callback_data: str | None = None
+    url: str | None = None
+    translate: bool = True  # False for labels shown as-is, like language names
+
+
+class Menu(NamedTuple):
+    """
+    A ready-to-send menu: translated text plus its (immutable) keyboard.
+    For template menus the text still holds its {placeholders}.
+    """
+    text: str | None
+    reply_markup: InlineKeyboardMarkup | None
+
+
+class MenuRegistry:
+    """
+    Holds the static menu layouts and builds each one once per language.
+    Built menus are cached, so a callback that shows a static menu does no
+    translation work and allocates nothing new.
+    """
+
+    def __init__(self):
+        self._layouts = {}   # name -> (text, rows, template)
+        self._built = {}     # (name, lang) -> Menu
+        self._building = {}  # (name, lang) -> Task, so concurrent first renders share one build
+
+    def register(self, name: str, text: str | None, rows: list[list[MenuButton]] = (),
+                 template: bool = False) -> None:
+        """
+        Registers a layout. `text` may be None for keyboard-only menus.
+        With template=True the text is a str.format template whose
+        placeholders are protected during translation and filled in by the caller.
+        """
+        self._layouts[name] = (text, [list(row) for row in rows], template)
+        # Drop anything built from an older layout with the same name
+        for key in [key for key in self._built if key[0] == name]:
+            del self._built[key]
+
+    async def get(self, name: str, lang: str) -> Menu:
+        """Returns the cached menu for `lang`, building it on first use."""
+        key = (name, lang)
+        menu = self._built.get(key)
+        if menu is not None:
+            return menu
+
+        task = self._building.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._build(name, lang))
+            self._building[key] = task
+            task.add_done_callback(lambda _: self._building.pop(key, None))
+        return await task
+
+    def source_texts(self) -> list[str]:
+        """
+        Every string _build() translates, as the translator receives it
+        (templates with their placeholders protected), without duplicates.
+        """
+        texts = []
+        for text, rows, template in self._layouts.values():
+            if text:
+                texts.append(translation.protect_placeholders(text)[0] if template else text)
+            texts += [button.label for row in rows for button in row if button.translate]
+        return list(dict.fromkeys(texts))
+
+    async def prebuild(self, langs: list[str]) -> None:
+        """Builds every registered menu for every language in `langs`."""
+        for lang in langs:
+            for name in list(self._layouts):
+                try:
+                    await self.get(name, lang)
+                except Exception as e:
+                    logging.error(f"Prebuilding menu '{name}' for lang '{lang}' failed: {e}")
+
+    async def _build(self, name: str, lang: str) -> Menu:
+        text, rows, template = self._layouts[name]
+
+        # Collect every string of the menu and translate them in one batch
+        source_text, names = (translation.protect_placeholders(text) if template and text
+                              else (text, []))
+        sources = [source_text] if text else []
+        sources += [button.label for row in rows for button in row if button.translate]
+        translated, complete = await translation.translate_all(sources, lang)
+        labels = iter(translated)
+
+        menu_text = next(labels) if text else None
+        if names:
+            menu_text = translation.restore_placeholders(menu_text, names)
+            if menu_text is None:
+                logging.warning(f"Placeholders were mangled translating menu '{name}' to lang '{lang}', "
+                                f"using the English template.")
+                menu_text = text
+        keyboard = [
+            [
+                InlineKeyboardButton(
+                    next(labels) if button.translate else button.label,
+                    callback_data=button.callback_data,
+                    url=button.url
+                )
+                for button in row
+            ]
+            for row in rows
+        ]
+        menu = Menu(menu_text, InlineKeyboardMarkup(keyboard) if keyboard else None)
+
+        # Only cache complete translations, so a translator timeout isn't frozen in as English
+        if complete:
+            self._built[(name, lang)] = menu
+        return menu
+
+
+menu_registry = MenuRegistry()
+
+
+class RenderCache:
+    """
+    Remembers a digest of the text and keyboard each message currently shows,
+    so an edit that would change nothing is skipped instead of sent (Telegram
+    would only answer "message is not modified").
+    Keys are (chat_id, message_id), or the inline_message_id for inline messages.
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self._digests = translation.LRUCache(maxsize)
+
+    @staticmethod
+    def digest(text: str, reply_markup: InlineKeyboardMarkup | None) -> bytes:
+        markup = json.dumps(reply_markup.to_dict(), sort_keys=True) if reply_markup else ''
+        return hashlib.blake2b(f"{text}\0{markup}".encode(), digest_size=16).digest()
+
+    def is_current(self, key, text: str, reply_markup: InlineKeyboardMarkup | None) -> bool:
+        """True if the message `key` already shows exactly this text and keyboard."""
+        return self._digests.get(key) == self.digest(text, reply_markup)
+
+    def remember(self, key, text: str, reply_markup: InlineKeyboardMarkup | None) -> None:
+        self._digests.set(key, self.digest(text, reply_markup))
+
+
+render_cache = RenderCache()
@@ -0,0 +1,332 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telegram.request import HTTPXRequest
+
+# --- Metrics ---
+# Per-process latency of updates (by route), SQL statements per update, CRUD
+# calls, translation and Bot API calls. Served as Prometheus text on
+# METRICS_PORT (needs aiohttp; worker i of webhook.py uses METRICS_PORT + i)
+# and/or logged every METRICS_LOG_INTERVAL seconds. Both are off by default.
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))                  # 0 disables the HTTP endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "0"))  # seconds, 0 disables the log summary
+ENABLED = bool(METRICS_PORT or METRICS_LOG_INTERVAL)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """A Prometheus counter with one optional label."""
+
+    def __init__(self, name: str, help: str, label: str | None = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value=None, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_value, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+                labels = f'{{{self.label}="{_escape(label_value)}"}}' if self.label else ''
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Histogram:
+    """A Prometheus histogram with one optional label, one series per label value."""
+
+    def __init__(self, name: str, help: str, label: str | None = None, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value: float) -> None:
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def summary(self) -> dict:
+        """Returns {label value: (count, mean, p95 bucket bound)}."""
+        result = {}
+        with self._lock:
+            for label_value, series in self._series.items():
+                counts = series[:-1]
+                total = sum(counts)
+                seen, p95 = 0, float('inf')
+                for bound, count in zip(self.buckets, counts):
+                    seen += count
+                    if seen >= 0.95 * total:
+                        p95 = bound
+                        break
+                result[label_value] = (total, series[-1] / total, p95)
+        return result
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items(), key=lambda item: str(item[0])):
+                label = f'{self.label}="{_escape(label_value)}",' if self.label else ''
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label}le="{bound}"}} {cumulative}')
+                cumulative += series[-2]
+                lines.append(f'{self.name}_bucket{{{label}le="+Inf"}} {cumulative}')
+                labels = f'{{{label[:-1]}}}' if label else ''
+                lines.append(f"{self.name}_sum{labels} {series[-1]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+update_seconds = Histogram('tgbot_update_seconds', "Time to handle one update.", 'route')
+update_sql_statements = Histogram('tgbot_update_sql_statements', "SQL statements executed while handling one update.",
+                                  'route', COUNT_BUCKETS)
+sql_statements = Counter('tgbot_sql_statements_total', "SQL statements executed.")
+db_call_seconds = Histogram('tgbot_db_call_seconds', "Time spent in a botcontrol/async_botcontrol function.", 'function')
+translate_seconds = Histogram('tgbot_translate_seconds', "Time spent in a translation function.", 'function')
+translator_request_seconds = Histogram('tgbot_translator_request_seconds', "Time of one request to the translator.")
+bot_api_seconds = Histogram('tgbot_bot_api_seconds', "Time of one outbound Bot API call.", 'method')
+bot_api_errors = Counter('tgbot_bot_api_errors_total', "Bot API calls that failed or returned an error status.", 'method')
+callbacks_debounced = Counter('tgbot_callbacks_debounced_total', "Repeated button presses answered without handling.")
+edits_skipped = Counter('tgbot_edits_skipped_total', "Message edits skipped because the message already showed the same content.")
+
+HISTOGRAMS = (update_seconds, update_sql_statements, db_call_seconds, translate_seconds,
+              translator_request_seconds, bot_api_seconds)
+COUNTERS = (sql_statements, bot_api_errors, callbacks_debounced, edits_skipped)
+
+
+# --- Per-update Tracking ---
+
+# A one-item list per update in flight, so SQL run in greenlets and worker threads still counts
+_update_statements = contextvars.ContextVar('update_statements', default=None)
+
+
+@asynccontextmanager
+async def track(route: str):
+    """Times the update handled inside the block and counts its SQL statements."""
+    statements = [0]
+    token = _update_statements.set(statements)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        update_seconds.observe(route, time.perf_counter() - started)
+        update_sql_statements.observe(route, statements[0])
+        _update_statements.reset(token)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    sql_statements.inc()
+    statements = _update_statements.get()
+    if statements is not None:
+        statements[0] += 1
+
+
+# --- Instrumentation ---
+
+def _timed(fn, histogram: Histogram, label: str):
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(label, time.perf_counter() - started)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(label, time.perf_counter() - started)
+    return wrapper
+
+
+def instrument_crud(module) -> None:
+    """
+    Times every CRUD function of a module, i.e. its public functions taking
+    `db` first. Generators (iter_*, stream) are left alone: their time is
+    mostly the caller's.
+    """
+    for name, fn in list(vars(module).items()):
+        if (name.startswith('_') or not inspect.isfunction(fn) or fn.__module__ != module.__name__
+                or inspect.isgeneratorfunction(fn) or inspect.isasyncgenfunction(fn)):
+            continue
+        if list(inspect.signature(fn).parameters)[:1] == ['db']:
+            setattr(module, name, _timed(fn, db_call_seconds, f"{module.__name__}.{name}"))
+
+
+def _timed_translator(translator_class):
+    class TimedTranslator(translator_class):
+        def translate(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return super().translate(*args, **kwargs)
+            finally:
+                translator_request_seconds.observe(None, time.perf_counter() - started)
+    TimedTranslator.__name__ = f"Timed{translator_class.__name__}"
+    return TimedTranslator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call by method."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            bot_api_errors.inc(api_method)
+            raise
+        finally:
+            bot_api_seconds.observe(api_method, time.perf_counter() - started)
+        if status >= 400:
+            bot_api_errors.inc(api_method)
+        return status, payload
+
+
+_installed = False
+
+
+def install() -> None:
+    """Hooks the metrics into SQLAlchemy, the CRUD modules and the translator. Idempotent."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    # Imported here so importing metrics (e.g. from a script) doesn't load the bot's modules
+    import async_botcontrol
+    import botcontrol
+    import translation
+
+    event.listen(Engine, 'before_cursor_execute', _count_statement)
+    instrument_crud(botcontrol)
+    instrument_crud(async_botcontrol)
+    for name in ('translate', 'translate_async', 'translate_all', 'translate_many'):
+        setattr(translation, name, _timed(getattr(translation, name), translate_seconds, name))
+    translation.GoogleTranslator = _timed_translator(translation.GoogleTranslator)
+
+
+# --- Export ---
+
+def _gauges() -> list[str]:
+    import db_models
+    import translation
+    from profile_cache import profile_cache
+
+    values = [
+        ('tgbot_translation_catalog_hits', "Translations served from a compiled catalog.",
+         translation.translation_cache.catalog_hits),
+        ('tgbot_translation_cache_hits', "Translations served from memory.", translation.translation_cache.hits),
+        ('tgbot_translation_cache_store_hits', "Translations served from the database.",
+         translation.translation_cache.store_hits),
+        ('tgbot_translation_cache_misses', "Translations that needed the translator.",
+         translation.translation_cache.misses),
+        ('tgbot_translation_cache_hit_ratio', "Translation cache hit rate.",
+         translation.translation_cache.stats()['hit_rate']),
+        ('tgbot_profile_cache_hit_ratio', "User profile cache hit rate.", profile_cache.stats()['hit_rate']),
+    ]
+    lines = []
+    for name, help, value in values:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+    pools = db_models.pool_stats()
+    for key in ('checkouts', 'timeouts', 'connects', 'invalidations', 'wait_seconds_total', 'saturation'):
+        lines.append(f"# TYPE tgbot_db_pool_{key} gauge")
+        for engine, stats in pools.items():
+            if key in stats:
+                lines.append(f'tgbot_db_pool_{key}{{engine="{engine}"}} {stats[key]}')
+    return lines
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in HISTOGRAMS + COUNTERS:
+        lines += metric.render()
+    lines += _gauges()
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> str:
+    """A short human-readable summary of the busiest routes and of the dependencies."""
+    statements = update_sql_statements.summary()
+    lines = ["Metrics summary:"]
+    routes = sorted(update_seconds.summary().items(), key=lambda item: item[1][0], reverse=True)
+    for route, (count, mean, p95) in routes[:10]:
+        sql = statements.get(route, (0, 0.0, 0))[1]
+        lines.append(f"  {route}: {count} updates, avg {mean * 1000:.1f} ms, p95 <= {p95 * 1000:.0f} ms, "
+                     f"{sql:.1f} SQL/update")
+    for label, histogram in (('db', db_call_seconds), ('bot api', bot_api_seconds)):
+        calls = histogram.summary()
+        total = sum(count for count, _, _ in calls.values())
+        if total:
+            mean = sum(count * mean for count, mean, _ in calls.values()) / total
+            lines.append(f"  {label}: {total} calls, avg {mean * 1000:.1f} ms")
+    from translation import translation_cache
+    requests = translator_request_seconds.summary().get(None)
+    lines.append(f"  translation: hit rate {translation_cache.stats()['hit_rate']:.1%}, "
+                 f"{requests[0] if requests else 0} translator requests")
+    return '\n'.join(lines)
+
+
+async def _log_summary_forever(interval: int) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(summary())
+
+
+async def start_server(port: int, host: str = METRICS_HOST):
+    """Serves render() on http://host:port/metrics. Returns the aiohttp AppRunner."""
+    from aiohttp import web  # optional dependency, only needed for the endpoint
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(body=render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    return runner
+
+
+async def start(application) -> None:
+    """Starts the endpoint and the log summary configured in the environment (from post_init)."""
+    if METRICS_PORT:
+        await start_server(METRICS_PORT)
+    if METRICS_LOG_INTERVAL:
+        application.create_task(_log_summary_forever(METRICS_LOG_INTERVAL))
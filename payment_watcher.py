@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from broadcast import Broadcaster
+from db_models import AsyncSessionLocal
+import async_botcontrol
+
+# --- Payment Watcher ---
+# A JobQueue job asks the payment provider about the pending deposits due for
+# a check, one call per keyset page. Paid ones are marked paid together with
+# an outbox row ('payment_notification') that the sender deletes once the
+# user is notified; unpaid ones are checked again after a doubling delay.
+
+PAYMENT_POLL_INTERVAL = int(os.getenv("PAYMENT_POLL_INTERVAL", "30"))  # seconds between two runs, and the first backoff
+PAYMENT_MAX_BACKOFF = int(os.getenv("PAYMENT_MAX_BACKOFF", "3600"))    # longest wait between two checks of a deposit
+PAYMENT_BATCH_SIZE = 100  # deposits per page, and per provider call
+
+
+class PaymentProvider(ABC):
+    """The payment processor's side of the watcher."""
+
+    @abstractmethod
+    async def paid_orders(self, order_ids: list[str]) -> set[str]:
+        """Returns the ids among `order_ids` whose payment was received. One API call per page."""
+
+
+class StubPaymentProvider(PaymentProvider):
+    """Answers from memory: an order is paid once pay() was called for it."""
+
+    def __init__(self):
+        self.paid = set()
+        self.calls = 0
+
+    def pay(self, order_id: str) -> None:
+        self.paid.add(order_id)
+
+    async def paid_orders(self, order_ids: list[str]) -> set[str]:
+        self.calls += 1
+        return self.paid.intersection(order_ids)
+
+
+def backoff(attempts: int, interval: float = PAYMENT_POLL_INTERVAL,
+            max_backoff: float = PAYMENT_MAX_BACKOFF) -> float:
+    """Seconds to wait after the unpaid check number `attempts` + 1."""
+    return min(max_backoff, interval * 2 ** min(attempts, 32))
+
+
+class PaymentWatcher:
+    """
+    Polls `provider` for the pending deposits and notifies their owners.
+    `render(row)` returns the (text, reply_markup) of the notification for a
+    deposit row (id, user_id, amount, coin, language_code).
+    """
+
+    def __init__(self, provider: PaymentProvider, render, session_factory=AsyncSessionLocal,
+                 batch_size: int = PAYMENT_BATCH_SIZE, interval: float = PAYMENT_POLL_INTERVAL,
+                 max_backoff: float = PAYMENT_MAX_BACKOFF):
+        self.provider = provider
+        self.render = render
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._outbox = asyncio.Event()  # set when the outbox may hold something to send
+        self._sender = None
+        self._sender_task = None
+
+    async def poll(self) -> int:
+        """Checks every deposit due now, page by page. Returns the number of deposits marked paid."""
+        now = datetime.now(timezone.utc)
+        after_id, claimed = 0, 0
+        while True:
+            async with self.session_factory() as db:
+                page = await async_botcontrol.get_due_deposits(db, now, after_id, self.batch_size)
+            if not page:
+                return claimed
+            after_id = page[-1].id
+
+            # A provider error leaves the page due, so it is asked about again on the next run
+            paid = await self.provider.paid_orders([row.order_id for row in page])
+            unpaid = defaultdict(list)  # check_attempts -> deposit ids
+            for row in page:
+                if row.order_id not in paid:
+                    unpaid[row.check_attempts].append(row.id)
+            schedule = [(ids, attempts, now + timedelta(seconds=backoff(attempts, self.interval, self.max_backoff)))
+                        for attempts, ids in unpaid.items()]
+            async with self.session_factory() as db:
+                newly_paid = await async_botcontrol.claim_paid_deposits(db, list(paid))
+                await async_botcontrol.postpone_deposit_checks(db, schedule)
+            if newly_paid:
+                claimed += newly_paid
+                self._outbox.set()
+            if len(page) < self.batch_size:
+                return claimed
+
+    async def send_notifications(self) -> int:
+        """
+        Sends everything in the outbox, page by page, deleting each row once
+        its message went out (or Telegram refused it for good). Returns the
+        number of messages sent. A crash between a send and its delete sends
+        that message again on the next run.
+        """
+        after_id, sent = 0, 0
+        while True:
+            async with self.session_factory() as db:
+                page = await async_botcontrol.get_payment_notifications(db, after_id, self.batch_size)
+            if not page:
+                return sent
+            after_id = page[-1].id
+            results = await asyncio.gather(*(self._notify(row) for row in page))
+            async with self.session_factory() as db:
+                await async_botcontrol.delete_payment_notifications(
+                    db, [row.id for row, result in zip(page, results) if result is not None])
+            sent += sum(1 for result in results if result)
+
+    async def _notify(self, row) -> bool | None:
+        """True if sent, False if Telegram refused it, None to keep it for the next run."""
+        try:
+            text, reply_markup = await self.render(row)
+            return await self._sender.send(row.user_id, text, reply_markup=reply_markup)
+        except Exception as e:
+            logging.error(f"Notifying user {row.user_id} of deposit {row.id} failed: {e}")
+            return None
+
+    async def _send_loop(self) -> None:
+        while True:
+            await self._outbox.wait()
+            self._outbox.clear()
+            try:
+                await self.send_notifications()
+            except Exception as e:
+                logging.error(f"Sending payment notifications failed, retrying on the next run: {e}")
+
+    def start_sender(self, bot) -> None:
+        """Starts sending the outbox through `bot`, within Telegram's rate limits."""
+        if self._sender_task is None or self._sender_task.done():
+            self._sender = Broadcaster(bot, session_factory=self.session_factory)
+            self._sender_task = asyncio.create_task(self._send_loop())
+
+    async def job(self, context) -> None:
+        """The JobQueue callback."""
+        self.start_sender(context.bot)
+        self._outbox.set()  # also picks up what a failed run or a restart left behind
+        try:
+            paid = await self.poll()
+        except Exception as e:
+            logging.error(f"Payment check failed, retrying in {self.interval} s: {e}")
+            return
+        if paid:
+            logging.info(f"Payment watcher marked {paid} deposits paid.")
+
+    def schedule(self, application) -> None:
+        """Runs job() every `interval` seconds on the application's JobQueue."""
+        if application.job_queue is None:
+            logging.warning("No JobQueue (pip install \"python-telegram-bot[job-queue]\"), "
+                            "pending deposits won't be checked.")
+            return
+        application.job_queue.run_repeating(self.job, interval=self.interval, first=10,
+                                            name='payment_watcher')
@@ -0,0 +1,245 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_botcontrol
+from db_models import AsyncSessionLocal, BotState, to_async_url
+
+# --- Persistence ---
+# user_data / chat_data as one JSON row per user or chat in 'bot_state',
+# loaded on the first update of each, written with batched upserts every
+# PERSISTENCE_FLUSH_INTERVAL seconds, and dropped from memory (not from the
+# database) after PERSISTENCE_IDLE_SECONDS without an update. The state must
+# be JSON-serializable with string keys; transient_user_keys stay in memory.
+
+# Empty to keep the state in the bot's database, or another database URL,
+# e.g. "sqlite:///bot_state.db" for a local file (created on first start).
+PERSISTENCE_URL = os.getenv("PERSISTENCE_URL", "")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "10"))
+PERSISTENCE_IDLE_SECONDS = float(os.getenv("PERSISTENCE_IDLE_SECONDS", "3600"))
+FLUSH_BATCH_SIZE = 500  # rows per upsert
+
+
+class _StateTable:
+    """The in-memory side of one kind of state, 'user' or 'chat'."""
+
+    def __init__(self, kind: str, transient_keys=frozenset()):
+        self.kind = kind
+        self.transient_keys = transient_keys  # never written, nor loaded from older rows
+        self.live = {}             # key -> the dict the Application hands to the handlers
+        self.seen = OrderedDict()  # key -> time.monotonic() of its last update, least recent first
+        self.pending = {}          # key -> JSON data waiting for the next flush
+        self.deleted = set()       # keys to delete on the next flush
+        self.evicted = set()       # keys dropped from memory, whose Application.drop_*_data is still to come
+        self.empty = set()         # keys with no stored state, so an empty dict needs no write
+        self.unloaded = set()      # keys whose load failed: not written until a load succeeds
+
+
+class SQLPersistence(BasePersistence):
+    """Lazily loaded, write-batched user and chat data. See the header above."""
+
+    def __init__(self, session_factory=None, flush_interval: float = PERSISTENCE_FLUSH_INTERVAL,
+                 idle_seconds: float = PERSISTENCE_IDLE_SECONDS, transient_user_keys=(),
+                 chat_data: bool = False):
+        # chat_data is off by default: the bot doesn't use it, and every cold
+        # chat would cost a SELECT on its first update
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=chat_data, callback_data=False),
+                         update_interval=flush_interval)
+        self.session_factory = session_factory
+        self.idle_seconds = idle_seconds
+        self.transient_user_keys = frozenset(transient_user_keys)
+        self.application = None
+        self._users = _StateTable('user', self.transient_user_keys)
+        self._chats = _StateTable('chat')
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._last_eviction = time.monotonic()
+
+    def attach(self, application) -> None:
+        """Lets the persistence evict idle users and chats from `application`."""
+        self.application = application
+
+    async def _open(self) -> None:
+        if self.session_factory is not None:
+            return
+        if PERSISTENCE_URL:
+            engine = create_async_engine(to_async_url(PERSISTENCE_URL))
+            async with engine.begin() as conn:
+                await conn.run_sync(BotState.__table__.create, checkfirst=True)
+            self.session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        else:
+            self.session_factory = AsyncSessionLocal
+
+    # --- Loading ---
+
+    async def get_user_data(self) -> dict:
+        await self._open()
+        return {}  # loaded per user, see refresh_user_data()
+
+    async def get_chat_data(self) -> dict:
+        await self._open()
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._load(self._users, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._load(self._chats, chat_id, chat_data)
+
+    async def _load(self, table: _StateTable, key: int, data: dict) -> None:
+        """Runs before every update: fills `data` on the first one, and marks the key as active."""
+        now = time.monotonic()
+        table.seen[key] = now
+        table.seen.move_to_end(key)
+        if now - self._last_eviction >= self.update_interval:
+            self._last_eviction = now
+            self._evict_idle()
+        if table.live.get(key) is data:
+            return
+
+        stored = table.pending.get(key)
+        if stored is None and key not in table.deleted:
+            try:
+                async with self.session_factory() as db:
+                    stored = await async_botcontrol.get_bot_state(db, table.kind, key)
+            except Exception as e:
+                # Handle the update without the stored state, and try again on the next one.
+                # Until then its in-memory dict is partial and must not overwrite the stored row.
+                logging.warning(f"Loading the {table.kind} state of {key} failed: {e}")
+                table.unloaded.add(key)
+                return
+        table.unloaded.discard(key)
+        table.live[key] = data
+        if stored is None:
+            table.empty.add(key)
+        else:
+            for name, value in json.loads(stored).items():
+                if name not in table.transient_keys:
+                    data.setdefault(name, value)  # anything set while loading is newer
+
+    # --- Writing ---
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(self._users, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._stage(self._chats, chat_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop(self._users, user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop(self._chats, chat_id)
+
+    def _stage(self, table: _StateTable, key: int, data: dict) -> None:
+        if table.transient_keys:
+            data = {name: value for name, value in data.items() if name not in table.transient_keys}
+        if key in table.unloaded:
+            return  # would replace the stored state with a partial one
+        if not data and key in table.empty:
+            return  # e.g. the chat_data of every private chat, never used
+        try:
+            table.pending[key] = json.dumps(data)
+        except (TypeError, ValueError) as e:
+            logging.warning(f"The {table.kind} state of {key} is not JSON-serializable, not saving it: {e}")
+            return
+        table.deleted.discard(key)
+        if data:
+            table.empty.discard(key)
+        self._schedule_flush()
+
+    def _drop(self, table: _StateTable, key: int) -> None:
+        if key in table.evicted:
+            # Our own eviction, not a deletion. If the user came back since, the
+            # Application skipped their latest changes in favor of this drop.
+            table.evicted.discard(key)
+            if key in table.live:
+                self._stage(table, key, table.live[key])
+            return
+        table.live.pop(key, None)
+        table.seen.pop(key, None)
+        table.pending.pop(key, None)
+        table.empty.discard(key)
+        table.unloaded.discard(key)
+        table.deleted.add(key)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        # The Application stages every change of an interval at once, so the
+        # task starts after all of them and writes them together
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_pending())
+
+    async def _flush_pending(self) -> None:
+        async with self._flush_lock:
+            for table in (self._users, self._chats):
+                while table.pending or table.deleted:
+                    rows = dict(itertools.islice(table.pending.items(), FLUSH_BATCH_SIZE))
+                    for key in rows:
+                        del table.pending[key]
+                    deleted, table.deleted = list(table.deleted), set()
+                    try:
+                        async with self.session_factory() as db:
+                            await async_botcontrol.save_bot_states(db, table.kind, rows)
+                            await async_botcontrol.delete_bot_states(db, table.kind, deleted)
+                    except Exception as e:
+                        logging.error(f"Saving {len(rows)} {table.kind} states failed, "
+                                      f"retrying on the next flush: {e}")
+                        for key, data in rows.items():
+                            table.pending.setdefault(key, data)  # anything staged since is newer
+                        table.deleted.update(key for key in deleted if key not in table.pending)
+                        return
+
+    def _evict_idle(self) -> None:
+        """Drops users and chats idle for idle_seconds from memory. Their state stays in the database."""
+        if self.application is None:
+            return
+        deadline = time.monotonic() - self.idle_seconds
+        for table, drop in ((self._users, self.application.drop_user_data),
+                            (self._chats, self.application.drop_chat_data)):
+            while table.seen:
+                key, seen = next(iter(table.seen.items()))
+                if seen > deadline or key in table.pending:
+                    break
+                del table.seen[key]
+                table.live.pop(key, None)
+                table.empty.discard(key)
+                table.unloaded.discard(key)
+                table.evicted.add(key)
+                drop(key)
+
+    async def flush(self) -> None:
+        """Writes everything still pending. Called by the Application on shutdown."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_pending()
+
+    # --- Not Persisted ---
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
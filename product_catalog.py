@@ -0,0 +1,66 @@
+import asyncio
+import time
+from typing import NamedTuple
+
+# --- Product Catalog ---
+# The products screen pages through an in-memory snapshot of the 'products'
+# table instead of loading the table on every view. create_product()
+# invalidates the snapshot; the TTL picks up products added by another
+# process (an admin script, another webhook worker).
+
+CATALOG_TTL = 10 * 60  # seconds before the snapshot is reloaded anyway
+
+
+class ProductView(NamedTuple):
+    """An immutable copy of one products row."""
+    id: int
+    name: str
+    text: str | None
+    image: str | None
+    url: str | None
+    file_id: str | None  # Telegram's id of the uploaded image, once it was sent
+
+    @classmethod
+    def from_model(cls, product) -> 'ProductView':
+        return cls(product.id, product.name, product.text, product.image, product.url, product.file_id)
+
+
+class ProductCatalog:
+    """
+    Snapshot of every product, in id order, loaded on first use.
+    File ids learnt after the snapshot was taken are kept on the side, so
+    the second view of a product already resends its image by id.
+    """
+
+    def __init__(self, ttl: int = CATALOG_TTL):
+        self.ttl = ttl
+        self._products = None  # tuple[ProductView, ...], None until loaded or after invalidate()
+        self._loaded_at = 0.0
+        self._file_ids = {}    # product id -> file_id
+        self._lock = asyncio.Lock()
+
+    async def get(self, load) -> tuple[ProductView, ...]:
+        """Returns the snapshot, reloading it with `await load()` (the Product rows) if needed."""
+        if self._is_fresh():
+            return self._products
+        async with self._lock:  # one reload, however many users open the screen at once
+            if not self._is_fresh():
+                self._products = tuple(ProductView.from_model(product) for product in await load())
+                self._loaded_at = time.monotonic()
+                self._file_ids.clear()  # now part of the snapshot
+            return self._products
+
+    def _is_fresh(self) -> bool:
+        return self._products is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def invalidate(self) -> None:
+        self._products = None
+
+    def file_id(self, product: ProductView) -> str | None:
+        return self._file_ids.get(product.id) or product.file_id
+
+    def remember_file_id(self, product_id: int, file_id: str) -> None:
+        self._file_ids[product_id] = file_id
+
+
+product_catalog = ProductCatalog()
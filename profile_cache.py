@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# --- User Profile Cache ---
+# Sits between get_user_language() and the users table so restarts and extra
+# workers don't all hit get_user_by_telegram_id at once. The backend is
+# pluggable: a bounded in-process LRU with TTL (default), or any Redis-protocol
+# server shared by every worker.
+
+PROFILE_TTL = 6 * 60 * 60  # seconds a cached profile stays valid
+
+
+class LRUTTLBackend:
+    """Bounded, thread-safe in-process LRU whose entries expire after a TTL."""
+
+    blocking = False  # cheap enough to call on the event loop
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: int) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisBackend:
+    """
+    Stores profiles as JSON in a Redis-protocol server.
+    `client` is anything with redis-py's get/set/delete, e.g. redis.Redis
+    or fakeredis.FakeRedis for local testing.
+    """
+
+    blocking = True  # network round trip, keep it off the event loop
+
+    def __init__(self, client, prefix: str = 'tgbot:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> 'RedisBackend':
+        """Connects with redis-py (an optional dependency, only needed for this backend)."""
+        import redis
+        return cls(redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5), **kwargs)
+
+    def get(self, key: str):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value, ttl: int) -> None:
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+
+class ProfileCache:
+    """
+    Caches small per-user profile dicts (e.g. {'language_code': 'es'}) by telegram_id.
+    Backend errors are logged and treated as misses, the database stays the source of truth.
+    """
+
+    def __init__(self, backend=None, ttl: int = PROFILE_TTL):
+        self.backend = backend or LRUTTLBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(telegram_id: int) -> str:
+        return f"profile:{telegram_id}"
+
+    def get(self, telegram_id: int) -> dict | None:
+        try:
+            profile = self.backend.get(self._key(telegram_id))
+        except Exception as e:
+            logging.warning(f"Profile cache lookup failed for user {telegram_id}: {e}")
+            profile = None
+        if profile is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return profile
+
+    def set(self, telegram_id: int, profile: dict) -> None:
+        try:
+            self.backend.set(self._key(telegram_id), profile, self.ttl)
+        except Exception as e:
+            logging.warning(f"Profile cache write failed for user {telegram_id}: {e}")
+
+    def invalidate(self, telegram_id: int) -> None:
+        """Drops a user's cached profile. Call after changing or deleting the user."""
+        self.invalidations += 1
+        try:
+            self.backend.delete(self._key(telegram_id))
+        except Exception as e:
+            logging.warning(f"Profile cache invalidation failed for user {telegram_id}: {e}")
+
+    # Async variants for handlers: blocking backends run in a worker thread.
+
+    async def get_async(self, telegram_id: int) -> dict | None:
+        if self.backend.blocking:
+            return await asyncio.to_thread(self.get, telegram_id)
+        return self.get(telegram_id)
+
+    async def set_async(self, telegram_id: int, profile: dict) -> None:
+        if self.backend.blocking:
+            await asyncio.to_thread(self.set, telegram_id, profile)
+        else:
+            self.set(telegram_id, profile)
+
+    async def invalidate_async(self, telegram_id: int) -> None:
+        if self.backend.blocking:
+            await asyncio.to_thread(self.invalidate, telegram_id)
+        else:
+            self.invalidate(telegram_id)
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+
+profile_cache = ProfileCache()
+
+
+def configure(backend, ttl: int = PROFILE_TTL) -> None:
+    """Swaps the backend of the shared profile_cache, e.g. configure(RedisBackend.from_url(url))."""
+    profile_cache.backend = backend
+    profile_cache.ttl = ttl
@@ -0,0 +1,115 @@
+import logging
+import time
+from typing import Awaitable, Callable, NamedTuple
+
+# A route handler gets (update, context, lang, db). `db` is an AsyncSession
+# for routes declared with needs_db=True and None for all others.
+RouteHandler = Callable[..., Awaitable[None]]
+
+
+class Route(NamedTuple):
+    handler: RouteHandler
+    needs_db: bool
+
+
+class CallbackRouter:
+    """
+    Declarative dispatch of inline-button callback data.
+    Exact callback data is looked up in a dict (O(1) whatever the number of
+    screens), then a short table of prefixes such as 'set_lang_' is tried.
+    A database session is checked out of the pool only for routes that
+    declare needs_db=True.
+    """
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._exact = {}      # callback data -> Route
+        self._prefixes = []   # (prefix, Route), longest prefix first
+
+    def add(self, data: str, handler: RouteHandler, needs_db: bool = False, prefix: bool = False) -> None:
+        """Registers `handler` for callback data `data` (or every data starting with it if prefix=True)."""
+        route = Route(handler, needs_db)
+        if prefix:
+            self._prefixes.append((data, route))
+            self._prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        else:
+            self._exact[data] = route
+
+    def route(self, *data: str, needs_db: bool = False, prefix: bool = False):
+        """Decorator form of add(), for one or more callback data values."""
+        def decorator(handler: RouteHandler) -> RouteHandler:
+            for value in data:
+                self.add(value, handler, needs_db=needs_db, prefix=prefix)
+            return handler
+        return decorator
+
+    def _match(self, data: str) -> tuple[str, Route] | None:
+        route = self._exact.get(data)
+        if route is not None:
+            return data, route
+        for prefix, route in self._prefixes:
+            if data.startswith(prefix):
+                return prefix, route
+        return None
+
+    def resolve(self, data: str) -> Route | None:
+        match = self._match(data)
+        return match[1] if match else None
+
+    def label(self, data: str) -> str:
+        """Names the route `data` matches (the prefix for prefix routes), e.g. for metrics."""
+        match = self._match(data)
+        return match[0] if match else 'unknown'
+
+    async def dispatch(self, update, context, lang: str) -> bool:
+        """Runs the route for the update's callback data. Returns False if nothing matched."""
+        data = update.callback_query.data or ''
+        route = self.resolve(data)
+        if route is None:
+            logging.warning(f"No route for callback data '{data}'.")
+            return False
+        if route.needs_db:
+            async with self.session_factory() as db:
+                await route.handler(update, context, lang, db)
+        else:
+            await route.handler(update, context, lang, None)
+        return True
+
+
+class CallbackDebouncer:
+    """
+    Drops repeated presses of a button: a callback with the same user,
+    message and data as one still being handled, or handled less than
+    `window` seconds ago, adds nothing but another full render.
+    Only used from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, window: float = 1.0, maxsize: int = 10_000):
+        self.window = window
+        self.maxsize = maxsize
+        self._presses = {}  # key -> monotonic time it finished, None while in flight
+
+    @staticmethod
+    def key(query) -> tuple:
+        message = query.message.message_id if query.message else query.inline_message_id
+        return query.from_user.id, message, query.data
+
+    def begin(self, key) -> bool:
+        """Claims `key` for a new press. False if it's a duplicate to drop."""
+        now = time.monotonic()
+        if key in self._presses:
+            finished_at = self._presses[key]
+            if finished_at is None or now - finished_at < self.window:
+                return False
+        self._presses[key] = None
+        if len(self._presses) > self.maxsize:
+            self._purge(now)
+        return True
+
+    def end(self, key) -> None:
+        self._presses[key] = time.monotonic()
+
+    def _purge(self, now: float) -> None:
+        for key in [key for key, finished_at in self._presses.items()
+                    if finished_at is not None and now - finished_at >= self.window]:
+            del self._presses[key]
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import os
+import uuid
+
+from db_models import AsyncSessionLocal
+import async_botcontrol
+
+# --- Referral Settlement ---
+# A JobQueue job credits referrers with REFERRAL_BONUS_RATE of every newly
+# approved deposit of the users they referred, in batches (see
+# botcontrol.settle_referral_batch()). Run python settlement.py to settle now.
+
+REFERRAL_BONUS_RATE = float(os.getenv("REFERRAL_BONUS_RATE", "0.10"))  # share of the referred user's deposit
+SETTLEMENT_INTERVAL = int(os.getenv("SETTLEMENT_INTERVAL", "300"))     # seconds between two runs
+SETTLEMENT_BATCH_SIZE = 500  # deposits per transaction
+
+
+async def settle_referrals(session_factory=AsyncSessionLocal, rate: float = REFERRAL_BONUS_RATE,
+                           batch_size: int = SETTLEMENT_BATCH_SIZE) -> int:
+    """Settles every approved deposit not settled yet. Returns the number of bonuses credited."""
+    total = 0
+    while True:
+        async with session_factory() as db:
+            seen, settled = await async_botcontrol.settle_referral_batch(db, uuid.uuid4().hex, rate, batch_size)
+        total += settled
+        if seen < batch_size:
+            return total
+
+
+async def settlement_job(context) -> None:
+    """The JobQueue callback."""
+    try:
+        settled = await settle_referrals()
+    except Exception as e:
+        # A concurrent run that settled the same deposits first ends up here; nothing was credited twice
+        logging.error(f"Referral settlement failed, retrying in {SETTLEMENT_INTERVAL} s: {e}")
+        return
+    if settled:
+        logging.info(f"Referral settlement credited {settled} bonuses.")
+
+
+def schedule(application) -> None:
+    """Runs settlement_job every SETTLEMENT_INTERVAL seconds on the application's JobQueue."""
+    if application.job_queue is None:
+        logging.warning("No JobQueue (pip install \"python-telegram-bot[job-queue]\"), "
+                        "referral bonuses won't be settled.")
+        return
+    application.job_queue.run_repeating(settlement_job, interval=SETTLEMENT_INTERVAL, first=10,
+                                        name='referral_settlement')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(f"Credited {asyncio.run(settle_referrals())} referral bonuses.")
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db_models
+from db_models import User
+
+
+def _enforce_foreign_keys(engine) -> None:
+    # MySQL/InnoDB always enforces them; SQLite only when asked
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, _):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+
+@pytest.fixture
+def db():
+    """A sync Session on a fresh in-memory SQLite database."""
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={'check_same_thread': False})
+    _enforce_foreign_keys(engine)
+    db_models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def async_db():
+    """An AsyncSession factory on a fresh in-memory SQLite database."""
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    _enforce_foreign_keys(engine.sync_engine)
+
+    async def create():
+        async with engine.begin() as conn:
+            await conn.run_sync(db_models.Base.metadata.create_all)
+    asyncio.run(create())
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+
+def add_users(db, *telegram_ids, language_code='en') -> None:
+    for telegram_id in telegram_ids:
+        db.add(User(telegram_id=telegram_id, first_name='Test', language_code=language_code))
+    db.commit()
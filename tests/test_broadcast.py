@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+from telegram import Bot
+
+import async_botcontrol
+import broadcast
+import translation
+from db_models import User
+from benchmarks.fake_telegram import FakeBotAPI
+
+
+class StubTranslator:
+    """Tags the text with the target language, and fails for German."""
+
+    def __init__(self, source: str, target: str):
+        self.target = target
+
+    def translate(self, text: str) -> str:
+        if self.target == 'de':
+            raise ConnectionError("translator unavailable")
+        return f"[{self.target}] {text}"
+
+
+@pytest.fixture(autouse=True)
+def stub_translation(db, monkeypatch):
+    monkeypatch.setattr(translation, 'GoogleTranslator', StubTranslator)
+    monkeypatch.setattr(translation, 'translation_cache',
+                        translation.TranslationCache(session_factory=sessionmaker(bind=db.get_bind())))
+    monkeypatch.setattr(broadcast, 'TRANSLATE_ATTEMPTS', 1)
+
+
+def add_recipients(async_db, languages: list[str]) -> None:
+    """One user per language code, with telegram_id 100, 101, ..."""
+    async def add():
+        async with async_db() as db:
+            for i, lang in enumerate(languages):
+                db.add(User(telegram_id=100 + i, first_name='Test', language_code=lang))
+            await db.commit()
+    asyncio.run(add())
+
+
+def run_broadcast(async_db, setup=None, **options):
+    """Runs broadcast 'b1' against a fake Bot API. Returns (totals, api)."""
+    async def run():
+        api = FakeBotAPI()
+        await api.start()
+        if setup is not None:
+            await setup(api)
+        try:
+            async with Bot('1:fake', base_url=f"{api.url}/bot") as telegram_bot:
+                sender = broadcast.Broadcaster(telegram_bot, session_factory=async_db, **options)
+                return await sender.run('b1', "Hello"), api
+        finally:
+            await api.stop()
+    return asyncio.run(run())
+
+
+def test_sends_within_the_rate_and_waits_out_flood_control(async_db):
+    add_recipients(async_db, ['en'] * 25)
+
+    async def setup(api):
+        api.fail('sendMessage', 429, "Too Many Requests: retry after 1", retry_after=1)
+        api.blocked.add(105)
+
+    totals, api = run_broadcast(async_db, setup, rate=10, per_chat_interval=0, page_size=5)
+    assert totals == {'sent': 24, 'failed': 1}
+    assert set(api.sent()) == {100 + i for i in range(25)} - {105}
+
+    sends = [(int(params['chat_id']), at) for (method, params), at in zip(api.calls, api.call_times)
+             if method == 'sendMessage']
+    assert len(sends) == 26  # the first one again after the 429
+    throttled, retried = [at for chat_id, at in sends if chat_id == sends[0][0]]
+    assert retried - throttled >= 0.9  # waited out retry_after
+    sends = [at for _, at in sends]
+    # Never more than the bucket's capacity plus its rate within a second
+    for i, at in enumerate(sends):
+        assert sum(1 for other in sends[i:] if other - at < 1.0) <= 10 + 10
+
+
+def test_resumes_from_the_checkpoint(async_db):
+    add_recipients(async_db, ['es'] * 5)
+
+    async def checkpoint(api):
+        async with async_db() as db:
+            await async_botcontrol.save_broadcast_progress(db, 'b1', 'es', last_user_id=3, sent=3, failed=0)
+
+    totals, api = run_broadcast(async_db, checkpoint, per_chat_interval=0, page_size=2)
+    assert totals == {'sent': 5, 'failed': 0}
+    assert api.sent() == {103: ["[es] Hello"], 104: ["[es] Hello"]}
+
+
+def test_skips_a_language_whose_translation_failed_and_sends_it_on_a_rerun(async_db, monkeypatch):
+    add_recipients(async_db, ['en', 'de', 'es', 'de'])
+
+    totals, api = run_broadcast(async_db, per_chat_interval=0)
+    assert totals == {'sent': 2, 'failed': 0}
+    assert api.sent() == {100: ["Hello"], 102: ["[es] Hello"]}
+
+    async def progress():
+        async with async_db() as db:
+            return {lang: row.done for lang, row in (await async_botcontrol.get_broadcast_progress(db, 'b1')).items()}
+    assert asyncio.run(progress()) == {'en': True, 'es': True}
+
+    # Once the translator is back, the rerun reaches only the skipped users
+    monkeypatch.setattr(StubTranslator, 'translate', lambda self, text: f"[{self.target}] {text}")
+    totals, api = run_broadcast(async_db, per_chat_interval=0)
+    assert totals == {'sent': 4, 'failed': 0}
+    assert api.sent() == {101: ["[de] Hello"], 103: ["[de] Hello"]}
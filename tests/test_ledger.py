@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import async_botcontrol
+import botcontrol
+from db_models import Balance, Deposit
+
+from conftest import add_users
+
+
+def new_deposit(db, user_id=1, amount=1, coin='BTC', order_id='o1'):
+    return botcontrol.create_deposit(db, user_id, amount, 100, coin, order_id)
+
+
+def expiry(db, user_id=1):
+    db.expire_all()
+    return botcontrol._as_utc(db.get(Balance, user_id).subscription_expires)
+
+
+def test_approve_credits_the_coin_balance(db):
+    add_users(db, 1)
+    deposit = new_deposit(db, amount='0.5', coin='USDT(TRC20)')
+    botcontrol.approve_deposit(db, deposit.id, '0.5', 100)
+    balance = botcontrol.get_balance(db, 1)
+    assert balance.usdt_balance == Decimal('0.5')
+    assert balance.btc_balance == 0
+
+
+def test_reapprove_credits_only_the_difference_and_never_extends_twice(db):
+    add_users(db, 1)
+    deposit = new_deposit(db, amount=1)
+    botcontrol.approve_deposit(db, deposit.id, 1, 100, subscription_days=30)
+    first_expiry = expiry(db)
+    botcontrol.approve_deposit(db, deposit.id, '1.25', 125, subscription_days=30)
+    assert botcontrol.get_balance(db, 1).btc_balance == Decimal('1.25')
+    assert expiry(db) == first_expiry
+
+
+def test_delete_takes_back_amount_and_subscription(db):
+    add_users(db, 1)
+    kept, deleted = new_deposit(db, order_id='o1'), new_deposit(db, amount=2, order_id='o2')
+    botcontrol.approve_deposit(db, kept.id, 1, 100, subscription_days=30)
+    after_first = expiry(db)
+    botcontrol.approve_deposit(db, deleted.id, 2, 200, subscription_days=90)
+    assert expiry(db) - after_first == timedelta(days=90)
+
+    assert botcontrol.delete_deposit(db, deleted.id)
+    assert botcontrol.get_balance(db, 1).btc_balance == Decimal(1)
+    assert expiry(db) == after_first
+
+
+def test_delete_of_unapproved_deposit_leaves_the_ledger_alone(db):
+    add_users(db, 1)
+    approved, pending = new_deposit(db, order_id='o1'), new_deposit(db, amount=5, order_id='o2')
+    botcontrol.approve_deposit(db, approved.id, 1, 100, subscription_days=30)
+    before = expiry(db)
+    assert botcontrol.delete_deposit(db, pending.id)
+    assert botcontrol.get_balance(db, 1).btc_balance == Decimal(1)
+    assert expiry(db) == before
+    assert db.get(Deposit, pending.id) is None
+
+
+def test_rebuild_balance_matches_the_ledger(db):
+    add_users(db, 1)
+    for i, (amount, coin) in enumerate([(1, 'BTC'), ('0.3', 'ETH'), (7, 'USDT')]):
+        deposit = new_deposit(db, amount=amount, coin=coin, order_id=f"o{i}")
+        botcontrol.approve_deposit(db, deposit.id, amount, 10)
+    ledger = botcontrol.get_balance(db, 1)
+    expected = (ledger.btc_balance, ledger.eth_balance, ledger.usdt_balance)
+    rebuilt = botcontrol.rebuild_balance(db, 1)
+    assert (rebuilt.btc_balance, rebuilt.eth_balance, rebuilt.usdt_balance) == expected
+
+
+def test_subscription_extends_from_now_once_lapsed():
+    now = datetime(2026, 1, 10, tzinfo=timezone.utc)
+    lapsed = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    assert botcontrol.extend_subscription(lapsed, 30, now) == now + timedelta(days=30)
+    assert botcontrol.extend_subscription(now + timedelta(days=5), 30, now) == now + timedelta(days=35)
+
+
+def test_repeated_paid_callback_after_approval_credits_nothing_twice(db):
+    add_users(db, 1)
+    deposit = new_deposit(db, amount=1)
+    botcontrol.mark_deposit_paid(db, 'o1')
+    botcontrol.approve_deposit(db, deposit.id, 1, 100, subscription_days=30)
+    approved_expiry = expiry(db)
+
+    assert botcontrol.mark_deposit_paid(db, 'o1').state == 'approved'
+    assert botcontrol.mark_deposits_paid(db, ['o1']) == 0
+    botcontrol.approve_deposit(db, deposit.id, 1, 100, subscription_days=30)
+    assert botcontrol.get_balance(db, 1).btc_balance == Decimal(1)
+    assert expiry(db) == approved_expiry
+
+
+def test_deposit_export_survives_deleting_the_page_boundary(db):
+    add_users(db, 1)
+    ids = [new_deposit(db, order_id=f'o{i}').id for i in range(10)]
+    rows = botcontrol.iter_deposits_by_state(db, 'pending', page_size=3)
+    seen = [next(rows).Deposit.id for _ in range(3)]
+    botcontrol.delete_deposit(db, seen[-1])
+    seen += [row.Deposit.id for row in rows]
+    assert seen == ids
+
+
+def test_async_deposit_export_survives_deleting_the_page_boundary(async_db):
+    async def run():
+        async with async_db() as db:
+            await async_botcontrol.create_user(db, 1, 'Test', None, None)
+            ids = [(await async_botcontrol.create_deposit(db, 1, 1, 100, 'BTC', f'o{i}')).id for i in range(10)]
+            rows = async_botcontrol.iter_deposits_by_state(db, 'pending', page_size=3)
+            seen = [(await anext(rows)).Deposit.id for _ in range(3)]
+            await async_botcontrol.delete_deposit(db, seen[-1])
+            seen += [row.Deposit.id async for row in rows]
+        assert seen == ids
+    asyncio.run(run())
@@ -0,0 +1,7 @@
+import bot
+
+
+def test_every_fixed_label_is_in_the_catalog_sources():
+    sources = bot.menu_registry.source_texts()
+    assert bot.BUTTON_VIEW_PRODUCT in sources
+    assert bot.BUTTON_MAIN_MENU in sources
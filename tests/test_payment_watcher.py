@@ -0,0 +1,130 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+import async_botcontrol
+import payment_watcher
+from db_models import Deposit, PaymentNotification, User
+
+
+class StubSender:
+    def __init__(self, refuse=()):
+        self.sent = []
+        self.refuse = set(refuse)
+
+    async def send(self, chat_id, text, **options) -> bool:
+        if chat_id in self.refuse:
+            return False
+        self.sent.append((chat_id, text))
+        return True
+
+
+async def render(row):
+    return f"{row.amount:.2f} {row.coin} {row.language_code}", None
+
+
+async def setup(session_factory, deposits: int):
+    async with session_factory() as db:
+        db.add_all([User(telegram_id=1, first_name='a', language_code='es'),
+                    User(telegram_id=2, first_name='b', language_code='en')])
+        await db.commit()
+        db.add_all([Deposit(user_id=1 + i % 2, amount=1, coin='BTC', order_id=f"o{i}", state='pending')
+                    for i in range(deposits)])
+        db.add(Deposit(user_id=1, amount=1, coin='BTC', order_id=None, state='pending'))
+        await db.commit()
+
+
+async def make_all_due(session_factory):
+    async with session_factory() as db:
+        await db.execute(update(Deposit).values(next_check_at=datetime.now(timezone.utc) - timedelta(seconds=1)))
+        await db.commit()
+
+
+async def column(session_factory, stmt):
+    async with session_factory() as db:
+        return list((await db.execute(stmt)).all())
+
+
+def test_one_provider_call_per_page_and_backoff(async_db):
+    async def run():
+        await setup(async_db, 25)
+        provider = payment_watcher.StubPaymentProvider()
+        watcher = payment_watcher.PaymentWatcher(provider, render, async_db, batch_size=10, interval=30)
+        assert await watcher.poll() == 0
+        assert provider.calls == 3
+        assert await watcher.poll() == 0  # all backed off
+        assert provider.calls == 3
+        rows = await column(async_db, select(Deposit.check_attempts, Deposit.next_check_at)
+                            .where(Deposit.order_id.isnot(None)))
+        assert {attempts for attempts, _ in rows} == {1}
+        await make_all_due(async_db)
+        await watcher.poll()
+        return await column(async_db, select(Deposit.check_attempts).where(Deposit.order_id.isnot(None)))
+
+    assert {attempts for attempts, in asyncio.run(run())} == {2}
+
+
+def test_backoff_doubles_up_to_the_cap():
+    assert [payment_watcher.backoff(n, 30, 3600) for n in range(9)] == [30, 60, 120, 240, 480, 960, 1920, 3600, 3600]
+    assert payment_watcher.backoff(10_000, 30, 3600) == 3600
+
+
+def test_paid_deposits_are_claimed_once_and_notified_from_the_outbox(async_db):
+    async def run():
+        await setup(async_db, 6)
+        provider = payment_watcher.StubPaymentProvider()
+        for order_id in ('o0', 'o1', 'o4'):
+            provider.pay(order_id)
+        watcher = payment_watcher.PaymentWatcher(provider, render, async_db)
+        assert await watcher.poll() == 3
+        async with async_db() as db:  # a callback racing the watcher claims nothing new
+            assert await async_botcontrol.claim_paid_deposits(db, ['o0', 'o1']) == 0
+
+        # A new watcher, as after a restart, still finds the notifications
+        restarted = payment_watcher.PaymentWatcher(provider, render, async_db)
+        restarted._sender = StubSender(refuse={2})
+        assert await restarted.send_notifications() == 2
+        states = await column(async_db, select(Deposit.order_id, Deposit.state).where(Deposit.state == 'paid'))
+        outbox = await column(async_db, select(PaymentNotification.deposit_id))
+        return restarted._sender.sent, sorted(order_id for order_id, _ in states), outbox
+
+    sent, paid, outbox = asyncio.run(run())
+    assert sent == [(1, "1.00 BTC es"), (1, "1.00 BTC es")]
+    assert paid == ['o0', 'o1', 'o4']
+    assert outbox == []  # the refused one (blocked bot) isn't retried forever
+
+
+def test_failed_render_stays_in_the_outbox(async_db):
+    async def broken_render(row):
+        raise RuntimeError('translator down')
+
+    async def run():
+        await setup(async_db, 1)
+        provider = payment_watcher.StubPaymentProvider()
+        provider.pay('o0')
+        watcher = payment_watcher.PaymentWatcher(provider, broken_render, async_db)
+        watcher._sender = StubSender()
+        await watcher.poll()
+        assert await watcher.send_notifications() == 0
+        watcher.render = render
+        return await watcher.send_notifications()
+
+    assert asyncio.run(run()) == 1
+
+
+def test_provider_error_leaves_the_page_due(async_db):
+    class Down(payment_watcher.PaymentProvider):
+        async def paid_orders(self, order_ids):
+            raise ConnectionError
+
+    async def run():
+        await setup(async_db, 3)
+        watcher = payment_watcher.PaymentWatcher(Down(), render, async_db)
+        try:
+            await watcher.poll()
+        except ConnectionError:
+            pass
+        return await column(async_db, select(Deposit.check_attempts, Deposit.next_check_at))
+
+    assert all(row == (0, None) for row in asyncio.run(run()))
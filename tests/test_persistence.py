@@ -0,0 +1,61 @@
+import asyncio
+
+import async_botcontrol
+from persistence import SQLPersistence
+
+
+class FlakySessions:
+    """Hands out sessions from `factory`, failing while `down` is set."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.down = False
+
+    def __call__(self):
+        if self.down:
+            raise ConnectionError("database unavailable")
+        return self.factory()
+
+
+def stored(async_db, user_id):
+    async def get():
+        async with async_db() as db:
+            return await async_botcontrol.get_bot_state(db, 'user', user_id)
+    return asyncio.run(get())
+
+
+def test_chat_data_is_not_persisted_by_default():
+    assert not SQLPersistence().store_data.chat_data
+    assert SQLPersistence(chat_data=True).store_data.chat_data
+
+
+def test_failed_load_does_not_overwrite_the_stored_state(async_db):
+    sessions = FlakySessions(async_db)
+
+    async def run():
+        first = SQLPersistence(session_factory=sessions)
+        data = {}
+        await first.refresh_user_data(1, data)
+        data.update(cart='a', step=2)
+        await first.update_user_data(1, data)
+        await first.flush()
+
+        # After a restart the load fails: the partial dict must not be written
+        second = SQLPersistence(session_factory=sessions)
+        sessions.down = True
+        data = {}
+        await second.refresh_user_data(1, data)
+        sessions.down = False
+        data['step'] = 3
+        await second.update_user_data(1, data)
+        await second.flush()
+        assert data == {'step': 3}
+
+        # The next load succeeds, keeps the newer value, and writes again
+        await second.refresh_user_data(1, data)
+        assert data == {'cart': 'a', 'step': 3}
+        await second.update_user_data(1, data)
+        await second.flush()
+
+    asyncio.run(run())
+    assert stored(async_db, 1) == '{"step": 3, "cart": "a"}'
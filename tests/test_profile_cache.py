@@ -0,0 +1,80 @@
+import asyncio
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+import async_botcontrol
+import bot
+import profile_cache
+from profile_cache import ProfileCache, RedisBackend
+
+
+@pytest.fixture
+def redis_server():
+    """One fake Redis server, shared by the caches of several 'workers'."""
+    return fakeredis.FakeServer()
+
+
+def worker_cache(server) -> ProfileCache:
+    return ProfileCache(RedisBackend(fakeredis.FakeRedis(server=server)))
+
+
+@pytest.fixture
+def shared_cache(redis_server):
+    """Points the module-wide profile_cache at the fake server, as REDIS_URL does."""
+    backend, ttl = profile_cache.profile_cache.backend, profile_cache.profile_cache.ttl
+    profile_cache.configure(RedisBackend(fakeredis.FakeRedis(server=redis_server)))
+    yield profile_cache.profile_cache
+    profile_cache.configure(backend, ttl)
+
+
+def test_hits_misses_and_invalidations(redis_server):
+    cache = worker_cache(redis_server)
+    assert cache.get(1) is None
+    cache.set(1, {'language_code': 'es'})
+    assert cache.get(1) == {'language_code': 'es'}
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3, 'invalidations': 1}
+
+
+def test_workers_share_entries_and_invalidations(redis_server):
+    first, second = worker_cache(redis_server), worker_cache(redis_server)
+    first.set(1, {'language_code': 'de'})
+    assert second.get(1) == {'language_code': 'de'}
+    second.invalidate(1)
+    assert first.get(1) is None
+
+
+def test_backend_errors_are_misses(redis_server):
+    cache = worker_cache(redis_server)
+    cache.set(1, {'language_code': 'de'})
+    redis_server.connected = False
+    assert cache.get(1) is None
+    cache.set(1, {'language_code': 'es'})
+    cache.invalidate(1)
+    assert cache.stats()['misses'] == 1
+
+
+def test_language_change_in_another_worker_reaches_this_one(async_db, redis_server, shared_cache, monkeypatch):
+    monkeypatch.setattr(bot, 'AsyncSessionLocal', async_db)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1, first_name='Test', last_name=None,
+                                                            username=None, language_code='en'))
+    context = SimpleNamespace(user_data={})
+
+    async def run():
+        # Registers the user, then answers from the cache
+        assert await bot.get_user_language(update, context) == 'en'
+        assert await bot.get_user_language(update, context) == 'en'
+        assert shared_cache.hits == 1
+
+        # An admin script or another worker, with its own connection to the same Redis
+        other = worker_cache(redis_server)
+        monkeypatch.setattr(async_botcontrol, 'profile_cache', other)
+        async with async_db() as session:
+            await async_botcontrol.update_user_language(session, 1, 'es')
+        assert other.invalidations == 1
+
+        assert await bot.get_user_language(update, context) == 'es'
+    asyncio.run(run())
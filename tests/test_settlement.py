@@ -0,0 +1,81 @@
+import asyncio
+from decimal import Decimal
+
+import botcontrol
+import settlement
+from db_models import Deposit, Referral, ReferralSettlement
+
+from conftest import add_users
+
+
+def approved_deposit(db, user_id, dollars, order_id):
+    deposit = botcontrol.create_deposit(db, user_id, 1, dollars, 'BTC', order_id)
+    return botcontrol.approve_deposit(db, deposit.id, 1, dollars)
+
+
+def referral_balance(db, user_id):
+    db.expire_all()
+    balance = botcontrol.get_balance(db, user_id)
+    return balance.referral_balance if balance else Decimal(0)
+
+
+def test_settles_each_deposit_once(db):
+    add_users(db, 1, 2, 3)
+    botcontrol.create_referral(db, 1, 2)
+    approved_deposit(db, 2, 100, 'o1')
+    approved_deposit(db, 2, 50, 'o2')
+    approved_deposit(db, 3, 999, 'o3')  # not referred
+
+    assert botcontrol.settle_referral_batch(db, 'b1', '0.10', 500) == (3, 2)
+    assert botcontrol.settle_referral_batch(db, 'b2', '0.10', 500) == (0, 0)
+    assert referral_balance(db, 1) == Decimal(15)
+    assert db.query(Referral).one().bonus == Decimal(15)
+
+
+def test_reads_only_new_approvals(db):
+    add_users(db, 1, 2)
+    botcontrol.create_referral(db, 1, 2)
+    approved_deposit(db, 2, 100, 'o1')
+    botcontrol.settle_referral_batch(db, 'b1', '0.10', 500)
+
+    late = botcontrol.create_deposit(db, 2, 1, 40, 'BTC', 'o2')
+    assert botcontrol.settle_referral_batch(db, 'b2', '0.10', 500) == (0, 0)  # still pending
+    botcontrol.approve_deposit(db, late.id, 1, 40)
+    assert botcontrol.settle_referral_batch(db, 'b3', '0.10', 500) == (1, 1)
+    assert referral_balance(db, 1) == Decimal(14)
+
+
+def test_batches_cover_every_deposit(db):
+    add_users(db, 1, 2)
+    botcontrol.create_referral(db, 1, 2)
+    for i in range(7):
+        approved_deposit(db, 2, 10, f"o{i}")
+    seen = [botcontrol.settle_referral_batch(db, f"b{i}", '0.10', 3)[0] for i in range(4)]
+    assert seen == [3, 3, 1, 0]
+    assert referral_balance(db, 1) == Decimal(7)
+
+
+def test_settled_deposit_can_be_deleted_and_keeps_its_bonus(db):
+    add_users(db, 1, 2)
+    botcontrol.create_referral(db, 1, 2)
+    deposit = approved_deposit(db, 2, 100, 'o1')
+    botcontrol.settle_referral_batch(db, 'b1', '0.10', 500)
+
+    assert botcontrol.delete_deposit(db, deposit.id)
+    assert db.get(Deposit, deposit.id) is None
+    assert db.query(ReferralSettlement).count() == 1
+    assert referral_balance(db, 1) == Decimal(10)
+
+
+def test_settle_referrals_async(async_db, db):
+    async def run():
+        async with async_db() as session:
+            await session.run_sync(lambda sync: add_users(sync, 1, 2))
+            await session.run_sync(lambda sync: botcontrol.create_referral(sync, 1, 2))
+            for i in range(5):
+                await session.run_sync(lambda sync, i=i: approved_deposit(sync, 2, 20, f"o{i}"))
+        first = await settlement.settle_referrals(async_db, rate='0.10', batch_size=2)
+        second = await settlement.settle_referrals(async_db, rate='0.10', batch_size=2)
+        return first, second
+
+    assert asyncio.run(run()) == (5, 0)
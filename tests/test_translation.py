@@ -0,0 +1,42 @@
+import asyncio
+import threading
+import time
+
+import translation
+
+
+def test_timed_out_translations_never_exceed_the_thread_cap(monkeypatch):
+    running, peak, lock = 0, 0, threading.Lock()
+
+    def slow_translate(texts, lang):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.3)
+        with lock:
+            running -= 1
+        return {text: text.upper() for text in texts}
+
+    monkeypatch.setattr(translation, '_translate_batch_blocking', slow_translate)
+    monkeypatch.setattr(translation, 'TRANSLATE_TIMEOUT', 0.05)
+
+    async def run():
+        for i in range(3):
+            texts = [f"text {i} {j} " + 'x' * translation.PARALLEL_BATCH_CHARS for j in range(6)]
+            _, complete = await translation.translate_all(texts, 'de')
+            assert not complete
+        await asyncio.sleep(0.8)
+
+    asyncio.run(run())
+    assert peak == translation.MAX_CONCURRENT_TRANSLATIONS
+
+
+def test_restored_templates_are_safe_to_format():
+    text, names = translation.protect_placeholders("You have {amount} {coin}.")
+    assert text == "You have [[0]] [[1]]."
+    assert translation.restore_placeholders("Tienes [[0]] [[1]].", names) == "Tienes {amount} {coin}."
+    assert translation.restore_placeholders("Tienes [[1]] [[0]] {{ok}}.", names) == "Tienes {coin} {amount} {{ok}}."
+    for mangled in ("Tienes [[0]].", "Tienes [[0]] [[0]] [[1]].", "Tienes [[0]] [[1]] [[2]].",
+                    "Tienes { [[0]] [[1]].", "Tienes [[0]] [[1]] }.", "Tienes [[0]] [[1]] {x}."):
+        assert translation.restore_placeholders(mangled, names) is None, mangled
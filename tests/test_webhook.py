@@ -0,0 +1,83 @@
+import asyncio
+import json
+import queue
+import random
+
+from aiohttp.test_utils import TestClient, TestServer
+from telegram.ext import ApplicationBuilder, MessageHandler, filters
+
+import webhook
+from benchmarks.fake_telegram import FakeBotAPI, message_update, callback_update, post_updates, wait_for_calls
+
+
+def test_partition_key():
+    assert webhook.partition_key(message_update(1, 42, 'hi')) == 42
+    assert webhook.partition_key(callback_update(2, 43, 'mainme')) == 43
+    assert webhook.partition_key({'update_id': 7, 'poll': {'id': 'p'}}) == 7
+
+
+def receive(queues, *bodies, headers=None) -> list[int]:
+    """POSTs each body to a receiver over `queues`, returns the response statuses."""
+    async def run():
+        async with TestClient(TestServer(webhook.create_receiver(queues))) as client:
+            statuses = []
+            for body in bodies:
+                response = await client.post(webhook.WEBHOOK_PATH, data=body, headers=headers or {})
+                statuses.append(response.status)
+            return statuses
+    return asyncio.run(run())
+
+
+def test_receiver_rejects_what_is_not_an_update():
+    queues = [queue.Queue()]
+    assert receive(queues, b'not json', b'[]', b'1', b'null') == [400, 400, 400, 400]
+    assert queues[0].empty()
+
+
+def test_receiver_checks_the_secret(monkeypatch):
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET', 'sesame')
+    body = json.dumps(message_update(1, 42, 'hi'))
+    queues = [queue.Queue()]
+    assert receive(queues, body, headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}) == [403]
+    assert receive(queues, body, headers={'X-Telegram-Bot-Api-Secret-Token': 'sesame'}) == [200]
+    assert queues[0].qsize() == 1
+
+
+def test_receiver_routes_by_user_and_sheds_load():
+    queues = [queue.Queue(2), queue.Queue(2)]
+    bodies = [json.dumps(message_update(i, 42, 'hi')) for i in range(3)]
+    assert receive(queues, *bodies) == [200, 200, 503]
+    assert queues[42 % 2].qsize() == 2 and queues[43 % 2].empty()
+
+
+def test_updates_from_the_fake_telegram_keep_each_users_order():
+    async def echo(update, context):
+        await asyncio.sleep(random.uniform(0, 0.01))  # finish out of order if allowed to
+        await context.bot.send_message(update.effective_chat.id, update.message.text)
+
+    async def run():
+        api = FakeBotAPI()
+        await api.start()
+        queues = [queue.Queue(), queue.Queue()]
+        workers = []
+        for index, worker_queue in enumerate(queues):
+            application = (ApplicationBuilder().token('1:fake').base_url(f"{api.url}/bot").updater(None)
+                           .concurrent_updates(webhook.PerUserUpdateProcessor(16)).build())
+            application.add_handler(MessageHandler(filters.TEXT, echo))
+            workers.append(asyncio.create_task(webhook.serve_queue(application, worker_queue, f"Worker {index}")))
+
+        async with TestClient(TestServer(webhook.create_receiver(queues))) as client:
+            chats = {user_id: [message_update(user_id * 100 + i, user_id, str(i)) for i in range(10)]
+                     for user_id in range(1, 7)}
+            statuses = await post_updates(str(client.make_url(webhook.WEBHOOK_PATH)), chats)
+            assert statuses == {200: 60}
+            # getMe of each worker, then one sendMessage per update
+            assert await wait_for_calls(api, 2 + 60, timeout=10)
+        for worker_queue in queues:
+            worker_queue.put(None)
+        await asyncio.gather(*workers)
+        await api.stop()
+        return api.sent()
+
+    sent = asyncio.run(run())
+    assert sent == {user_id: [str(i) for i in range(10)] for user_id in range(1, 7)}
@@ -0,0 +1,395 @@
+import asyncio
+import hashlib
+import logging
+import re
+import string
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from deep_translator import GoogleTranslator
+
+# Import the session factory and the CRUD functions for the persistent tier
+from db_models import SessionLocal
+import botcontrol
+from catalog import CatalogSet
+
+
+def text_hash(text: str) -> str:
+    """Returns the cache key for a source text (sha256 hex digest)."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """A small, thread-safe, bounded LRU map."""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TranslationCache:
+    """
+    Two-tier translation cache keyed on (source text hash, target lang).
+    Tier 1 is an in-process LRU, tier 2 is the 'translations' table.
+    In front of both sit the compiled catalogs (catalog.py), once loaded.
+    """
+
+    def __init__(self, maxsize: int = 4096, session_factory=SessionLocal):
+        self.memory = LRUCache(maxsize)
+        self.session_factory = session_factory
+        self.catalogs = CatalogSet()
+        self.catalog_hits = 0  # served from a compiled catalog
+        self.hits = 0         # served from the in-process LRU
+        self.store_hits = 0   # served from the database
+        self.misses = 0       # had to call the translator
+
+    def get_memory(self, text: str, lang: str) -> str | None:
+        """Looks in the catalogs and the in-process tier only. Safe to call on the event loop."""
+        translated = self.catalogs.get(text, lang)
+        if translated is not None:
+            self.catalog_hits += 1
+            return translated
+        translated = self.memory.get((text_hash(text), lang))
+        if translated is not None:
+            self.hits += 1
+        return translated
+
+    def get(self, text: str, lang: str) -> str | None:
+        translated = self.get_memory(text, lang)
+        if translated is not None:
+            return translated
+        return self.get_store(text, lang)
+
+    def get_store(self, text: str, lang: str) -> str | None:
+        """Looks in the database tier only (blocking), promoting hits to memory."""
+        key = (text_hash(text), lang)
+        try:
+            db = self.session_factory()
+            try:
+                translated = botcontrol.get_translation(db, source_hash=key[0], lang=lang)
+            finally:
+                db.close()
+        except Exception as e:
+            # The database is only a cache here, never fail a render because of it
+            logging.warning(f"Translation cache lookup failed for lang '{lang}': {e}")
+            translated = None
+
+        if translated is None:
+            self.misses += 1
+            return None
+        self.store_hits += 1
+        self.memory.set(key, translated)
+        return translated
+
+    def set(self, text: str, lang: str, translated: str) -> None:
+        key = (text_hash(text), lang)
+        self.memory.set(key, translated)
+        try:
+            db = self.session_factory()
+            try:
+                botcontrol.save_translation(db, source_hash=key[0], lang=lang,
+                                            source_text=text, translated_text=translated)
+            finally:
+                db.close()
+        except Exception as e:
+            logging.warning(f"Translation cache write failed for lang '{lang}': {e}")
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and the current LRU size."""
+        found = self.catalog_hits + self.hits + self.store_hits
+        lookups = found + self.misses
+        return {
+            'catalog_hits': self.catalog_hits,
+            'hits': self.hits,
+            'store_hits': self.store_hits,
+            'misses': self.misses,
+            'hit_rate': found / lookups if lookups else 0.0,
+            'memory_size': len(self.memory),
+        }
+
+
+translation_cache = TranslationCache()
+
+
+# --- Segmenting Long Texts ---
+# Long texts are translated and cached paragraph by paragraph (line by line
+# for very long paragraphs), so editing one line of a screen only
+# retranslates that paragraph, and a paragraph shared by several screens is
+# translated once. Short texts such as button labels stay whole.
+
+SEGMENT_MIN_CHARS = 400   # texts shorter than this are translated in one piece
+MAX_SEGMENT_CHARS = 600   # paragraphs longer than this are split into lines
+
+_PARAGRAPH_BREAK = re.compile(r"(\s*\n\s*\n\s*)")
+_LINE_BREAK = re.compile(r"(\s*\n\s*)")
+
+
+def split_segments(text: str) -> list[str]:
+    """
+    Splits `text` into [segment, separator, segment, ..., segment], so the
+    segments are at even indexes and ''.join() gives back the text.
+    """
+    if len(text) < SEGMENT_MIN_CHARS:
+        return [text]
+    parts = []
+    for i, paragraph in enumerate(_PARAGRAPH_BREAK.split(text)):
+        if i % 2 or len(paragraph) <= MAX_SEGMENT_CHARS:
+            parts.append(paragraph)
+        else:
+            parts += _LINE_BREAK.split(paragraph)
+    return parts
+
+
+def unique_segments(texts: list[str]) -> list[str]:
+    """The distinct segments of `texts` worth translating (not blank), in order."""
+    return list(dict.fromkeys(segment for text in texts if text
+                              for segment in split_segments(text)[::2] if segment.strip()))
+
+
+def join_segments(parts: list[str], translated: dict[str, str]) -> str:
+    """Reassembles split_segments() parts, keeping any untranslated segment in English."""
+    return ''.join(part if i % 2 else translated.get(part, part) for i, part in enumerate(parts))
+
+
+def translate(text: str, lang: str) -> str:
+    """Translates English text to `lang`, going through the cache first."""
+    if lang == 'en' or not text:
+        return text
+
+    parts = split_segments(text)
+    if len(parts) > 1:
+        translated = {}
+        pending = []
+        for segment in unique_segments([text]):
+            cached = translation_cache.get_memory(segment, lang)
+            if cached is not None:
+                translated[segment] = cached
+            else:
+                pending.append(segment)
+        if pending:
+            translated.update(_translate_batch_blocking(pending, lang))
+        return join_segments(parts, translated)
+
+    cached = translation_cache.get(text, lang)
+    if cached is not None:
+        return cached
+
+    try:
+        translated = GoogleTranslator(source='auto', target=lang).translate(text)
+    except Exception as e:
+        logging.error(f"Translation failed for text '{text}' to lang '{lang}': {e}")
+        return text  # Return original text on failure, and don't cache it
+    if not translated:
+        return text
+
+    translation_cache.set(text, lang, translated)
+    return translated
+
+
+# --- Async, Batched Translation ---
+# Handlers must never call the blocking translator on the event loop.
+# translate_many() translates every segment of one render in worker threads,
+# packing them into as few translator requests as possible and sending those
+# requests in parallel.
+
+TRANSLATE_TIMEOUT = 3.0            # seconds per translate_many() call
+MAX_CONCURRENT_TRANSLATIONS = 4    # translator requests in flight at once
+MAX_BATCH_CHARS = 4500             # Google Translate rejects payloads over 5000 chars
+PARALLEL_BATCH_CHARS = 1500        # a render's missing segments are split into requests of about this size, sent in parallel
+
+# A marker line the translator leaves untouched, used to pack several strings into one request
+BATCH_SEPARATOR = "\n[[#]]\n"
+_BATCH_SPLIT = re.compile(r"\s*\[\[#\]\]\s*")
+
+# Translator requests run on their own threads: one that outlives its
+# TRANSLATE_TIMEOUT keeps its thread until it returns, so the cap holds and
+# the default executor (Redis calls, the webhook queues) is never filled
+_translation_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TRANSLATIONS,
+                                           thread_name_prefix='translate')
+
+
+def _pack_batches(texts: list[str], limit: int = MAX_BATCH_CHARS) -> list[list[str]]:
+    """Groups texts into batches whose joined size stays under `limit` chars."""
+    batches, batch, size = [], [], 0
+    for text in texts:
+        if batch and size + len(text) + len(BATCH_SEPARATOR) > limit:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(text)
+        size += len(text) + len(BATCH_SEPARATOR)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _translate_batch_blocking(texts: list[str], lang: str) -> dict[str, str]:
+    """
+    Resolves texts through the database tier and the translator.
+    Runs in a worker thread. Returns only the texts it could translate.
+    """
+    results = {}
+    pending = []
+    for text in texts:
+        stored = translation_cache.get_store(text, lang)
+        if stored is not None:
+            results[text] = stored
+        else:
+            pending.append(text)
+    if not pending:
+        return results
+
+    translator = GoogleTranslator(source='auto', target=lang)
+    for batch in _pack_batches(pending):
+        try:
+            if len(batch) == 1:
+                parts = [translator.translate(batch[0])]
+            else:
+                parts = _BATCH_SPLIT.split(translator.translate(BATCH_SEPARATOR.join(batch)))
+                if len(parts) != len(batch):
+                    # The translator mangled a separator, fall back to one request per string
+                    logging.warning(f"Batched translation to '{lang}' returned {len(parts)} parts "
+                                    f"for {len(batch)} strings, retrying one by one.")
+                    parts = [translator.translate(text) for text in batch]
+        except Exception as e:
+            logging.error(f"Batched translation of {len(batch)} strings to lang '{lang}' failed: {e}")
+            continue
+        for text, translated in zip(batch, parts):
+            if translated:
+                results[text] = translated
+                translation_cache.set(text, lang, translated)
+    return results
+
+
+def translate_batch(texts: list[str], lang: str) -> dict[str, str]:
+    """
+    Blocking, batched translation with no timeout, for offline jobs such as
+    building the catalogs. Returns {segment: translation} for every segment
+    of `texts` it could translate.
+    """
+    return _translate_batch_blocking(unique_segments(texts), lang)
+
+
+async def _translate_batch(batch: list[str], lang: str, results: dict[str, str]) -> None:
+    """Translates one packed batch in a worker thread, adding what it got to `results`."""
+    loop = asyncio.get_running_loop()
+    results.update(await loop.run_in_executor(_translation_executor, _translate_batch_blocking, batch, lang))
+
+
+async def translate_all(texts: list[str], lang: str) -> tuple[list[str], bool]:
+    """
+    Same as translate_many(), but also reports whether every string was
+    actually translated (False if any part of them fell back to English).
+    """
+    if lang == 'en':
+        return list(texts), True
+
+    results = {}
+    missing = []
+    for segment in unique_segments(texts):
+        cached = translation_cache.get_memory(segment, lang)
+        if cached is not None:
+            results[segment] = cached
+        else:
+            missing.append(segment)
+
+    if missing:
+        try:
+            # Batches that finish before the timeout are kept even if another one doesn't
+            await asyncio.wait_for(
+                asyncio.gather(*(_translate_batch(batch, lang, results) for batch in _pack_batches(missing, PARALLEL_BATCH_CHARS))),
+                timeout=TRANSLATE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            # Batches still queued are dropped; the running ones keep going
+            # and still fill the cache for the next render
+            logging.warning(f"Translation of {len(missing)} segments to lang '{lang}' timed out, "
+                            f"falling back to English for the rest.")
+        except Exception as e:
+            logging.error(f"Translation of {len(missing)} segments to lang '{lang}' failed: {e}")
+
+    complete = all(segment in results for segment in missing)
+    return [join_segments(split_segments(text), results) if text else text for text in texts], complete
+
+
+async def translate_many(texts: list[str], lang: str) -> list[str]:
+    """
+    Translates all strings for one render with a single batched request.
+    The blocking work runs off the event loop under a concurrency cap and a
+    timeout. Any string that can't be translated in time is returned in English.
+    """
+    translated, _ = await translate_all(texts, lang)
+    return translated
+
+
+async def translate_async(text: str, lang: str) -> str:
+    """Async, non-blocking counterpart of translate() for a single string."""
+    return (await translate_many([text], lang))[0]
+
+
+# --- Placeholder-Safe Templates ---
+# str.format templates are translated once per language with their
+# {placeholders} swapped for tokens the translator leaves alone, then the
+# live values are filled in after translation (see MenuRegistry._build()).
+
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+_PLACEHOLDER_TOKEN = re.compile(r"\[\[\s*(\d+)\s*\]\]")
+
+def protect_placeholders(template: str) -> tuple[str, list[str]]:
+    """Replaces each {name} with a numbered [[n]] token. Returns the text and the names."""
+    names = []
+
+    def _token(match):
+        names.append(match.group(1))
+        return f"[[{len(names) - 1}]]"
+
+    return _PLACEHOLDER.sub(_token, template), names
+
+
+def restore_placeholders(text: str, names: list[str]) -> str | None:
+    """
+    Turns [[n]] tokens back into {name} placeholders.
+    Returns None if the translator dropped, duplicated or invented a placeholder,
+    or left a stray brace: the result must be safe to pass to str.format().
+    """
+    seen = []
+
+    def _placeholder(match):
+        index = int(match.group(1))
+        if index >= len(names):
+            return match.group(0)  # left as-is, caught by the check below
+        seen.append(index)
+        return "{" + names[index] + "}"
+
+    restored = _PLACEHOLDER_TOKEN.sub(_placeholder, text)
+    if sorted(seen) != list(range(len(names))) or _PLACEHOLDER_TOKEN.search(restored):
+        return None
+    try:
+        fields = [field for _, field, _, _ in string.Formatter().parse(restored) if field is not None]
+    except ValueError:
+        return None  # a single { or }
+    if sorted(fields) != sorted(names):
+        return None  # e.g. a "{x}" of the translator's own
+    return restored
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+from collections import defaultdict
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor
+
+# --- Webhook Mode ---
+# One receiver process takes Telegram's POSTs (aiohttp) and hands each update
+# to one of WEBHOOK_WORKERS worker processes by user id, so a user's updates
+# stay in order while different users run on every core. Each worker runs
+# bot.build_application() without an Updater. Run: python webhook.py
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # public https URL for setWebhook, empty to skip it
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")    # echoed by Telegram in X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "")  # e.g. benchmarks/fake_telegram.py for load tests
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")     # for setWebhook and the workers, empty for bot.BOT_TOKEN
+
+MAX_CONCURRENT_UPDATES = 256  # per worker
+QUEUE_SIZE = 10_000           # per worker, the receiver answers 503 when a worker is this far behind
+
+# Keys of an Update that carry a `from` user, in Telegram's order of likelihood
+_USER_KEYS = ('message', 'callback_query', 'edited_message', 'inline_query', 'chosen_inline_result',
+              'my_chat_member', 'chat_member', 'chat_join_request', 'shipping_query',
+              'pre_checkout_query', 'poll_answer')
+
+
+def partition_key(data: dict) -> int:
+    """Returns the user id an update (a JSON object) belongs to, or its update_id if it has no user."""
+    for key in _USER_KEYS:
+        payload = data.get(key)
+        if payload:
+            user = payload.get('from') or payload.get('user')
+            if user:
+                return user['id']
+    return data.get('update_id', 0)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently, but each user's
+    updates strictly one after another, in arrival order.
+    At most `max_concurrent_updates` run at once. That limit is taken only
+    once the user's lock is held: PTB's own semaphore (sized `max_pending`)
+    is held while waiting for it, so a user with a backlog of updates would
+    otherwise fill every slot with updates queued behind their own lock.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending: int = QUEUE_SIZE):
+        super().__init__(max(max_pending, max_concurrent_updates))
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = defaultdict(asyncio.Lock)
+        self._waiting = defaultdict(int)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            async with self._running:
+                await coroutine
+            return
+        self._waiting[user.id] += 1
+        try:
+            async with self._locks[user.id], self._running:
+                await coroutine
+        finally:
+            self._waiting[user.id] -= 1
+            if not self._waiting[user.id]:
+                # Keep the lock table bounded to users with updates in flight
+                del self._waiting[user.id]
+                del self._locks[user.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# --- Worker Process ---
+
+def run_worker(index: int, queue) -> None:
+    """Entry point of a worker process: feeds its queue into a bot Application."""
+    logging.basicConfig(format=f'%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    asyncio.run(_worker_main(index, queue))
+
+
+async def _worker_main(index: int, queue) -> None:
+    # Imported here so the receiver process never loads the bot, the models or a DB driver
+    import metrics
+    if metrics.METRICS_PORT:
+        metrics.METRICS_PORT += index  # one endpoint per worker
+    import bot
+    bot.RUN_JOBS = index == 0  # one of each scheduled job for the whole bot
+    if BOT_TOKEN:
+        bot.BOT_TOKEN = BOT_TOKEN
+
+    builder = ApplicationBuilder().updater(None).concurrent_updates(
+        PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+    application = bot.build_application(builder)
+    await serve_queue(application, queue, name=f"Worker {index}")
+
+
+async def serve_queue(application, queue, name: str = "Worker") -> None:
+    """Runs `application` on the raw updates of `queue` until it yields the None sentinel."""
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        if application.post_init:
+            await application.post_init(application)
+        logging.info(f"{name} ready.")
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:  # shutdown sentinel
+                break
+            update = Update.de_json(json.loads(raw), application.bot)
+            await application.update_queue.put(update)
+        await application.stop()
+
+
+# --- Receiver Process ---
+
+def create_receiver(queues: list):
+    """Builds the aiohttp app that accepts webhook POSTs and routes them to worker queues."""
+    from aiohttp import web  # optional dependency, only needed for webhook mode
+
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        raw = await request.read()
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)  # valid JSON, but not an Update
+        queue = queues[partition_key(data) % len(queues)]
+        try:
+            queue.put_nowait(raw)
+        except Exception:
+            # Worker is saturated: let Telegram retry this update later
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    return app
+
+
+async def _set_webhook() -> None:
+    from telegram import Bot
+    if not BOT_TOKEN:
+        logging.error("WEBHOOK_URL is set but TELEGRAM_BOT_TOKEN is not, skipping setWebhook.")
+        return
+    options = {'base_url': f"{TELEGRAM_API_BASE_URL}/bot"} if TELEGRAM_API_BASE_URL else {}
+    async with Bot(BOT_TOKEN, **options) as telegram_bot:
+        await telegram_bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+
+
+def main(workers: int = WEBHOOK_WORKERS) -> None:
+    """Starts the worker processes and serves the webhook receiver until interrupted."""
+    from aiohttp import web
+
+    logging.basicConfig(format='%(asctime)s - receiver - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    # "spawn" gives every worker a fresh interpreter with its own engine and connection pool
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(QUEUE_SIZE) for _ in range(workers)]
+    processes = [context.Process(target=run_worker, args=(i, queues[i]), daemon=True) for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    if WEBHOOK_URL:
+        asyncio.run(_set_webhook())
+
+    print(f"Webhook receiver on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} with {workers} workers...")
+    try:
+        web.run_app(create_receiver(queues), host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, print=None)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=10)
+
+
+if __name__ == '__main__':
+    main()